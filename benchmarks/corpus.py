@@ -0,0 +1,39 @@
+"""Deterministic corpus of synthetic changes of increasing size."""
+
+SIZES = [1, 4, 16, 64]
+
+def make_files(file_count, hunks_per_file=3, lines_per_hunk=12):
+    # Files in the format of the GitHub "list pull request files" API
+    files = []
+    for f in range(file_count):
+        hunks = []
+        for h in range(hunks_per_file):
+            start = 10 + h * 40
+            lines = [f"@@ -{start},{lines_per_hunk} +{start},{lines_per_hunk + 2} @@ def handler_{f}_{h}(request):"]
+            for i in range(lines_per_hunk):
+                if i == lines_per_hunk // 2:
+                    lines.append(f"-    result = process(request.data[{i}])")
+                    lines.append(f"+    result = process(request.data[{i}], strict=True)")
+                    lines.append(f"+    if result is None:")
+                    lines.append(f"+        raise ValueError('invalid request {f}.{h}')")
+                else:
+                    lines.append(f"     value_{i} = request.get('field_{i}', {i})")
+            hunks.append("\n".join(lines))
+        additions = hunks_per_file * 3
+        deletions = hunks_per_file
+        files.append({
+            "filename": f"service/handlers/module_{f}.py",
+            "status": "modified",
+            "additions": additions,
+            "deletions": deletions,
+            "changes": additions + deletions,
+            "patch": "\n".join(hunks),
+        })
+    return files
+
+def make_diff(file_count, hunks_per_file=3, lines_per_hunk=12):
+    parts = []
+    for i, file in enumerate(make_files(file_count, hunks_per_file, lines_per_hunk)):
+        name = file["filename"]
+        parts.append(f"diff --git a/{name} b/{name}\nindex {i:07x}..{i + 1:07x} 100644\n--- a/{name}\n+++ b/{name}\n{file['patch']}\n")
+    return "".join(parts)
@@ -0,0 +1,104 @@
+"""Fake GitHub API serving the benchmark corpus.
+
+Pull Request number N contains the changes of corpus.make_files(N). Supports the
+endpoints used by pearbot: repository installations, installation tokens, pull requests (JSON and diff
+media type), the paginated list of files and issue comments.
+
+    python benchmarks/fake_github.py --port 11600
+"""
+import argparse
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from corpus import make_diff, make_files
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, status=200, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Remaining", "4999")
+        self.send_header("X-RateLimit-Reset", "0")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.count("POST")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if re.fullmatch(r"/app/installations/\d+/access_tokens", self.path):
+            self.send({"token": "ghs_benchmark", "expires_at": "2999-01-01T00:00:00Z"}, 201)
+        elif re.fullmatch(r"/repos/[^/]+/[^/]+/issues/\d+/comments", self.path):
+            self.server.comments.append(json.loads(body)["body"])
+            self.send({"id": len(self.server.comments)}, 201)
+        else:
+            self.send({"message": "Not Found"}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/_stats":
+            self.send(self.server.stats())
+            return
+        self.server.count("GET")
+        if re.fullmatch(r"/repos/[^/]+/[^/]+/installation", url.path):
+            self.send({"id": 1})
+            return
+        match = re.fullmatch(r"/repos/([^/]+/[^/]+)/pulls/(\d+)(/files)?", url.path)
+        if not match:
+            self.send({"message": "Not Found"}, 404)
+            return
+        number = int(match.group(2))
+        if match.group(3):
+            files = make_files(number)
+            per_page = int(parse_qs(url.query).get("per_page", ["30"])[0])
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            headers = {}
+            if page * per_page < len(files):
+                next_url = f"http://{self.headers['Host']}{url.path}?per_page={per_page}&page={page + 1}"
+                headers["Link"] = f'<{next_url}>; rel="next"'
+            self.send(files[(page - 1) * per_page:page * per_page], headers=headers)
+        elif self.headers.get("Accept") == "application/vnd.github.v3.diff":
+            self.send(make_diff(number).encode(), content_type="text/plain")
+        else:
+            self.send({"number": number, "title": f"Benchmark PR with {number} files", "body": "Synthetic changes", "head": {"sha": f"{number:040x}"}})
+
+class FakeGitHubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, FakeGitHubHandler)
+        self.requests = {}
+        self.comments = []
+        self._lock = threading.Lock()
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.requests), "comments": len(self.comments)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake GitHub API serving the benchmark corpus")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11600)
+    args = parser.parse_args()
+
+    server = FakeGitHubServer((args.host, args.port))
+    print(f"http://{args.host}:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
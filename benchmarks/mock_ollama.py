@@ -0,0 +1,156 @@
+"""Mock Ollama server replaying recorded responses.
+
+/api/generate streams the tokens of recordings/generate.ndjson after `--latency`
+seconds at `--token-rate` tokens per second; /api/show and /api/tags return the
+recorded JSON, /api/embed returns embeddings of character trigrams. /_stats reports the number of calls and the time the first token
+of each generation was sent.
+
+    python benchmarks/mock_ollama.py --port 11500 --token-rate 200 --latency 0.05
+"""
+import argparse
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+RECORDINGS_DIR = Path(__file__).parent / "recordings"
+
+def embedding(text, dim=64):
+    # Stand-in for an embedding model: character trigrams hashed into `dim` buckets, so similar texts get similar vectors
+    vector = [0.0] * dim
+    for i in range(len(text) - 2):
+        vector[zlib.crc32(text[i:i + 3].encode()) % dim] += 1.0
+    return vector
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/api/tags":
+            server.count("tags")
+            self.send_json(server.tags)
+        elif self.path == "/api/ps":
+            self.send_json({"models": [{"name": name} for name in server.tags_names()]})
+        elif self.path == "/_stats":
+            self.send_json(server.stats())
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        server = self.server
+        request = self.read_json()
+        if self.path == "/api/show":
+            server.count("show")
+            self.send_json(server.show)
+        elif self.path == "/api/generate":
+            self.generate(request)
+        elif self.path == "/api/embed":
+            server.count("embed")
+            inputs = request.get("input", [])
+            self.send_json({"model": request.get("model"), "embeddings": [embedding(text) for text in ([inputs] if isinstance(inputs, str) else inputs)]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def generate(self, request):
+        server = self.server
+        prompt = request.get("prompt", "")
+        if not prompt:
+            # Loading a model (warm-up) does not generate anything
+            server.count("load")
+            self.send_json({"model": request.get("model"), "response": "", "done": True, "done_reason": "load"})
+            return
+
+        server.count("generate")
+        server.prompt_chars += len(prompt)
+        stream = request.get("stream", True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(server.latency)
+        # Like Ollama, the output stops after `num_predict` tokens
+        num_predict = request.get("options", {}).get("num_predict", -1)
+        tokens = server.generation[:-1] if num_predict < 0 else server.generation[:-1][:num_predict]
+        first = True
+        for message in tokens:
+            if stream:
+                self.write_chunk(message)
+            if first:
+                server.first_tokens.append(time.time())
+                first = False
+            time.sleep(1 / server.token_rate)
+        final = dict(server.generation[-1], prompt_eval_count=len(prompt) // 4, eval_count=len(tokens))
+        if len(tokens) < len(server.generation) - 1:
+            final["done_reason"] = "length"
+        if not stream:
+            final["response"] = "".join(message["response"] for message in tokens)
+        self.write_chunk(final)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, message):
+        data = json.dumps(message).encode() + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+class MockOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, token_rate=100.0, latency=0.0, context_length=None):
+        super().__init__(address, MockOllamaHandler)
+        self.token_rate = token_rate
+        self.latency = latency
+        self.generation = [json.loads(line) for line in (RECORDINGS_DIR / "generate.ndjson").read_text().splitlines() if line]
+        self.show = json.loads((RECORDINGS_DIR / "show.json").read_text())
+        self.tags = json.loads((RECORDINGS_DIR / "tags.json").read_text())
+        if context_length:
+            self.show["model_info"]["llama.context_length"] = context_length
+        self.calls = {}
+        self.first_tokens = []
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def tags_names(self):
+        return [model["name"] for model in self.tags["models"]]
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "first_tokens": list(self.first_tokens), "prompt_chars": self.prompt_chars}
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Ollama server replaying recorded responses")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--token-rate", type=float, default=100.0, help="Tokens per second of the replayed generations")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first token of a generation")
+    parser.add_argument("--context-length", type=int, default=None, help="Context length reported for the model")
+    args = parser.parse_args()
+
+    server = MockOllamaServer((args.host, args.port), args.token_rate, args.latency, args.context_length)
+    print(f"http://{args.host}:{server.server_address[1]}", flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
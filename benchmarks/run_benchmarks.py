@@ -0,0 +1,164 @@
+"""Measures pearbot's own overhead against a mock Ollama server and a fake GitHub API.
+
+For every size of the corpus, the local diff review (review_local.analyze_diff) and
+the Pull Request review (GitHubReviewer.perform_review) are run once, reporting
+end-to-end latency, time to first token, CPU time and peak memory allocated by
+pearbot, and the number of LLM calls. Results are written as JSON, and can be
+compared with an earlier run:
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --output bench-new.json --compare bench.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import requests
+
+BENCHMARKS_DIR = Path(__file__).parent
+sys.path.insert(0, str(BENCHMARKS_DIR.parent / "src"))
+
+from corpus import SIZES, make_diff
+
+def start_server(script, *args):
+    process = subprocess.Popen([sys.executable, str(BENCHMARKS_DIR / script), "--port", "0", *args], stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        raise RuntimeError(f"{script} did not start")
+    return process, url
+
+def private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+
+def measure(name, size, func, ollama_url):
+    from model_registry import registry
+
+    # Every run starts like a fresh invocation, without cached model metadata
+    registry.invalidate()
+    before = requests.get(f"{ollama_url}/_stats").json()
+
+    tracemalloc.start()
+    start_wall = time.time()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        func()
+    cpu = time.process_time() - start_cpu
+    latency = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    after = requests.get(f"{ollama_url}/_stats").json()
+    first_tokens = after["first_tokens"][len(before["first_tokens"]):]
+    calls = {endpoint: count - before["calls"].get(endpoint, 0) for endpoint, count in after["calls"].items()}
+    result = {
+        "mode": name,
+        "size": size,
+        "latency_seconds": round(latency, 4),
+        "time_to_first_token_seconds": round(min(first_tokens) - start_wall, 4) if first_tokens else None,
+        "cpu_seconds": round(cpu, 4),
+        "peak_memory_bytes": peak,
+        "llm_calls": calls.get("generate", 0),
+        "ollama_calls": calls,
+        "prompt_chars": after["prompt_chars"] - before["prompt_chars"],
+    }
+    print(f"{name:>6} size {size:>3}: {latency:7.3f}s latency, {cpu:6.3f}s CPU, {peak / 1024:8.1f} KiB peak, {result['llm_calls']} LLM calls")
+    return result
+
+def compare(results, previous_path):
+    previous = {(r["mode"], r["size"]): r for r in json.loads(Path(previous_path).read_text())["results"]}
+    print(f"\nCompared with {previous_path}:")
+    for result in results:
+        old = previous.get((result["mode"], result["size"]))
+        if old is None:
+            continue
+        changes = []
+        for key in ("latency_seconds", "cpu_seconds", "peak_memory_bytes", "llm_calls"):
+            if old[key]:
+                changes.append(f"{key} {(result[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"{result['mode']:>6} size {result['size']:>3}: {', '.join(changes)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Pearbot benchmarks")
+    parser.add_argument("--sizes", type=str, default=",".join(map(str, SIZES)), help="Comma-separated numbers of changed files")
+    parser.add_argument("--modes", type=str, default="local,github", help="Comma-separated list of: local, github")
+    parser.add_argument("--token-rate", type=float, default=500.0, help="Tokens per second of the mock generations")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds before the first token of a mock generation")
+    parser.add_argument("--context-length", type=int, default=8192, help="Context length reported by the mock model")
+    parser.add_argument("--initial-review-models", type=str, default="llama3.1,llama3.1,llama3.1")
+    parser.add_argument("--model", type=str, default="llama3.1")
+    parser.add_argument("--prompt-style", type=str, default="default")
+    parser.add_argument("--parallel-reviews", type=int, default=1)
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="File to write the results to")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier results to compare with")
+    args = parser.parse_args()
+
+    ollama_process, ollama_url = start_server("mock_ollama.py", "--token-rate", str(args.token_rate), "--latency", str(args.latency), "--context-length", str(args.context_length))
+    github_process, github_url = start_server("fake_github.py")
+    os.environ.update({
+        "GITHUB_APP_ID": "1",
+        "GITHUB_PRIVATE_KEY": private_key(),
+        "GITHUB_APP_WEBHOOK_SECRET": "benchmark",
+        "GITHUB_API_URL": github_url,
+    })
+
+    try:
+        import ollama
+
+        import backends
+        from agents import Agent
+        from model_registry import registry
+        from review_github import GitHubReviewer
+        from review_local import analyze_diff
+        from storage import configure_sessions
+
+        backends.configure_backends([ollama_url])
+        configure_sessions(os.path.join(tempfile.mkdtemp(prefix="pearbot-benchmark-"), "sessions.sqlite3"))
+        registry.client = ollama.Client(host=ollama_url)
+
+        initial_review_models = args.initial_review_models.split(",")
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            code_review_agent = Agent(role="code_reviewer", use_post_request=True, prompt_style=args.prompt_style)
+            feedback_improver_agent = Agent(role="feedback_improver", use_post_request=True, prompt_style=args.prompt_style)
+        github_reviewer = GitHubReviewer(code_review_agent, feedback_improver_agent, initial_review_models, args.model, False, args.parallel_reviews, incremental=False)
+
+        results = []
+        modes = args.modes.split(",")
+        for size in [int(size) for size in args.sizes.split(",")]:
+            if "local" in modes:
+                diff = make_diff(size)
+                results.append(measure("local", size, lambda: analyze_diff(diff, code_review_agent, feedback_improver_agent, initial_review_models, args.model, False, args.parallel_reviews), ollama_url))
+            if "github" in modes:
+                results.append(measure("github", size, lambda: github_reviewer.perform_review(size, "benchmark/repo", 1), ollama_url))
+    finally:
+        ollama_process.kill()
+        github_process.kill()
+
+    output = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2))
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
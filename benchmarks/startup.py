@@ -0,0 +1,112 @@
+"""Measures the startup time of pearbot and the import cost of its modules.
+
+Every scenario is started `--runs` times in a fresh interpreter with `-X importtime`,
+reporting the median wall time and the slowest top-level imports. Results are
+written as JSON, and can be compared with an earlier run:
+
+    python benchmarks/startup.py --output startup.json
+    python benchmarks/startup.py --output startup-new.json --compare startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+SRC = ROOT / "src"
+
+SCENARIOS = {
+    # What every local invocation (git hooks, CI) pays before doing any work
+    "help": [str(SRC / "pearbot.py"), "--help"],
+    "import_local": ["-c", f"import sys; sys.path.insert(0, {str(SRC)!r}); import pearbot, agents; agents.Agent()"],
+    "import_server": ["-c", f"import sys; sys.path.insert(0, {str(SRC)!r}); import review_github"],
+}
+
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+def run_scenario(args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", *args], capture_output=True, text=True, cwd=ROOT, stdin=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    total = 0
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1e6
+        # The cumulative time of the top-level imports includes the nested ones
+        if len(match.group(3)) == 1:
+            total += cumulative
+        # Packages and modules (not submodules) at any depth, to find the expensive ones
+        if "." not in match.group(4):
+            imports[match.group(4)] = max(imports.get(match.group(4), 0), cumulative)
+    return wall, total, imports
+
+def measure(name, args, runs, top):
+    walls = []
+    totals = []
+    imports = {}
+    for _ in range(runs):
+        wall, total, run_imports = run_scenario(args)
+        walls.append(wall)
+        totals.append(total)
+        for module, seconds in run_imports.items():
+            imports.setdefault(module, []).append(seconds)
+    slowest = sorted(((module, statistics.median(times)) for module, times in imports.items()), key=lambda item: -item[1])[:top]
+    result = {
+        "scenario": name,
+        "wall_seconds": round(statistics.median(walls), 4),
+        "import_seconds": round(statistics.median(totals), 4),
+        "slowest_imports": {module: round(seconds, 4) for module, seconds in slowest},
+    }
+    print(f"{name:>14}: {result['wall_seconds']:.3f}s wall, {result['import_seconds']:.3f}s importing")
+    for module, seconds in slowest:
+        print(f"{'':>16}{module:<28}{seconds * 1000:8.1f} ms")
+    return result
+
+def compare(results, previous_path):
+    previous = {r["scenario"]: r for r in json.loads(Path(previous_path).read_text())["results"]}
+    print(f"\nCompared with {previous_path}:")
+    for result in results:
+        old = previous.get(result["scenario"])
+        if old is None:
+            continue
+        changes = [f"{key} {(result[key] - old[key]) / old[key] * 100:+.1f}%" for key in ("wall_seconds", "import_seconds") if old[key]]
+        print(f"{result['scenario']:>14}: {', '.join(changes)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Pearbot startup benchmark")
+    parser.add_argument("--scenarios", type=str, default=",".join(SCENARIOS), help=f"Comma-separated list of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per scenario (default: 5)")
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest imports to report (default: 5)")
+    parser.add_argument("--output", type=str, default="startup_results.json", help="File to write the results to")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier results to compare with")
+    args = parser.parse_args()
+
+    results = [measure(name, SCENARIOS[name], args.runs, args.top) for name in args.scenarios.split(",")]
+
+    output = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(output, indent=2))
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
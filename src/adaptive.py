@@ -0,0 +1,44 @@
+import math
+import re
+from collections import Counter
+
+WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+STOPWORDS = {
+    "the", "and", "for", "that", "this", "with", "are", "was", "not", "but", "you", "can", "should", "could",
+    "would", "will", "its", "has", "have", "from", "into", "there", "their", "which", "when", "also", "than",
+    "then", "use", "using", "consider", "line", "lines", "code", "change", "changes", "file",
+}
+
+def term_counts(text):
+    return Counter(word for word in (w.lower() for w in WORD.findall(text)) if word not in STOPWORDS)
+
+def similarity(a, b):
+    # Cosine similarity of the word counts of two reviews
+    counts_a, counts_b = term_counts(a), term_counts(b)
+    dot = sum(count * counts_b[word] for word, count in counts_a.items())
+    norm = math.sqrt(sum(c * c for c in counts_a.values())) * math.sqrt(sum(c * c for c in counts_b.values()))
+    return dot / norm if norm else 0.0
+
+def agreement(reviews):
+    # How much the latest review repeats an earlier one: a review that mostly confirms the
+    # findings of another reviewer suggests that further reviewers would add little
+    if len(reviews) < 2:
+        return 0.0
+    return max(similarity(reviews[-1], earlier) for earlier in reviews[:-1])
+
+class AdaptiveEnsemble:
+    """Policy of the adaptive ensemble.
+
+    Every part of the changes is reviewed by the first `min_reviews` models; further models are
+    only asked while the latest review agrees less than `threshold` with an earlier one.
+    Changes smaller than `small_diff_tokens` are reviewed by a single model, and a single
+    review is returned without running the feedback improver.
+    """
+
+    def __init__(self, threshold=0.6, min_reviews=2, small_diff_tokens=200):
+        self.threshold = threshold
+        self.min_reviews = max(min_reviews, 2)
+        self.small_diff_tokens = small_diff_tokens
+
+    def agree(self, reviews):
+        return len(reviews) >= self.min_reviews and agreement(reviews) >= self.threshold
@@ -1,32 +1,73 @@
-import ollama
-import yaml
+import sys
+from contextlib import nullcontext
 
+import backends
+import planning
+from metrics import CACHE_REQUESTS, observe_generation, span
 from model import post_request_generate
+from prompt_templates import load_prompts
+
+# Name of the pipeline stage of each role in the metrics
+STAGES = {"code_reviewer": "initial_review", "feedback_improver": "improver"}
 
 class Agent:
-    def __init__(self, role="code_reviewer", use_post_request=False, prompt_style="default"):
+    def __init__(self, role="code_reviewer", use_post_request=False, prompt_style="default", cache=None):
         self.role = role
         self.use_post_request = use_post_request
         self.prompt_style = prompt_style
-        self.prompts = self._load_prompts()
+        self.cache = cache
+        self.stage = STAGES.get(role, role)
+        self.prompts = load_prompts()
         print(f"Initialized agent with role: {role}, use_post_request: {use_post_request}, prompt_style: {prompt_style}")
 
-    def _load_prompts(self):
-        with open('src/prompts.yaml', 'r') as file:
-            return yaml.safe_load(file)['prompts']
-
-    def analyze(self, data, model: str):
-        prompt = self._prepare_prompt(data)
+    def analyze(self, data, model: str, out=None, run=None, slot=0):
+        # `slot` tells apart the reviews of a model that is used several times in the ensemble, so
+        # that they are cached separately instead of all getting the response of the first one
+        if out is None and run is not None:
+            out = run.out
+        with span("render", role=self.role):
+            prompt = self._prepare_prompt(data)
 
         # print(f"Prompt:\n{prompt}\nENDOFPROMPT")
 
-        if self.use_post_request:
-            response = post_request_generate(model, prompt)
-        else:
-            response = ollama.generate(model=model, prompt=prompt)['response']
+        if self.cache is not None:
+            cache_key = self.cache.key(model, self.prompt_style, prompt, planning.planner.options(model, prompt, self.stage), slot)
+            response = self.cache.get(cache_key)
+            CACHE_REQUESTS.inc(result="hit" if response is not None else "miss")
+            if response is not None:
+                print(f"{response}\n\n(cached response of {model})\n", file=out or sys.stdout)
+                if run is not None:
+                    run.record_cached(model)
+                return prompt, response
+
+        scheduler = run.scheduler if run is not None else None
+        with (scheduler.slot(model) if scheduler is not None else nullcontext()), span(self.stage, model=model):
+            if run is not None:
+                run.check_cancelled()
+            plan = planning.planner.plan(model, prompt, self.stage)
+            if not plan.fits:
+                print(f"Warning: the prompt for {model} (~{plan.estimated_tokens} tokens) does not fit in its context of {plan.context_length} tokens and will be cut short", file=out or sys.stdout)
+            if self.use_post_request:
+                response, metrics = post_request_generate(model, prompt, out=out, run=run, stage=self.stage, plan=plan)
+            else:
+                response, metrics = backends.pool.generate(plan.apply({"model": model, "prompt": prompt}), tracker=run.tracking if run is not None else None)
+                observe_generation(model, self.stage, metrics)
+                planning.planner.record(plan, metrics)
+                if run is not None:
+                    run.record_generation(model, prompt, metrics, plan.estimated_tokens)
+
+        # A response that was cut short by the output limit is not replayed
+        if metrics.get("done_reason") == "length":
+            print(f"Warning: the response of {model} reached the output limit of {plan.num_predict} tokens", file=out or sys.stdout)
+        elif self.cache is not None:
+            self.cache.put(cache_key, model, response)
 
         return prompt, response
 
+    def fits(self, data, model):
+        # Whether the prompt for `data` leaves room for the output in the context of the model
+        return planning.planner.fits(model, self._prepare_prompt(data))
+
     def _prepare_prompt(self, data):
         if self.role == "code_reviewer":
             return self._prepare_code_review_prompt(data)
@@ -37,9 +78,18 @@ class Agent:
         else:
             raise ValueError(f"Unknown role: {self.role}")
 
+    def _render(self, stage, **fields):
+        # Styles with a `prefix` put it in front of both stages, so that the prompts
+        # of all stages start with the same text
+        templates = self.prompts['instructions'][self.prompt_style]
+        prompt = templates[stage].format(**fields)
+        if 'prefix' in templates:
+            prompt = templates['prefix'].format(**fields) + prompt
+        return prompt
+
     def _prepare_code_review_prompt(self, pr_data):
         context = f"Additional Context:\n{pr_data['context']}" if pr_data.get('context') else ""
-        return self.prompts['instructions'][self.prompt_style]['review'].format(
+        return self._render('review',
             title=pr_data['title'],
             description=pr_data['description'],
             changes=pr_data['changes'],
@@ -57,7 +107,7 @@ Review #{i}:
 {review}
 ---
 """
-        return self.prompts['instructions'][self.prompt_style]['feedback'].format(
+        return self._render('feedback',
             title=review_data['pr_data']['title'],
             description=review_data['pr_data']['description'],
             changes=review_data['pr_data']['changes'],
@@ -0,0 +1,291 @@
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from contextlib import nullcontext
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_OLLAMA_HOST = "http://localhost:11434"
+
+class BackendError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+class Backend:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.in_flight = 0
+        self.healthy = True
+        self.loaded_models = set()
+        self.available_models = None
+        self.requests = 0
+        self.failures = 0
+
+    def serves(self, model):
+        if self.available_models is None:
+            return True
+        return model in self.available_models or f"{model}:latest" in self.available_models
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "loaded_models": sorted(self.loaded_models),
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+class GenerationStream:
+    # Iterates over the NDJSON lines of a streamed generation; closing it aborts the generation
+    def __init__(self, pool, backend, response, lines):
+        self.pool = pool
+        self.backend = backend
+        self.response = response
+        self.lines = lines
+        self._closed = False
+        # A stream may be closed from another thread (a cancelled review) while it is read
+        self._close_lock = threading.Lock()
+
+    def __iter__(self):
+        return self.lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        # Closing the response does not interrupt a read that blocks in another thread, shutting
+        # down its socket does (the connection is only still attached if the stream was not read to the end)
+        sock = getattr(getattr(self.response.raw, "connection", None), "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.response.close()
+        self.pool._release(self.backend)
+
+class BackendPool:
+    """Distributes generations over several Ollama servers.
+
+    Each request goes to the healthy backend with the fewest requests in flight,
+    preferring backends that already have the model loaded. Failed requests are
+    retried on another backend; with `hedge_after`, a second backend is asked as
+    well when the first one has not started to respond after that many seconds.
+    A backend that fails is unhealthy until a request or health check succeeds.
+    All requests share one pooled keep-alive session.
+    """
+
+    def __init__(self, urls, health_interval=30, timeout=300, retries=2, hedge_after=None, pool_size=16):
+        self.backends = [Backend(url) for url in urls]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.backends), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge_after = hedge_after
+        self.hedged = 0
+        self._lock = threading.Lock()
+        self._health_thread = None
+
+    @property
+    def primary_url(self):
+        return self.backends[0].url
+
+    def start_health_checks(self):
+        if self._health_thread is None and len(self.backends) > 1:
+            self.check_health()
+            self._health_thread = threading.Thread(target=self._health_loop, name="ollama-health", daemon=True)
+            self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+    def check_health(self):
+        for backend in self.backends:
+            try:
+                loaded = self.session.get(f"{backend.url}/api/ps", timeout=5).json().get("models", [])
+                available = self.session.get(f"{backend.url}/api/tags", timeout=5).json().get("models", [])
+                self._succeeded(backend)
+                with self._lock:
+                    backend.loaded_models = {model["name"] for model in loaded}
+                    backend.available_models = {model["name"] for model in available}
+            except (requests.RequestException, ValueError) as e:
+                with self._lock:
+                    if backend.healthy:
+                        print(f"Ollama backend {backend.url} is unhealthy: {e}")
+                    backend.healthy = False
+
+    def choose(self, model, exclude=()):
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and b.serves(model)]
+            if not candidates:
+                return None
+            loaded = lambda b: model in b.loaded_models or f"{model}:latest" in b.loaded_models
+            backend = min(candidates, key=lambda b: (not b.healthy, b.in_flight, not loaded(b)))
+            backend.in_flight += 1
+            backend.requests += 1
+            return backend
+
+    def _release(self, backend, failed=False):
+        with self._lock:
+            backend.in_flight -= 1
+            if failed:
+                backend.failures += 1
+                backend.healthy = False
+
+    def _succeeded(self, backend):
+        with self._lock:
+            if not backend.healthy:
+                print(f"Ollama backend {backend.url} is healthy again")
+            backend.healthy = True
+
+    def _attempt(self, backend, payload, results, race):
+        # Opens the stream and reads its first line, so that a backend only counts as
+        # responding once the generation actually started
+        try:
+            response = self.session.post(f"{backend.url}/api/generate", json=payload, stream=True, timeout=(5, self.timeout))
+            if response.status_code >= 400:
+                response.close()
+                raise BackendError(f"HTTP {response.status_code}: {response.reason}", retryable=response.status_code >= 500)
+            lines = (line for line in response.iter_lines() if line)
+            first_line = next(lines)
+        except (requests.RequestException, StopIteration, BackendError) as e:
+            error = e if isinstance(e, BackendError) else BackendError(str(e) or "empty response")
+            self._release(backend, failed=error.retryable)
+            results.put((backend, None, error))
+            return
+        self._succeeded(backend)
+        with race["lock"]:
+            if race["won"]:
+                response.close()
+                self._release(backend)
+                return
+            race["won"] = True
+        with self._lock:
+            backend.loaded_models.add(payload["model"])
+        results.put((backend, GenerationStream(self, backend, response, itertools.chain([first_line], lines)), None))
+
+    def stream_generate(self, payload):
+        tried = []
+        results = queue.Queue()
+        race = {"lock": threading.Lock(), "won": False}
+        errors = []
+
+        def launch(retry=False):
+            backend = self.choose(payload["model"], exclude=tried)
+            if backend is None and retry:
+                # Every backend has been tried already, try again on the best one
+                backend = self.choose(payload["model"])
+            if backend is None:
+                return False
+            tried.append(backend)
+            threading.Thread(target=self._attempt, args=(backend, payload, results, race), daemon=True).start()
+            return True
+
+        if not launch():
+            raise BackendError(f"No Ollama backend serves model {payload['model']}")
+        pending = 1
+        attempts = 1
+        while pending:
+            wait = self.hedge_after if self.hedge_after and attempts == 1 and len(tried) < len(self.backends) else None
+            try:
+                backend, stream, error = results.get(timeout=wait)
+            except queue.Empty:
+                if launch():
+                    print(f"Hedging generation of {payload['model']}: {tried[0].url} is slow, also asking {tried[-1].url}")
+                    self.hedged += 1
+                    pending += 1
+                    attempts += 1
+                continue
+            pending -= 1
+            if stream is not None:
+                return stream
+            errors.append(f"{backend.url}: {error}")
+            print(f"Ollama backend {backend.url} failed: {error}")
+            if not error.retryable:
+                raise error
+            if attempts <= self.retries and launch(retry=True):
+                pending += 1
+                attempts += 1
+        raise BackendError(f"Generation with {payload['model']} failed on all tried backends ({'; '.join(errors)})")
+
+    def generate(self, payload, tracker=None):
+        # Returns the generated text and the final message with the metrics of the generation.
+        # `tracker` is a context manager that watches the open stream (see ReviewRun.tracking).
+        response = []
+        metrics = {}
+        with self.stream_generate(dict(payload, stream=True)) as stream, (tracker(stream) if tracker is not None else nullcontext()):
+            for line in stream:
+                message = json.loads(line)
+                if message.get("done"):
+                    metrics = message
+                else:
+                    response.append(message.get("response", ""))
+        return "".join(response), metrics
+
+    def load(self, model, keep_alive=None):
+        # Loads a model without generating anything, on the backend that would serve it next
+        backend = self.choose(model)
+        if backend is None:
+            return
+        try:
+            payload = {"model": model, "prompt": ""}
+            if keep_alive is not None:
+                payload["keep_alive"] = keep_alive
+            self.session.post(f"{backend.url}/api/generate", json=payload, timeout=self.timeout).raise_for_status()
+            self._succeeded(backend)
+            with self._lock:
+                backend.loaded_models.add(model)
+        finally:
+            self._release(backend)
+
+    def embed(self, model, inputs):
+        # Embeddings of several texts with a single request
+        backend = self.choose(model)
+        if backend is None:
+            raise BackendError(f"No Ollama backend serves model {model}")
+        try:
+            response = self.session.post(f"{backend.url}/api/embed", json={"model": model, "input": inputs}, timeout=self.timeout)
+            if response.status_code >= 400:
+                raise BackendError(f"HTTP {response.status_code}: {response.text}", retryable=response.status_code >= 500)
+            embeddings = response.json()["embeddings"]
+            self._succeeded(backend)
+            return embeddings
+        except (requests.RequestException, ValueError, KeyError) as e:
+            raise BackendError(str(e))
+        finally:
+            self._release(backend)
+
+    def status(self):
+        with self._lock:
+            return {"backends": [backend.to_dict() for backend in self.backends], "hedged": self.hedged}
+
+def normalize_url(host):
+    host = host.strip()
+    return host if "://" in host else f"http://{host}"
+
+pool = BackendPool([normalize_url(os.getenv("OLLAMA_HOST") or DEFAULT_OLLAMA_HOST)])
+
+def configure_backends(urls, timeout=300, retries=2, hedge_after=None, health_interval=30):
+    global pool
+    pool = BackendPool([normalize_url(url) for url in urls], health_interval, timeout, retries, hedge_after)
+    pool.start_health_checks()
+    return pool
@@ -0,0 +1,205 @@
+import io
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from diffs import FileDiff, flatten_commits, parse_patch_series
+from ensemble import run_ensemble
+from metrics import span
+from ollama_utils import validate_models
+from review_local import announce, commit_review_data
+from review_run import ReviewRun
+from utils import remove_reasoning
+
+PULL_REQUEST_SPEC = re.compile(r'^([\w.-]+/[\w.-]+)#(\d+)$')
+PATCH_EXTENSIONS = (".patch", ".diff")
+
+class BatchUnit:
+    def __init__(self, name, pr_data, files, separator=""):
+        self.name = name
+        self.pr_data = pr_data
+        self.files = files
+        self.separator = separator
+
+class ModelScheduler:
+    """Runs the generations of many reviews in model-contiguous waves.
+
+    At most `parallel` generations run at once, using at most `max_models` different models.
+    A model stays active while generations for it are pending or running; when a slot for a
+    new model becomes free, the model with the most pending generations is activated next.
+    """
+
+    def __init__(self, parallel=1, max_models=1):
+        self.parallel = max(parallel, 1)
+        self.max_models = max(max_models, 1)
+        self.pending = Counter()
+        self.in_flight = Counter()
+        self.active = []
+        # The models used last, which are presumably still loaded
+        self.recent = []
+        self.loads = 0
+        self._cond = threading.Condition()
+
+    def _next_model(self):
+        waiting = [(count, model) for model, count in self.pending.items() if count and model not in self.active]
+        return max(waiting, key=lambda item: item[0])[1] if waiting else None
+
+    def _can_start(self, model):
+        if sum(self.in_flight.values()) >= self.parallel:
+            return False
+        if model in self.active:
+            return True
+        if len(self.active) < self.max_models and model == self._next_model():
+            self.active.append(model)
+            if model in self.recent:
+                self.recent.remove(model)
+            else:
+                self.loads += 1
+            self.recent = (self.recent + [model])[-self.max_models:]
+            return True
+        return False
+
+    @contextmanager
+    def slot(self, model):
+        with self._cond:
+            self.pending[model] += 1
+            while not self._can_start(model):
+                self._cond.wait()
+            self.pending[model] -= 1
+            self.in_flight[model] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight[model] -= 1
+                if not self.in_flight[model] and not self.pending[model]:
+                    self.active.remove(model)
+                self._cond.notify_all()
+
+def sequential_model_loads(runs):
+    # Model loads when the reviews run one after another: every change of the model is a load
+    loads = 0
+    previous = None
+    for run in runs:
+        for generation in run.generations:
+            if generation["model"] != previous:
+                loads += 1
+                previous = generation["model"]
+    return loads
+
+def units_from_patch_file(path):
+    with open(path, "r") as file:
+        commits = list(parse_patch_series(file))
+    preamble, files = flatten_commits(commits)
+    if preamble.strip():
+        files.insert(0, FileDiff("(commit messages)", preamble))
+    subjects = [commit.subject for commit in commits if commit.sha]
+    pr_data = {
+        "title": subjects[0] if len(subjects) == 1 else os.path.basename(path),
+        "description": "    commits:\n\n" + "\n    ".join(subjects) if subjects else "No commit information found.",
+        "changes": "".join(file_diff.render() for file_diff in files),
+        "context": ""
+    }
+    return [BatchUnit(path, pr_data, files)]
+
+def units_from_range(revision_range):
+    process = subprocess.Popen(["git", "format-patch", "--stdout", revision_range], stdout=subprocess.PIPE, text=True)
+    units = [BatchUnit(commit.label, commit_review_data(commit, commit.files), commit.files) for commit in parse_patch_series(process.stdout)]
+    if process.wait() != 0:
+        raise ValueError(f"Could not read the commits of {revision_range}")
+    return units
+
+def units_from_pull(github, repo_full_name, pr_number):
+    from review_github import FILE_SEPARATOR, GitHubReviewer
+
+    installation_id = github.repo_installation(repo_full_name)
+    pull_request = github.get_pull(repo_full_name, pr_number, installation_id)
+    files = GitHubReviewer.file_diffs(github.get_pull_files(repo_full_name, pr_number, installation_id))
+    pr_data = {
+        "title": pull_request["title"],
+        "description": pull_request["body"],
+        "changes": FILE_SEPARATOR.join(file_diff.render() for file_diff in files),
+        "context": ""
+    }
+    return [BatchUnit(f"{repo_full_name}#{pr_number}", pr_data, files, FILE_SEPARATOR)]
+
+def collect_units(specs):
+    # A spec is a directory of patch files, a patch file, a Pull Request (owner/repo#123)
+    # or a range of commits of the current git repository (one unit per commit).
+    units = []
+    github = None
+    for spec in specs:
+        match = PULL_REQUEST_SPEC.match(spec)
+        if os.path.isdir(spec):
+            for name in sorted(os.listdir(spec)):
+                if name.endswith(PATCH_EXTENSIONS):
+                    units.extend(units_from_patch_file(os.path.join(spec, name)))
+        elif os.path.isfile(spec):
+            units.extend(units_from_patch_file(spec))
+        elif match:
+            if github is None:
+                from github_client import GitHubClient
+
+                github = GitHubClient(os.getenv("GITHUB_APP_ID"), (os.getenv("GITHUB_PRIVATE_KEY") or "").replace('\\n', '\n'))
+            units.extend(units_from_pull(github, match.group(1), int(match.group(2))))
+        else:
+            units.extend(units_from_range(spec))
+    return units
+
+def review_unit(unit, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning, scheduler, chunk_tokens=None, compactor=None, adaptive=None, out=None, reuse=None):
+    files = unit.files
+    pr_data = unit.pr_data
+    if compactor is not None:
+        files, report = compactor.compact(files, unit.separator)
+        pr_data = dict(pr_data, changes=unit.separator.join(file_diff.render() for file_diff in files))
+
+    run = ReviewRun(out, scheduler)
+    with span("review", source="batch", unit=unit.name):
+        # All initial reviews of a unit are requested at once, so the scheduler sees them together
+        _, improved_feedback = run_ensemble(pr_data, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, len(initial_review_models), partial(announce, out=out), files, unit.separator, chunk_tokens, run=run, adaptive=adaptive, reuse=reuse)
+    run.print_summary()
+
+    if skip_reasoning:
+        improved_feedback = remove_reasoning(improved_feedback)
+    return run, improved_feedback
+
+def run_batch(units, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool, parallel=1, max_models=1, max_units=8, chunk_tokens=None, compactor=None, adaptive=None, reuse=None):
+    # Reviews up to `max_units` units at once. Their generations are ordered by the ModelScheduler,
+    # so each model is loaded once per wave instead of once per unit. The models are not warmed
+    # up in advance, as that would load them out of order.
+    if not validate_models(initial_review_models + ([final_review_model] if final_review_model != "" else [])):
+        sys.exit(1)
+
+    scheduler = ModelScheduler(parallel, max_models)
+    runs = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(max_units, 1)) as executor:
+        reviews = []
+        for unit in units:
+            buffer = io.StringIO()
+            future = executor.submit(review_unit, unit, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning, scheduler, chunk_tokens, compactor, adaptive, buffer, reuse)
+            reviews.append((unit, future, buffer))
+        for unit, future, buffer in reviews:
+            run, improved_feedback = future.result()
+            runs.append(run)
+            announce(f"\n\n >>> Review of {unit.name}:")
+            print(buffer.getvalue(), end='')
+            print(f"\n\nImproved feedback for {unit.name}:\n{improved_feedback}\n\n")
+    elapsed = time.perf_counter() - start
+
+    generations = sum(len(run.generations) for run in runs)
+    generated = sum(g["eval_count"] for run in runs for g in run.generations)
+    sequential_loads = sequential_model_loads(runs)
+    print(f"Batch: {len(units)} unit(s) in {elapsed:.1f} seconds ({len(units) / elapsed * 60 if elapsed else 0:.1f} units/minute), "
+          f"{generations} generation(s), {generated} tokens generated ({generated / elapsed if elapsed else 0:.1f} tokens/second)")
+    print(f"Model loads: {scheduler.loads} (~{sequential_loads} when reviewed one after another, ~{max(sequential_loads - scheduler.loads, 0)} avoided)")
+    if reuse is not None:
+        reuse.print_stats()
+    return runs
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ollama_utils import get_model_digest
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pearbot", "reviews.sqlite3")
+
+class ReviewCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=200 * 1024 * 1024, max_age_days=30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS reviews (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS reviews_accessed_at ON reviews (accessed_at)")
+        self._db.commit()
+
+    def key(self, model, prompt_style, prompt, options=None, slot=0):
+        # The digest changes when a model is pulled again, which invalidates its cached reviews.
+        # `options` of the generation (e.g. num_ctx, num_predict) are part of the key as well, and
+        # the `slot` of a model that is used several times in the ensemble.
+        h = hashlib.sha256()
+        for part in (model, get_model_digest(model) or "", prompt_style, prompt, json.dumps(options or {}, sort_keys=True), str(slot)):
+            h.update(part.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, created_at FROM reviews WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE reviews SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO reviews VALUES (?, ?, ?, ?, ?, ?)", (key, model, response, len(response.encode()), now, now))
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM reviews WHERE created_at < ?", (now - self.max_age_seconds,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM reviews").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used entries until the cache fits again
+        for key, size in self._db.execute("SELECT key, size FROM reviews ORDER BY accessed_at").fetchall():
+            self._db.execute("DELETE FROM reviews WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def purge(self):
+        with self._lock:
+            self._db.execute("DELETE FROM reviews")
+            self._db.commit()
+            self._db.execute("VACUUM")
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM reviews").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Review cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries ({stats['bytes'] / 1024:.1f} KiB) in {self.path}")
@@ -0,0 +1,108 @@
+from model import get_context_length
+from utils import estimate_tokens
+
+DEFAULT_CONTEXT_LENGTH = 2048
+OUTPUT_RESERVE_TOKENS = 1024
+MIN_CHUNK_TOKENS = 256
+
+class Chunk:
+    def __init__(self):
+        self.paths = []
+        self.parts = []
+        self.tokens = 0
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+def context_token_budget(models):
+    lengths = [get_context_length(model) for model in models]
+    known = [length for length in lengths if isinstance(length, int)]
+    return min(known) if known else DEFAULT_CONTEXT_LENGTH
+
+def chunk_token_budget(code_review_agent, pr_data, models):
+    # Room left for the changes in the review prompt of the smallest context window
+    overhead = estimate_tokens(code_review_agent._prepare_prompt(dict(pr_data, changes="")))
+    return max(context_token_budget(models) - overhead - OUTPUT_RESERVE_TOKENS, MIN_CHUNK_TOKENS)
+
+def split_oversized_hunk(hunk, max_tokens):
+    lines = hunk.splitlines(keepends=True)
+    hunk_header, body = lines[0], lines[1:]
+    parts = []
+    current = [hunk_header]
+    tokens = estimate_tokens(hunk_header)
+    for line in body:
+        line_tokens = estimate_tokens(line)
+        if tokens + line_tokens > max_tokens and len(current) > 1:
+            parts.append("".join(current))
+            current = [hunk_header.rstrip("\n") + " (continued)\n"]
+            tokens = estimate_tokens(current[0])
+        current.append(line)
+        tokens += line_tokens
+    parts.append("".join(current))
+    return parts
+
+def split_lines(text, max_tokens):
+    # For text without hunks, such as the commit messages, that is too large on its own
+    parts = [""]
+    for line in text.splitlines(keepends=True):
+        if parts[-1] and estimate_tokens(parts[-1] + line) > max_tokens:
+            parts.append("")
+        parts[-1] += line
+    return parts
+
+def build_chunks(file_diffs, max_tokens, separator=""):
+    # Greedily packs the files into chunks, splitting them on hunk boundaries (or lines, for
+    # hunks that are too large on their own). A file split over several chunks repeats its
+    # header in each of them. Every line of the input ends up in exactly one chunk.
+    chunks = []
+    current = Chunk()
+
+    for file_diff in file_diffs:
+        header = file_diff.header
+        header_tokens = estimate_tokens(header) + estimate_tokens(separator)
+        pieces = []
+        if not file_diff.hunks and header_tokens > max_tokens:
+            pieces = split_lines(header, max(max_tokens - estimate_tokens(separator), MIN_CHUNK_TOKENS))
+            header, header_tokens = "", estimate_tokens(separator)
+        for hunk in file_diff.hunks or ([] if pieces else [""]):
+            if header_tokens + estimate_tokens(hunk) > max_tokens:
+                pieces.extend(split_oversized_hunk(hunk, max(max_tokens - header_tokens, MIN_CHUNK_TOKENS)))
+            else:
+                pieces.append(hunk)
+
+        opened = False
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece)
+            if opened and current.tokens + piece_tokens <= max_tokens:
+                current.parts.append(piece)
+                current.tokens += piece_tokens
+                continue
+            if opened:
+                current.parts.append(file_diff.footer)
+            if current.parts and current.tokens + header_tokens + piece_tokens > max_tokens:
+                chunks.append(current)
+                current = Chunk()
+            if current.parts:
+                current.parts.append(separator)
+            current.parts.extend([header, piece])
+            current.paths.append(file_diff.path)
+            current.tokens += header_tokens + piece_tokens
+            opened = True
+        current.parts.append(file_diff.footer)
+
+    if current.parts:
+        chunks.append(current)
+    return chunks
+
+def changes_overview(file_diffs, parts, max_tokens):
+    intro = f"The changes are too large to be shown at once and were reviewed in {parts} parts."
+    files = [f"  {file_diff.path}" for file_diff in file_diffs]
+    hunks = []
+    for file_diff in file_diffs:
+        hunks.append(f"  {file_diff.path}")
+        hunks.extend(f"    {hunk.splitlines()[0]}" for hunk in file_diff.hunks if hunk)
+    overview = "\n".join([intro, "Changed files and hunks:"] + hunks)
+    if estimate_tokens(overview) > max_tokens:
+        overview = "\n".join([intro, "Changed files:"] + files)
+    return overview
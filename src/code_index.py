@@ -0,0 +1,378 @@
+import ast
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import Counter
+
+from diffs import HUNK_HEADER
+from metrics import span
+from utils import estimate_tokens
+
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pearbot", "index")
+INDEX_VERSION = 1
+MAX_FILE_BYTES = 1024 * 1024
+# Names defined in more places than this are too ambiguous to look up
+MAX_DEFINITIONS = 3
+MAX_BLOCK_LINES = 300
+
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]{2,}')
+KEYWORDS = {
+    "and", "as", "assert", "async", "await", "break", "case", "catch", "class", "const", "continue", "def", "default",
+    "del", "elif", "else", "enum", "except", "export", "extends", "false", "False", "final", "finally", "for", "from",
+    "func", "function", "global", "if", "impl", "import", "interface", "lambda", "let", "match", "mut", "new", "None",
+    "nonlocal", "not", "null", "or", "package", "pass", "private", "protected", "pub", "public", "raise", "return",
+    "self", "static", "struct", "super", "switch", "this", "throw", "true", "True", "try", "type", "var", "void",
+    "while", "with", "yield", "int", "str", "bool", "float", "dict", "list", "set", "tuple", "len", "print", "range",
+}
+
+# Definitions of languages with braces, by file extension; the block of a definition ends at its closing brace
+C_FUNCTION = r'^\s*(?:[\w<>\[\],*&:]+\s+)+(?!if\b|for\b|while\b|switch\b|return\b)(\w+)\s*\([^;]*$'
+BRACE_DEFINITIONS = {
+    (".js", ".jsx", ".ts", ".tsx", ".mjs"): [
+        ("function", r'^\s*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*(\w+)'),
+        ("class", r'^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+(\w+)'),
+        ("function", r'^\s*(?:export\s+)?(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|\w+\s*=>)'),
+        ("interface", r'^\s*(?:export\s+)?(?:interface|enum)\s+(\w+)'),
+    ],
+    (".go",): [
+        ("function", r'^func\s+(?:\([^)]*\)\s*)?(\w+)'),
+        ("type", r'^type\s+(\w+)'),
+    ],
+    (".rs",): [
+        ("function", r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:async\s+)?(?:unsafe\s+)?fn\s+(\w+)'),
+        ("type", r'^\s*(?:pub(?:\([^)]*\))?\s+)?(?:struct|enum|trait|impl(?:<[^>]*>)?)\s+(\w+)'),
+    ],
+    (".java", ".kt", ".cs", ".scala", ".swift"): [
+        ("class", r'^\s*(?:[\w@]+\s+)*(?:class|interface|enum|record|object|struct)\s+(\w+)'),
+        ("function", r'^\s*(?:[\w@]+\s+)*fun\s+(\w+)'),
+        ("function", C_FUNCTION),
+    ],
+    (".c", ".h", ".cc", ".cpp", ".hpp", ".cxx"): [
+        ("type", r'^\s*(?:typedef\s+)?(?:struct|class|enum|union)\s+(\w+)\s*\{?\s*$'),
+        ("function", C_FUNCTION),
+    ],
+}
+
+class Symbol:
+    def __init__(self, name, kind, start, end):
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end = end
+
+    def contains(self, first, last):
+        return self.start <= first and last <= self.end
+
+    def overlaps(self, first, last):
+        return self.start <= last and first <= self.end
+
+def python_symbols(text):
+    symbols = []
+    for node in ast.walk(ast.parse(text)):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            kind = "function"
+        elif isinstance(node, ast.ClassDef):
+            kind = "class"
+        else:
+            continue
+        # Decorators belong to the definition
+        start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+        symbols.append(Symbol(node.name, kind, start, node.end_lineno))
+    return symbols
+
+def block_end(lines, start):
+    # Line number of the brace that closes the block opened on or after line `start` (strings and comments are not skipped)
+    depth = 0
+    opened = False
+    for number in range(start, min(start + MAX_BLOCK_LINES, len(lines) + 1)):
+        line = lines[number - 1]
+        depth += line.count("{") - line.count("}")
+        opened = opened or "{" in line
+        if opened and depth <= 0:
+            return number
+        if not opened and (line.rstrip().endswith(";") or number - start > 3):
+            # A declaration without a body
+            return start
+    return min(start + MAX_BLOCK_LINES - 1, len(lines))
+
+def brace_symbols(text, patterns):
+    lines = text.splitlines()
+    symbols = []
+    for number, line in enumerate(lines, 1):
+        for kind, pattern in patterns:
+            match = pattern.match(line)
+            if match:
+                symbols.append(Symbol(match.group(1), kind, number, block_end(lines, number)))
+                break
+    return symbols
+
+_COMPILED_DEFINITIONS = {extension: [(kind, re.compile(pattern)) for kind, pattern in patterns]
+                         for extensions, patterns in BRACE_DEFINITIONS.items() for extension in extensions}
+
+def indexed(path):
+    extension = os.path.splitext(path)[1].lower()
+    return extension == ".py" or extension in _COMPILED_DEFINITIONS
+
+def extract_symbols(path, text):
+    # Definitions (functions, classes, types) of a source file; None for files that are not indexed
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".py":
+        try:
+            return python_symbols(text)
+        except (SyntaxError, ValueError):
+            return []
+    patterns = _COMPILED_DEFINITIONS.get(extension)
+    return brace_symbols(text, patterns) if patterns is not None else None
+
+def git(repo_path, *args, input=None):
+    return subprocess.run(["git", "-C", repo_path] + list(args), input=input, capture_output=True, check=True).stdout
+
+class CodeIndex:
+    """Index of the definitions in a git repository.
+
+    Files are identified by their blob SHA, so a refresh only parses the files whose content
+    is not in the index yet. The index is stored in INDEX_DIR, one JSON file per repository.
+    """
+
+    def __init__(self, repo_path=".", index_path=None):
+        self.repo_path = os.path.abspath(repo_path)
+        git_dir = os.path.abspath(os.path.join(self.repo_path, git(self.repo_path, "rev-parse", "--git-dir").decode().strip()))
+        self.index_path = index_path or os.path.join(INDEX_DIR, hashlib.sha1(git_dir.encode()).hexdigest()[:16] + ".json")
+        # Symbols by blob SHA, as lists of [name, kind, start, end]
+        self.blobs = self._load()
+        # Blob SHA by path, of the files of the last refresh
+        self.files = {}
+        self.rev = None
+        self.parsed = 0
+        self._definitions = None
+        self._contents = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return stored.get("blobs", {}) if stored.get("version") == INDEX_VERSION else {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            temporary_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(temporary_path, "w") as file:
+                json.dump({"version": INDEX_VERSION, "blobs": self.blobs}, file)
+            os.replace(temporary_path, self.index_path)
+        except OSError as e:
+            print(f"Could not write the code index to {self.index_path}: {e}")
+
+    def has_commit(self, rev):
+        try:
+            git(self.repo_path, "cat-file", "-e", f"{rev}^{{commit}}")
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def fetch(self, ref, remote="origin"):
+        try:
+            git(self.repo_path, "fetch", "--quiet", remote, ref)
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f"Could not fetch {ref} into {self.repo_path}: {e.stderr.decode(errors='replace').strip()}")
+            return False
+
+    def _tree_blobs(self, rev):
+        # Blob SHA by path of a commit, or of the working tree (rev=None). Git compares the working
+        # tree with its index by the file stats, so only modified files have to be hashed.
+        if rev is not None:
+            entries = git(self.repo_path, "ls-tree", "-r", "-z", rev).split(b"\0")
+            return {path.decode(): info.split()[2].decode() for info, _, path in (entry.partition(b"\t") for entry in entries if entry) if info.split()[1] == b"blob"}
+        entries = git(self.repo_path, "ls-files", "-s", "-z").split(b"\0")
+        blobs = {path.decode(): info.split()[1].decode() for info, _, path in (entry.partition(b"\t") for entry in entries if entry)}
+        modified = [path for path in git(self.repo_path, "diff-files", "--name-only", "-z").decode().split("\0") if path in blobs]
+        for path in [path for path in modified if not os.path.isfile(os.path.join(self.repo_path, path))]:
+            del blobs[path]
+            modified.remove(path)
+        if modified:
+            hashes = git(self.repo_path, "hash-object", "--stdin-paths", input="\n".join(modified).encode()).decode().split()
+            blobs.update(zip(modified, hashes))
+        return blobs
+
+    def _read_blobs(self, shas):
+        # Contents of several blobs with a single `git cat-file --batch`
+        output = git(self.repo_path, "cat-file", "--batch", input="".join(f"{sha}\n" for sha in shas).encode())
+        contents = {}
+        position = 0
+        for sha in shas:
+            header_end = output.index(b"\n", position)
+            header = output[position:header_end].split()
+            if header[-1] == b"missing":
+                position = header_end + 1
+                continue
+            size = int(header[2])
+            contents[sha] = output[header_end + 1:header_end + 1 + size].decode(errors="replace")
+            position = header_end + 1 + size + 1
+        return contents
+
+    def _read(self, paths, rev):
+        if rev is not None:
+            return self._read_blobs([self.files[path] for path in paths])
+        contents = {}
+        for path in paths:
+            full_path = os.path.join(self.repo_path, path)
+            if os.path.getsize(full_path) <= MAX_FILE_BYTES:
+                with open(full_path, "r", errors="replace") as file:
+                    contents[self.files[path]] = file.read()
+        return contents
+
+    def refresh(self, rev=None):
+        # Brings the index up to date with a commit, or with the working tree (rev=None)
+        with self._lock:
+            start = time.perf_counter()
+            self.files = self._tree_blobs(rev)
+            self.rev = rev
+            self._definitions = None
+            self._contents = {}
+            # One path per new blob, for blobs of files in an indexed language
+            new_blobs = {}
+            for path, sha in self.files.items():
+                if sha not in self.blobs and sha not in new_blobs and indexed(path):
+                    new_blobs[sha] = path
+            contents = self._read(list(new_blobs.values()), rev)
+            for sha, path in new_blobs.items():
+                # Files that were not read (too large) are indexed without symbols
+                text = contents.get(sha)
+                self.blobs[sha] = [[s.name, s.kind, s.start, s.end] for s in extract_symbols(path, text)] if text is not None else []
+            self._contents.update(contents)
+            self.parsed = len(new_blobs)
+            if new_blobs:
+                # Blobs that are no longer part of the tree are dropped once they outnumber the current ones
+                current = set(self.files.values())
+                if len(self.blobs) > 2 * len(current):
+                    self.blobs = {sha: symbols for sha, symbols in self.blobs.items() if sha in current}
+                self._save()
+            elapsed = time.perf_counter() - start
+        print(f"Code index: {self.parsed} of {len(self.files)} file(s) parsed in {elapsed * 1000:.0f} ms")
+
+    def symbols(self, path):
+        sha = self.files.get(path)
+        return [Symbol(*symbol) for symbol in self.blobs.get(sha, [])] if sha else []
+
+    def definitions(self, name):
+        # (path, Symbol) of every definition of a name
+        with self._lock:
+            if self._definitions is None:
+                self._definitions = {}
+                for path, sha in self.files.items():
+                    for symbol in self.blobs.get(sha, []):
+                        self._definitions.setdefault(symbol[0], []).append((path, Symbol(*symbol)))
+            return self._definitions.get(name, [])
+
+    def lines(self, path):
+        sha = self.files.get(path)
+        if sha is None:
+            return []
+        with self._lock:
+            if sha not in self._contents:
+                self._contents.update(self._read([path], self.rev))
+            return self._contents.get(sha, "").splitlines()
+
+class Snippet:
+    def __init__(self, path, symbol, reason, score):
+        self.path = path
+        self.symbol = symbol
+        self.reason = reason
+        self.score = score
+
+def changed_ranges(file_diff):
+    # (first, last, changed lines) of every hunk, with line numbers of the new version of the file
+    ranges = []
+    for hunk in file_diff.hunks:
+        match = HUNK_HEADER.match(hunk)
+        if not match:
+            continue
+        first = int(match.group(3))
+        last = first + max(int(match.group(4) or 1), 1) - 1
+        changed = [line[1:] for line in hunk.splitlines()[1:] if line[:1] in ("+", "-")]
+        ranges.append((first, last, changed))
+    return ranges
+
+class ContextBuilder:
+    """Collects the code around a change as additional context for the review.
+
+    For every hunk, the innermost definition enclosing it is included, followed by the definitions
+    of the names used on the changed lines (most used first), as long as they fit in `max_tokens`.
+    Snippets are cut after `max_snippet_lines` lines.
+    """
+
+    def __init__(self, index, max_tokens=1500, max_snippet_lines=40):
+        self.index = index
+        self.max_tokens = max_tokens
+        self.max_snippet_lines = max_snippet_lines
+        # Concurrent reviews may need the index at different commits
+        self._lock = threading.Lock()
+
+    def candidates(self, files):
+        enclosing = []
+        used = Counter()
+        changed = {}
+        for file_diff in files:
+            symbols = self.index.symbols(file_diff.path)
+            for first, last, lines in changed_ranges(file_diff):
+                changed.setdefault(file_diff.path, []).append((first, last))
+                around = [symbol for symbol in symbols if symbol.contains(first, last)]
+                if around:
+                    innermost = min(around, key=lambda symbol: symbol.end - symbol.start)
+                    enclosing.append(Snippet(file_diff.path, innermost, "encloses the change", float("inf")))
+                for line in lines:
+                    used.update(word for word in IDENTIFIER.findall(line) if word not in KEYWORDS)
+
+        used_definitions = []
+        for name, count in used.items():
+            definitions = self.index.definitions(name)
+            if not definitions or len(definitions) > MAX_DEFINITIONS:
+                continue
+            for path, symbol in definitions:
+                # Definitions that are changed are part of the diff already
+                if not any(symbol.overlaps(first, last) for first, last in changed.get(path, [])):
+                    used_definitions.append(Snippet(path, symbol, f"used {count} time(s) in the changes", count))
+        used_definitions.sort(key=lambda snippet: -snippet.score)
+        return enclosing + used_definitions
+
+    def render(self, snippet):
+        lines = self.index.lines(snippet.path)[snippet.symbol.start - 1:snippet.symbol.end]
+        if len(lines) > self.max_snippet_lines:
+            lines = lines[:self.max_snippet_lines] + ["    ..."]
+        return f"{snippet.path}:{snippet.symbol.start}-{snippet.symbol.end} ({snippet.symbol.kind} {snippet.symbol.name}, {snippet.reason}):\n" + "\n".join(lines) + "\n"
+
+    def build(self, files, rev=None, fetch=None):
+        # The context of the changes at commit `rev`, or in the working tree (rev=None). A commit that
+        # is not in the repository is fetched with the ref `fetch` (e.g. pull/N/head) first; without it,
+        # there is no context: the working tree may hold unrelated or outdated code.
+        with self._lock, span("context"):
+            if rev is not None and not self.index.has_commit(rev):
+                if fetch is None or not self.index.fetch(fetch) or not self.index.has_commit(rev):
+                    print(f"Commit {rev[:7]} is not in {self.index.repo_path}, reviewing without context")
+                    return ""
+            self.index.refresh(rev)
+
+            parts = []
+            seen = set()
+            tokens = 0
+            for snippet in self.candidates(files):
+                key = (snippet.path, snippet.symbol.start)
+                if key in seen:
+                    continue
+                seen.add(key)
+                text = self.render(snippet)
+                size = estimate_tokens(text)
+                if tokens + size > self.max_tokens:
+                    continue
+                parts.append(text)
+                tokens += size
+        print(f"Context: {len(parts)} snippet(s), ~{tokens} tokens")
+        return "\n".join(parts)
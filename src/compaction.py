@@ -0,0 +1,214 @@
+import fnmatch
+import posixpath
+import re
+
+from diffs import HUNK_HEADER, FileDiff
+from metrics import COMPACTION_TOKENS_SAVED
+from utils import estimate_tokens
+
+# Lockfiles, build output, vendored trees and generated sources. Patterns ending with "/" match
+# a directory anywhere in the path, or only at the top of the repository when they also start
+# with "/"; the others match the path or the file name.
+GENERATED_GLOBS = [
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "npm-shrinkwrap.json", "poetry.lock", "Pipfile.lock",
+    "uv.lock", "Cargo.lock", "Gemfile.lock", "composer.lock", "go.sum", "flake.lock", "*.min.js", "*.min.css",
+    "*.map", "*.bundle.js", "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.pb.cc", "*.pb.h", "*.generated.*",
+    "*.g.dart", "*.snap", "vendor/", "node_modules/", "third_party/", "/dist/", "/build/", "__snapshots__/",
+]
+# Headers that generators put in a comment at the top of the files they write
+GENERATED_HEADERS = [re.compile(pattern) for pattern in (
+    r"@generated\b",
+    r"^Code generated .* DO NOT EDIT\.$",
+    r"Generated by the protocol buffer compiler\.\s+DO NOT EDIT!",
+    r"<auto-generated\b",
+)]
+COMMENT_PREFIXES = ("#", "//", "/*", "*", "--", ";", "<!--")
+MINIFIED_LINE_LENGTH = 1000
+OMITTED_PATH = "(omitted files)"
+
+def matches_glob(path, pattern):
+    if pattern.endswith("/"):
+        if pattern.startswith("/"):
+            return f"/{path}".startswith(pattern)
+        return f"/{pattern}" in f"/{path}"
+    return fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(posixpath.basename(path), pattern)
+
+def hunk_lines(hunk):
+    # The changed lines of a hunk, without the `+`/`-` markers
+    lines = hunk.splitlines()[1:]
+    removed = [line[1:] for line in lines if line.startswith("-")]
+    added = [line[1:] for line in lines if line.startswith("+")]
+    return removed, added
+
+def is_whitespace_only(hunk):
+    # Only trailing whitespace and line endings; indentation is meaningful in Python, YAML or Makefiles
+    removed, added = hunk_lines(hunk)
+    if not removed and not added:
+        return False
+    return [line.rstrip() for line in removed] == [line.rstrip() for line in added]
+
+def comment_text(line):
+    # The text of a comment line, or None for other lines
+    line = line.strip()
+    for prefix in COMMENT_PREFIXES:
+        if line.startswith(prefix):
+            return line[len(prefix):].strip()
+    return None
+
+def is_generated(file_diff):
+    if any(matches_glob(file_diff.path, pattern) for pattern in GENERATED_GLOBS):
+        return True
+    for hunk in file_diff.hunks[:1]:
+        match = HUNK_HEADER.match(hunk)
+        if match and match.group(3) in ("0", "1"):
+            comments = [comment_text(line[1:]) for line in hunk.splitlines()[1:11] if line.startswith("+")]
+            if any(header.search(comment) for comment in comments if comment is not None for header in GENERATED_HEADERS):
+                return True
+    return any(len(line) > MINIFIED_LINE_LENGTH for hunk in file_diff.hunks for line in hunk_lines(hunk)[1])
+
+def is_rename(file_diff):
+    return "rename from " in file_diff.header or "Status: renamed" in file_diff.header
+
+def is_binary(file_diff):
+    return "Binary files " in file_diff.header or "GIT binary patch" in file_diff.header
+
+def trim_context(hunk, radius):
+    # Splits a hunk into hunks with at most `radius` lines of context around the changed lines
+    lines = hunk.splitlines(keepends=True)
+    match = HUNK_HEADER.match(lines[0]) if lines else None
+    if match is None:
+        return [hunk]
+    heading = lines[0][match.end():]
+    body = lines[1:]
+
+    keep = [False] * len(body)
+    for i, line in enumerate(body):
+        if line[:1] in ("+", "-"):
+            for j in range(max(i - radius, 0), min(i + radius + 1, len(body))):
+                keep[j] = True
+    for i, line in enumerate(body):
+        # "\ No newline at end of file" belongs to the line before it
+        if line.startswith("\\") and i > 0:
+            keep[i] = keep[i - 1]
+    if all(keep) or not any(keep):
+        return [hunk]
+
+    segments = []
+    current = None
+    old_line, new_line = int(match.group(1)), int(match.group(3))
+    for line, kept in zip(body, keep):
+        tag = line[:1]
+        if kept:
+            if current is None:
+                current = {"old": old_line, "new": new_line, "old_count": 0, "new_count": 0, "lines": []}
+                segments.append(current)
+            current["lines"].append(line)
+            if tag != "+" and tag != "\\":
+                current["old_count"] += 1
+            if tag != "-" and tag != "\\":
+                current["new_count"] += 1
+        else:
+            current = None
+        if tag != "+" and tag != "\\":
+            old_line += 1
+        if tag != "-" and tag != "\\":
+            new_line += 1
+
+    hunks = []
+    for segment in segments:
+        # Like git, an empty side starts at the line before the change
+        old_start = segment["old"] - (segment["old_count"] == 0)
+        new_start = segment["new"] - (segment["new_count"] == 0)
+        header = f"@@ -{old_start},{segment['old_count']} +{new_start},{segment['new_count']} @@{heading}"
+        if not header.endswith("\n"):
+            header += "\n"
+        hunks.append(header + "".join(segment["lines"]))
+    return hunks
+
+class CompactionReport:
+    def __init__(self):
+        self.omitted = []
+        self.whitespace_hunks = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    @property
+    def tokens_saved(self):
+        return self.tokens_before - self.tokens_after
+
+    def summary(self):
+        lines = ["Files not shown in the changes:"]
+        lines.extend(f"  {path} ({reason})" for path, reason in self.omitted)
+        if self.whitespace_hunks:
+            lines.append(f"Also not shown: {self.whitespace_hunks} hunk(s) with whitespace-only changes.")
+        return "\n".join(lines) + "\n"
+
+    def print_report(self):
+        percent = self.tokens_saved / self.tokens_before * 100 if self.tokens_before else 0
+        print(f"Diff compaction: {len(self.omitted)} file(s) omitted, {self.whitespace_hunks} whitespace-only hunk(s) dropped, "
+              f"~{self.tokens_saved} of ~{self.tokens_before} tokens per prompt saved ({percent:.1f}%)")
+        for path, reason in self.omitted:
+            print(f"   {path}: {reason}")
+
+class DiffCompactor:
+    """Removes the parts of a diff that are not worth reviewing before they are put into the prompts.
+
+    Files matching `ignore_globs`, generated and vendored files and files without textual changes
+    are omitted, renames without changes and whitespace-only changes are collapsed, context lines
+    are trimmed to `context_lines` around the changes, and files beyond `max_tokens` are omitted.
+    The omitted files are listed in a summary at the end of the changes.
+    """
+
+    def __init__(self, ignore_globs=None, context_lines=3, max_tokens=None, detect_generated=True):
+        self.ignore_globs = ignore_globs or []
+        self.context_lines = context_lines
+        self.max_tokens = max_tokens
+        self.detect_generated = detect_generated
+
+    def omit_reason(self, file_diff):
+        if any(matches_glob(file_diff.path, pattern) for pattern in self.ignore_globs):
+            return "ignored"
+        if self.detect_generated and is_generated(file_diff):
+            return "generated or vendored"
+        if is_binary(file_diff):
+            return "binary"
+        if not file_diff.hunks:
+            return "renamed without changes" if is_rename(file_diff) else "no textual changes"
+        if all(is_whitespace_only(hunk) for hunk in file_diff.hunks):
+            return "whitespace-only changes"
+        return None
+
+    def compact_file(self, file_diff, report):
+        hunks = []
+        for hunk in file_diff.hunks:
+            if is_whitespace_only(hunk):
+                report.whitespace_hunks += 1
+                continue
+            hunks.extend(trim_context(hunk, self.context_lines) if self.context_lines is not None else [hunk])
+        return FileDiff(file_diff.path, file_diff.header, hunks, file_diff.footer)
+
+    def compact(self, files, separator=""):
+        # Returns the compacted files (followed by a summary of the omitted ones) and a CompactionReport
+        report = CompactionReport()
+        report.tokens_before = estimate_tokens(separator.join(file_diff.render() for file_diff in files))
+
+        compacted = []
+        tokens = 0
+        for file_diff in files:
+            reason = self.omit_reason(file_diff)
+            if reason is not None:
+                report.omitted.append((file_diff.path, reason))
+                continue
+            file_diff = self.compact_file(file_diff, report)
+            file_tokens = estimate_tokens(file_diff.render()) + estimate_tokens(separator)
+            if self.max_tokens is not None and tokens + file_tokens > self.max_tokens:
+                report.omitted.append((file_diff.path, "over the token budget"))
+                continue
+            compacted.append(file_diff)
+            tokens += file_tokens
+
+        if report.omitted or report.whitespace_hunks:
+            compacted.append(FileDiff(OMITTED_PATH, report.summary()))
+        report.tokens_after = estimate_tokens(separator.join(file_diff.render() for file_diff in compacted))
+        COMPACTION_TOKENS_SAVED.inc(max(report.tokens_saved, 0))
+        return compacted, report
@@ -0,0 +1,179 @@
+import re
+
+FILE_HEADER = re.compile(r'^diff --git a/(.*) b/(.*)$')
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+COMMIT_HEADER = re.compile(r'^From ([0-9a-f]{40}) ')
+PATCH_PREFIX = re.compile(r'^\[PATCH[^\]]*\]\s*')
+
+class FileDiff:
+    def __init__(self, path, header="", hunks=None, footer=""):
+        self.path = path
+        self.header = header
+        self.hunks = hunks if hunks is not None else []
+        self.footer = footer
+
+    def render(self):
+        return self.header + "".join(self.hunks) + self.footer
+
+def split_hunks(patch):
+    preamble = []
+    hunks = []
+    for line in (patch or "").splitlines(keepends=True):
+        if line.startswith("@@"):
+            hunks.append([line])
+        elif hunks:
+            hunks[-1].append(line)
+        else:
+            preamble.append(line)
+    return "".join(preamble), ["".join(hunk) for hunk in hunks]
+
+class Commit:
+    # One commit of a patch series (`git format-patch`), or the whole input of a plain diff (without `sha`).
+    # The text in front of the first file is kept as `preamble`, so rendering the commit reproduces the input.
+    def __init__(self, sha=None):
+        self.sha = sha
+        self.headers = {}
+        self.preamble_lines = []
+        self.message_lines = []
+        self.files = []
+
+    @property
+    def subject(self):
+        return PATCH_PREFIX.sub("", self.headers.get("Subject", "")).strip()
+
+    @property
+    def message(self):
+        return "".join(self.message_lines).strip()
+
+    @property
+    def preamble(self):
+        return "".join(self.preamble_lines)
+
+    @property
+    def label(self):
+        return f"{self.sha[:7]} {self.subject}" if self.sha else "(uncommitted changes)"
+
+    def render(self):
+        return self.preamble + "".join(file_diff.render() for file_diff in self.files)
+
+class _FileBuilder:
+    def __init__(self, path, line):
+        self.path = path
+        self.header = [line]
+        self.hunks = []
+        self.footer = []
+        # Lines still expected in the current hunk (old side, new side), None once the hunk is complete
+        self.remaining = None
+
+    def start_hunk(self, line):
+        match = HUNK_HEADER.match(line)
+        self.hunks.append([line])
+        self.footer = []
+        if match:
+            self.remaining = [int(match.group(2) or 1), int(match.group(4) or 1)]
+        else:
+            self.remaining = None
+
+    def add_hunk_line(self, line):
+        self.hunks[-1].append(line)
+        tag = line[:1]
+        if tag != "+" and tag != "\\":
+            self.remaining[0] -= 1
+        if tag != "-" and tag != "\\":
+            self.remaining[1] -= 1
+        if self.remaining[0] <= 0 and self.remaining[1] <= 0:
+            self.remaining = None
+
+    def add_line(self, line):
+        if line.startswith("\\") and self.hunks and not self.footer:
+            # "\ No newline at end of file" after the last line of a hunk
+            self.hunks[-1].append(line)
+        elif self.hunks:
+            self.footer.append(line)
+        else:
+            self.header.append(line)
+
+    def build(self):
+        return FileDiff(self.path, "".join(self.header), ["".join(hunk) for hunk in self.hunks], "".join(self.footer))
+
+def parse_patch_series(lines):
+    # Incrementally parses a diff or a `git format-patch` series from an iterable of lines (with
+    # their line endings, e.g. an open file) and yields every Commit as soon as it is complete.
+    # Hunks end after the number of lines given in their header, so text following the last hunk
+    # (like the "-- " signature of format-patch) ends up in the footer of the file.
+    commit = None
+    current_file = None
+    state = "preamble"
+
+    def finish():
+        if current_file is not None:
+            commit.files.append(current_file.build())
+        return commit
+
+    for line in lines:
+        match = COMMIT_HEADER.match(line)
+        if match and (current_file is None or current_file.remaining is None):
+            if commit is not None:
+                yield finish()
+            commit = Commit(match.group(1))
+            commit.preamble_lines.append(line)
+            current_file = None
+            state = "headers"
+            continue
+        if commit is None:
+            commit = Commit()
+
+        if current_file is not None and current_file.remaining is not None:
+            if line.startswith("@@") or FILE_HEADER.match(line):
+                current_file.remaining = None
+            else:
+                current_file.add_hunk_line(line)
+                continue
+
+        match = FILE_HEADER.match(line)
+        if match:
+            if current_file is not None:
+                commit.files.append(current_file.build())
+            current_file = _FileBuilder(match.group(2), line)
+            state = "files"
+        elif current_file is not None:
+            if line.startswith("@@"):
+                current_file.start_hunk(line)
+            else:
+                current_file.add_line(line)
+        else:
+            commit.preamble_lines.append(line)
+            if state == "headers":
+                if not line.strip():
+                    state = "message"
+                elif line[:1] in (" ", "\t") and commit.headers:
+                    # Folded header line (e.g. a long subject)
+                    name = list(commit.headers)[-1]
+                    commit.headers[name] += " " + line.strip()
+                elif ":" in line:
+                    name, value = line.split(":", 1)
+                    commit.headers[name.strip()] = value.strip()
+            elif state == "message":
+                if line.rstrip("\r\n") == "---":
+                    state = "stat"
+                else:
+                    commit.message_lines.append(line)
+
+    if commit is not None:
+        yield finish()
+
+def flatten_commits(commits):
+    # Returns the text in front of the first file (e.g. commit headers) and the changed files of all commits.
+    # Anything between two files stays with the preceding file, so rendering all files reproduces the input.
+    preamble = ""
+    files = []
+    for commit in commits:
+        if files:
+            files[-1].footer += commit.preamble
+        else:
+            preamble += commit.preamble
+        files.extend(commit.files)
+    return preamble, files
+
+def parse_diff(diff_content):
+    return flatten_commits(parse_patch_series(diff_content.splitlines(keepends=True)))
@@ -0,0 +1,206 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from adaptive import agreement
+from chunking import build_chunks, changes_overview, chunk_token_budget, context_token_budget, MIN_CHUNK_TOKENS, OUTPUT_RESERVE_TOKENS
+from metrics import LLM_CALLS_SAVED
+from utils import estimate_tokens
+
+def model_slots(models):
+    # Position of every model among the uses of the same model in the ensemble, which keeps the
+    # cached reviews of a model that is used several times apart (see Agent.analyze)
+    return [models[:i].count(model) for i, model in enumerate(models)]
+
+def run_generations(agent, tasks, parallel_reviews=1, announce=print, run=None):
+    # tasks: list of (description, data, model, slot), results are returned in the same order
+    if parallel_reviews <= 1 or len(tasks) <= 1:
+        responses = []
+        for description, data, model, slot in tasks:
+            announce(f"\n\n >>> Requesting {description} with {model}...")
+            _, response = agent.analyze(data, model, run=run, slot=slot)
+            responses.append(response)
+        return responses
+
+    # Streamed output of concurrent generations is buffered per task and
+    # printed in the order of the tasks, so the log stays readable.
+    workers = min(parallel_reviews, len(tasks))
+    announce(f"\n\n >>> Requesting {len(tasks)} generations ({workers} in parallel)...")
+    buffers = [io.StringIO() for _ in tasks]
+    responses = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(agent.analyze, data, model, out=buffer, run=run, slot=slot) for (_, data, model, slot), buffer in zip(tasks, buffers)]
+        for (description, _, model, _), future, buffer in zip(tasks, futures, buffers):
+            _, response = future.result()
+            announce(f"\n\n >>> {description[0].upper()}{description[1:]} with {model}:")
+            print(buffer.getvalue(), end='', file=run.out if run is not None else None)
+            responses.append(response)
+    return responses
+
+def run_initial_reviews(code_review_agent, pr_data, models, parallel_reviews=1, announce=print, run=None):
+    tasks = [(f"initial review #{i}", pr_data, model, slot) for i, (model, slot) in enumerate(zip(models, model_slots(models)), 1)]
+    return run_generations(code_review_agent, tasks, parallel_reviews, announce, run)
+
+def improve_reviews(feedback_improver_agent, pr_data, reviews, final_review_model, max_tokens=None, parallel_reviews=1, announce=print, run=None):
+    # When the reviews do not fit into a single improver prompt, they are merged
+    # in groups first, until the remaining (merged) reviews fit.
+    while max_tokens is not None and len(reviews) > 1:
+        groups = [[]]
+        for review in reviews:
+            candidate = groups[-1] + [review]
+            if groups[-1] and estimate_tokens(feedback_improver_agent._prepare_prompt({"pr_data": pr_data, "initial_reviews": candidate})) > max_tokens:
+                groups.append([review])
+            else:
+                groups[-1] = candidate
+        if len(groups) == 1:
+            break
+        if len(groups) == len(reviews):
+            announce(f"\n\n >>> Warning: the reviews exceed the context window of {final_review_model} and cannot be merged further.")
+            break
+        tasks = [(f"merge of reviews (group {i}/{len(groups)})", {"pr_data": pr_data, "initial_reviews": group}, final_review_model, 0) for i, group in enumerate(groups, 1)]
+        reviews = run_generations(feedback_improver_agent, tasks, parallel_reviews, announce, run)
+
+    announce(f"\n\n >>> Requesting improved review (with {final_review_model})...\n\n")
+    _, improved_feedback = feedback_improver_agent.analyze({"pr_data": pr_data, "initial_reviews": reviews}, final_review_model, run=run)
+    return improved_feedback
+
+def run_adaptive_reviews(code_review_agent, parts, models, adaptive, parallel_reviews=1, announce=print, run=None):
+    # parts: list of (label, data). Each part is reviewed by the first `adaptive.min_reviews` models,
+    # then by one more model per round until its reviews agree. The parts are reviewed together in
+    # every round, so they still run concurrently with `parallel_reviews`.
+    reviews = [[] for _ in parts]
+    slots = model_slots(models)
+    while True:
+        tasks = []
+        owners = []
+        for i, (label, data) in enumerate(parts):
+            done = len(reviews[i])
+            if done >= len(models) or adaptive.agree(reviews[i]):
+                continue
+            for j in range(done, min(done + (adaptive.min_reviews if done == 0 else 1), len(models))):
+                tasks.append((f"initial review #{j + 1}{label}", data, models[j], slots[j]))
+                owners.append(i)
+        if not tasks:
+            break
+        for i, response in zip(owners, run_generations(code_review_agent, tasks, parallel_reviews, announce, run)):
+            reviews[i].append(response)
+
+    skipped = sum(len(models) - len(part_reviews) for part_reviews in reviews)
+    if skipped:
+        agreements = ", ".join(f"{agreement(part_reviews):.2f}" for part_reviews in reviews)
+        announce(f"\n\n >>> Initial reviews agree (similarity {agreements}), skipped {skipped} initial review(s)")
+        record_calls_saved(run, skipped, "agreement")
+    return reviews
+
+def record_calls_saved(run, count, reason):
+    LLM_CALLS_SAVED.inc(count, reason=reason)
+    if run is not None:
+        run.record_calls_saved(count)
+
+def review_units(pr_data, code_review_agent, initial_review_models, parallel_reviews, announce, files, separator, chunk_tokens, run=None, adaptive=None):
+    # A unit is a set of files together with the initial reviews that cover them.
+    # Changes that exceed the token budget are split into chunks that become units of their own (map step).
+    def fits(changes):
+        return all(code_review_agent.fits(dict(pr_data, changes=changes), model) for model in initial_review_models)
+
+    changes = separator.join(file_diff.render() for file_diff in files)
+    if estimate_tokens(changes) <= chunk_tokens and fits(changes):
+        paths = [file_diff.path for file_diff in files]
+        if adaptive is None:
+            return [{"paths": paths, "reviews": run_initial_reviews(code_review_agent, dict(pr_data, changes=changes), initial_review_models, parallel_reviews, announce, run)}]
+        if estimate_tokens(changes) < adaptive.small_diff_tokens and len(initial_review_models) > 1:
+            announce(f"\n\n >>> Small change, requesting a single initial review")
+            record_calls_saved(run, len(initial_review_models) - 1, "small_diff")
+            return [{"paths": paths, "reviews": run_initial_reviews(code_review_agent, dict(pr_data, changes=changes), initial_review_models[:1], parallel_reviews, announce, run)}]
+        reviews = run_adaptive_reviews(code_review_agent, [("", dict(pr_data, changes=changes))], initial_review_models, adaptive, parallel_reviews, announce, run)
+        return [{"paths": paths, "reviews": reviews[0]}]
+
+    chunks = build_chunks(files, chunk_tokens, separator)
+    # With the estimates of the planner, corrected by the measured prompt sizes, parts may not fit after all
+    while chunk_tokens > MIN_CHUNK_TOKENS and not all(fits(chunk.text) for chunk in chunks):
+        chunk_tokens = max(chunk_tokens // 2, MIN_CHUNK_TOKENS)
+        chunks = build_chunks(files, chunk_tokens, separator)
+    announce(f"\n\n >>> Changes exceed {chunk_tokens} tokens, reviewing them in {len(chunks)} parts...")
+    parts = [(f" of part {i}/{len(chunks)}", dict(pr_data, changes=chunk.text)) for i, chunk in enumerate(chunks, 1)]
+
+    if adaptive is not None:
+        reviews = run_adaptive_reviews(code_review_agent, parts, initial_review_models, adaptive, parallel_reviews, announce, run)
+    else:
+        slots = model_slots(initial_review_models)
+        tasks = [(f"initial review #{j}{label}", data, model, slot) for label, data in parts for j, (model, slot) in enumerate(zip(initial_review_models, slots), 1)]
+        responses = run_generations(code_review_agent, tasks, parallel_reviews, announce, run)
+        n = len(initial_review_models)
+        reviews = [responses[i * n:(i + 1) * n] for i in range(len(chunks))]
+
+    return [{"paths": list(dict.fromkeys(chunk.paths)), "reviews": part_reviews} for chunk, part_reviews in zip(chunks, reviews)]
+
+def unit_label(unit):
+    label = f"Findings for {', '.join(unit['paths'])}"
+    if unit.get("reused_from"):
+        label += f" (from an earlier review of a matching change to {unit['reused_from']})"
+    if unit.get("outdated_paths"):
+        label += f" (from an earlier review, disregard its comments on {', '.join(unit['outdated_paths'])})"
+    return label
+
+def run_ensemble(pr_data, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, parallel_reviews=1, announce=print, files=None, separator="", chunk_tokens=None, previous_units=None, run=None, adaptive=None, reuse=None):
+    # Returns the review units (see review_units) and the final review.
+    # `previous_units` are still valid units of an earlier review; only the files they do not cover
+    # are reviewed again. The feedback improver combines the findings of all units (reduce step).
+    # With an `adaptive` policy (see adaptive.AdaptiveEnsemble), fewer reviews may be requested.
+    # With `reuse` (see hunk_reuse.HunkReuse), hunks that match reviewed ones are not reviewed again.
+    models = initial_review_models + ([final_review_model] if final_review_model != "" else [])
+    previous_units = previous_units or []
+
+    if files is None:
+        if adaptive is None:
+            reviews = run_initial_reviews(code_review_agent, pr_data, initial_review_models, parallel_reviews, announce, run)
+        else:
+            reviews = run_adaptive_reviews(code_review_agent, [("", pr_data)], initial_review_models, adaptive, parallel_reviews, announce, run)[0]
+        units = [{"paths": [], "reviews": reviews}]
+    else:
+        covered = {path for unit in previous_units for path in unit["paths"]}
+        pending = [file_diff for file_diff in files if file_diff.path not in covered]
+        if previous_units:
+            announce(f"\n\n >>> Reusing the earlier review of {len(files) - len(pending)} file(s), reviewing {len(pending)} changed file(s)...")
+        reused = None
+        if reuse is not None and pending:
+            reused = reuse.split(pending)
+            if reused.reused_hunks:
+                announce(f"\n\n >>> Reusing earlier findings for {reused.reused_hunks} hunk(s), reviewing {sum(len(file_diff.hunks) for file_diff in reused.pending)} hunk(s)...")
+                if not reused.pending:
+                    record_calls_saved(run, len(initial_review_models), "reuse")
+            pending = reused.pending
+        units = []
+        if pending:
+            chunk_tokens = chunk_tokens or chunk_token_budget(code_review_agent, pr_data, models)
+            units = review_units(pr_data, code_review_agent, initial_review_models, parallel_reviews, announce, pending, separator, chunk_tokens, run, adaptive)
+        if reused is not None:
+            units = reused.units + units + reuse.remember(reused, units)
+    all_units = previous_units + units
+
+    if not all_units:
+        return all_units, "No changes to review."
+
+    if len(all_units) == 1:
+        initial_reviews = all_units[0]["reviews"]
+    else:
+        initial_reviews = [f"{unit_label(unit)}:\n{review}" for unit in all_units for review in unit["reviews"]]
+
+    if final_review_model == "":
+        announce(f"\n\n >>> No final review model specified. Returning first review.\n\n")
+        if len(all_units) == 1:
+            return all_units, initial_reviews[0]
+        return all_units, "\n\n".join(f"{unit_label(unit)}:\n{unit['reviews'][0]}" for unit in all_units)
+
+    if adaptive is not None and len(all_units) == 1 and len(initial_reviews) == 1:
+        announce(f"\n\n >>> A single review suffices, skipping the improved review")
+        record_calls_saved(run, 1, "single_review")
+        return all_units, initial_reviews[0]
+
+    if len(all_units) == 1:
+        return all_units, improve_reviews(feedback_improver_agent, pr_data, initial_reviews, final_review_model, run=run)
+
+    max_tokens = context_token_budget([final_review_model]) - OUTPUT_RESERVE_TOKENS
+    reduce_data = pr_data
+    if estimate_tokens(feedback_improver_agent._prepare_prompt({"pr_data": pr_data, "initial_reviews": initial_reviews})) > max_tokens:
+        reduce_data = dict(pr_data, changes=changes_overview(files or [], len(all_units), max_tokens // 4))
+    return all_units, improve_reviews(feedback_improver_agent, reduce_data, initial_reviews, final_review_model, max_tokens, parallel_reviews, announce, run)
@@ -0,0 +1,203 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_API_URL = "https://api.github.com"
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+MAX_RATE_LIMIT_WAIT_SECONDS = 60
+DEFAULT_RETRY_AFTER_SECONDS = 60
+
+class GitHubAPIError(Exception):
+    def __init__(self, status, data):
+        super().__init__(f"{status} - {data}")
+        self.status = status
+        self.data = data
+
+def retry_after_seconds(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER_SECONDS
+
+class CachedResponse:
+    # What is kept of a GET response for revalidation with its ETag: the parsed JSON (or the text) and the links
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.links = response.links
+        try:
+            self._json, self.text = response.json(), None
+        except ValueError:
+            self._json, self.text = None, response.text
+
+    def json(self):
+        return copy.deepcopy(self._json)
+
+class GitHubClient:
+    """Access to the GitHub API for a GitHub App.
+
+    Keeps one pooled keep-alive session, caches installation tokens until shortly
+    before they expire, revalidates GET requests with their ETag and waits for the
+    rate limit to reset instead of failing when it is exhausted.
+    """
+
+    def __init__(self, app_id, private_key, base_url=None, pool_size=10, etag_cache_size=256):
+        self.app_id = app_id
+        self.private_key = private_key
+        self.base_url = (base_url or os.getenv("GITHUB_API_URL") or DEFAULT_API_URL).rstrip("/")
+        self.etag_cache_size = etag_cache_size
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/vnd.github.v3+json", "User-Agent": "pearbot"})
+
+        self._tokens = {}
+        self._installations = {}
+        self._etags = OrderedDict()
+        self._rate_limits = {}
+        self._lock = threading.Lock()
+        self.requests_sent = 0
+        self.not_modified = 0
+
+    def create_jwt(self):
+        now = int(time.time())
+        payload = {
+            "iat": now - 60,  # allow for clock drift
+            "exp": now + (10 * 60),  # JWT expires in 10 minutes
+            "iss": self.app_id
+        }
+        # Imported here, PyJWT (with cryptography) is only needed to authenticate as the app
+        import jwt
+
+        return jwt.encode(payload, self.private_key, algorithm="RS256")
+
+    def installation_token(self, installation_id):
+        with self._lock:
+            cached = self._tokens.get(installation_id)
+        if cached is not None and cached[1] - time.time() > TOKEN_REFRESH_MARGIN_SECONDS:
+            return cached[0]
+
+        response = self._send("POST", f"/app/installations/{installation_id}/access_tokens", None, {"Authorization": f"Bearer {self.create_jwt()}"})
+        data = response.json()
+        expires_at = datetime.strptime(data["expires_at"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+        with self._lock:
+            self._tokens[installation_id] = (data["token"], expires_at)
+        return data["token"]
+
+    def repo_installation(self, repo_full_name):
+        # Installation of the app on a repository, for requests that do not come from a webhook
+        with self._lock:
+            installation_id = self._installations.get(repo_full_name)
+        if installation_id is None:
+            response = self._send("GET", f"/repos/{repo_full_name}/installation", None, {"Authorization": f"Bearer {self.create_jwt()}"})
+            installation_id = response.json()["id"]
+            with self._lock:
+                self._installations[repo_full_name] = installation_id
+        return installation_id
+
+    def request(self, method, path, installation_id, accept=None, **kwargs):
+        for attempt in range(2):
+            headers = {"Authorization": f"token {self.installation_token(installation_id)}"}
+            if accept:
+                headers["Accept"] = accept
+            try:
+                return self._send(method, path, installation_id, headers, **kwargs)
+            except GitHubAPIError as e:
+                # A revoked installation token is dropped and requested again, once
+                if e.status != 401 or attempt:
+                    raise
+                with self._lock:
+                    self._tokens.pop(installation_id, None)
+
+    def _send(self, method, path, rate_limit_key, headers, **kwargs):
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        etag_key = (url, headers.get("Accept"), rate_limit_key)
+
+        for attempt in range(2):
+            self._wait_for_rate_limit(rate_limit_key)
+            request_headers = dict(headers)
+            with self._lock:
+                cached = self._etags.get(etag_key) if method == "GET" else None
+            if cached is not None:
+                request_headers["If-None-Match"] = cached[0]
+
+            response = self.session.request(method, url, headers=request_headers, timeout=30, **kwargs)
+            self.requests_sent += 1
+            self._update_rate_limit(rate_limit_key, response)
+
+            if response.status_code == 304 and cached is not None:
+                self.not_modified += 1
+                with self._lock:
+                    self._etags.move_to_end(etag_key)
+                return cached[1]
+            if response.status_code in (403, 429) and attempt == 0 and self._rate_limited(response):
+                continue
+            if response.status_code >= 400:
+                raise GitHubAPIError(response.status_code, response.text)
+
+            if method == "GET" and response.headers.get("ETag"):
+                with self._lock:
+                    self._etags[etag_key] = (response.headers["ETag"], CachedResponse(response))
+                    self._etags.move_to_end(etag_key)
+                    while len(self._etags) > self.etag_cache_size:
+                        self._etags.popitem(last=False)
+            return response
+        raise GitHubAPIError(response.status_code, response.text)
+
+    def _update_rate_limit(self, key, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is not None and reset is not None:
+            with self._lock:
+                self._rate_limits[key] = (int(remaining), int(reset))
+
+    def _rate_limited(self, response):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            wait = min(retry_after_seconds(retry_after), MAX_RATE_LIMIT_WAIT_SECONDS)
+        elif response.headers.get("X-RateLimit-Remaining") == "0":
+            wait = min(max(int(response.headers.get("X-RateLimit-Reset", 0)) - time.time(), 0), MAX_RATE_LIMIT_WAIT_SECONDS)
+        else:
+            return False
+        print(f"GitHub rate limit reached, waiting {wait:.0f} seconds")
+        time.sleep(wait)
+        return True
+
+    def _wait_for_rate_limit(self, key):
+        with self._lock:
+            remaining, reset = self._rate_limits.get(key, (None, 0))
+        if remaining == 0 and reset > time.time():
+            wait = min(reset - time.time(), MAX_RATE_LIMIT_WAIT_SECONDS)
+            print(f"GitHub rate limit exhausted, waiting {wait:.0f} seconds")
+            time.sleep(wait)
+
+    def get_pull(self, repo_full_name, pr_number, installation_id):
+        return self.request("GET", f"/repos/{repo_full_name}/pulls/{pr_number}", installation_id).json()
+
+    def get_pull_files(self, repo_full_name, pr_number, installation_id):
+        files = []
+        url = f"/repos/{repo_full_name}/pulls/{pr_number}/files?per_page=100"
+        while url:
+            response = self.request("GET", url, installation_id)
+            files.extend(response.json())
+            url = response.links.get("next", {}).get("url")
+        return files
+
+    def get_pull_diff(self, repo_full_name, pr_number, installation_id):
+        return self.request("GET", f"/repos/{repo_full_name}/pulls/{pr_number}", installation_id, accept="application/vnd.github.v3.diff").text
+
+    def create_issue_comment(self, repo_full_name, issue_number, body, installation_id):
+        return self.request("POST", f"/repos/{repo_full_name}/issues/{issue_number}/comments", installation_id, json={"body": body}).json()
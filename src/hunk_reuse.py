@@ -0,0 +1,342 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+import time
+from collections import Counter
+
+import backends
+from diffs import FileDiff
+from metrics import HUNKS_REUSED
+from utils import estimate_tokens
+
+try:
+    import numpy
+except ImportError:
+    # Optional (pip install pearbot[reuse]): without NumPy the nearest-neighbor search runs in plain Python
+    numpy = None
+
+DEFAULT_REUSE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pearbot", "hunks")
+DEFAULT_EMBEDDING_MODEL = "nomic-embed-text"
+MAX_HUNKS = 20000
+# Hunks with fewer changed tokens (an import, a closing brace, a version bump) are always reviewed
+MIN_REUSE_TOKENS = 12
+
+def normalize_hunk(hunk):
+    # The lines of a hunk without line numbers and with collapsed whitespace, or None for a hunk
+    # without changes. Copies of a change (cherry-picks, bulk edits) normalize to the same text;
+    # the context lines are kept, so that a change only matches in the same surroundings.
+    lines = [line[0] + " ".join(line[1:].split()) for line in hunk.splitlines()[1:] if line[:1] in ("+", "-", " ")]
+    if not any(line[0] in ("+", "-") for line in lines):
+        return None
+    return "\n".join(lines)
+
+def changed_lines(normalized):
+    return "\n".join(line for line in normalized.splitlines() if line[0] in ("+", "-"))
+
+def changed_tokens(normalized):
+    return estimate_tokens(changed_lines(normalized))
+
+def hunk_hash(normalized):
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+def unit_vector(vector):
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+class HunkStore:
+    """Embeddings of reviewed hunks and the findings of their reviews, on disk.
+
+    Every embedding model has a directory in `path`. The vectors are appended to `vectors.f16`
+    (normalized, float16), the hash, the hash of the changed lines and the entry of each vector to
+    `hunks.jsonl` and the findings to `entries.jsonl`. When more than `max_hunks` hunks are stored, the oldest are dropped and the
+    files are rewritten.
+    """
+
+    def __init__(self, path=DEFAULT_REUSE_PATH, model=DEFAULT_EMBEDDING_MODEL, max_hunks=MAX_HUNKS):
+        self.path = os.path.join(path, model.replace("/", "_").replace(":", "_"))
+        self.model = model
+        self.max_hunks = max_hunks
+        self.dim = None
+        self.hashes = []
+        self.changed = []
+        self.entry_ids = []
+        self.entries = {}
+        self.rows = {}
+        # Rows by the hash of their changed lines
+        self.changed_rows = {}
+        # Matrix of the vectors with NumPy, a list of vectors without it
+        self.vectors = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        try:
+            with open(self._file("meta.json"), "r") as file:
+                self.dim = json.load(file)["dim"]
+            with open(self._file("entries.jsonl"), "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.entries[entry["id"]] = entry
+            with open(self._file("hunks.jsonl"), "r") as file:
+                hunks = [json.loads(line) for line in file]
+            with open(self._file("vectors.f16"), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return self.clear()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read the hunk index in {self.path}, starting a new one: {e}")
+            return self.clear()
+        count = min(len(hunks), len(data) // (2 * self.dim))
+        self.hashes = [hunk["hash"] for hunk in hunks[:count]]
+        # Hunks stored without the hash of their changed lines only match identical hunks
+        self.changed = [hunk.get("changed") for hunk in hunks[:count]]
+        self.entry_ids = [hunk["entry"] for hunk in hunks[:count]]
+        self._index()
+        if numpy is not None:
+            self.vectors = numpy.frombuffer(data, dtype="<f2", count=count * self.dim).reshape(count, self.dim).astype(numpy.float32)
+        else:
+            values = struct.unpack(f"<{count * self.dim}e", data[:count * self.dim * 2])
+            self.vectors = [values[i * self.dim:(i + 1) * self.dim] for i in range(count)]
+        if count > self.max_hunks:
+            self._compact()
+
+    def clear(self):
+        self.dim = None
+        self.hashes, self.changed, self.entry_ids, self.entries, self.rows, self.changed_rows = [], [], [], {}, {}, {}
+        self.vectors = None
+        for name in ("meta.json", "entries.jsonl", "hunks.jsonl", "vectors.f16"):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+    def _index(self):
+        self.rows = {hunk_hash: row for row, hunk_hash in enumerate(self.hashes)}
+        self.changed_rows = {}
+        for row, changed in enumerate(self.changed):
+            if changed is not None:
+                self.changed_rows.setdefault(changed, []).append(row)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def exact(self, normalized_hash):
+        row = self.rows.get(normalized_hash)
+        return self.entry_ids[row] if row is not None else None
+
+    def nearest(self, queries):
+        # (similarity, entry id) of the closest stored hunk for each of the queries, (hash of the changed
+        # lines, normalized vector) pairs. Only hunks with the same changed lines are compared: a hunk
+        # that differs in one token (`<` for `<=`) is usually just as similar, but not the same change.
+        results = []
+        with self._lock:
+            for changed, query in queries:
+                rows = self.changed_rows.get(changed)
+                if not rows:
+                    results.append((0.0, None))
+                elif numpy is not None:
+                    scores = self.vectors[rows] @ numpy.asarray(query, dtype=numpy.float32)
+                    best = int(scores.argmax())
+                    results.append((float(scores[best]), self.entry_ids[rows[best]]))
+                else:
+                    score, row = max((sum(a * b for a, b in zip(query, self.vectors[row])), row) for row in rows)
+                    results.append((score, self.entry_ids[row]))
+        return results
+
+    def add(self, entry, hunks):
+        # Stores the findings `entry` for the hunks, (hash, hash of the changed lines, normalized vector) tuples
+        with self._lock:
+            hunks = list({hunk_hash: (hunk_hash, changed, vector) for hunk_hash, changed, vector in hunks if hunk_hash not in self.rows}.values())
+            if not hunks:
+                return
+            os.makedirs(self.path, exist_ok=True)
+            if self.dim is None:
+                self.dim = len(hunks[0][2])
+                with open(self._file("meta.json"), "w") as file:
+                    json.dump({"model": self.model, "dim": self.dim}, file)
+            entry = dict(entry, id=max(self.entries, default=0) + 1, created_at=time.time())
+            self.entries[entry["id"]] = entry
+            with open(self._file("entries.jsonl"), "a") as file:
+                file.write(json.dumps(entry) + "\n")
+            with open(self._file("hunks.jsonl"), "a") as file:
+                for hunk_hash, changed, _ in hunks:
+                    file.write(json.dumps({"hash": hunk_hash, "changed": changed, "entry": entry["id"]}) + "\n")
+            with open(self._file("vectors.f16"), "ab") as file:
+                for _, _, vector in hunks:
+                    file.write(struct.pack(f"<{self.dim}e", *vector))
+
+            for hunk_hash, changed, _ in hunks:
+                self.rows[hunk_hash] = len(self.hashes)
+                self.changed_rows.setdefault(changed, []).append(len(self.hashes))
+                self.hashes.append(hunk_hash)
+                self.changed.append(changed)
+                self.entry_ids.append(entry["id"])
+            if numpy is not None:
+                added = numpy.asarray([vector for _, _, vector in hunks], dtype=numpy.float16).astype(numpy.float32)
+                self.vectors = added if self.vectors is None else numpy.vstack([self.vectors, added])
+            else:
+                self.vectors = (self.vectors or []) + [struct.unpack(f"<{self.dim}e", struct.pack(f"<{self.dim}e", *vector)) for _, _, vector in hunks]
+            # Rewriting the files on every addition would be slow, so the store may grow by a quarter first
+            if len(self.hashes) > self.max_hunks * 5 // 4:
+                self._compact()
+
+    def _compact(self):
+        # Keeps the latest `max_hunks` hunks and the entries they refer to
+        drop = len(self.hashes) - self.max_hunks
+        self.hashes = self.hashes[drop:]
+        self.changed = self.changed[drop:]
+        self.entry_ids = self.entry_ids[drop:]
+        self.vectors = self.vectors[drop:]
+        self._index()
+        self.entries = {entry_id: self.entries[entry_id] for entry_id in set(self.entry_ids)}
+        with open(self._file("entries.jsonl"), "w") as file:
+            for entry in self.entries.values():
+                file.write(json.dumps(entry) + "\n")
+        with open(self._file("hunks.jsonl"), "w") as file:
+            for hunk_hash, changed, entry_id in zip(self.hashes, self.changed, self.entry_ids):
+                file.write(json.dumps({"hash": hunk_hash, "changed": changed, "entry": entry_id}) + "\n")
+        with open(self._file("vectors.f16"), "wb") as file:
+            for vector in self.vectors:
+                file.write(struct.pack(f"<{self.dim}e", *[float(value) for value in vector]))
+
+class ReuseResult:
+    def __init__(self):
+        # Files with the hunks that have to be reviewed
+        self.pending = []
+        # Units with the earlier findings for the matched hunks
+        self.units = []
+        # Paths whose hunks are copies of hunks of another pending file, by the path of that file
+        self.copies = {}
+        # Normalized vector of every pending hunk and hash of its changed lines, by its hash
+        self.vectors = {}
+        self.changed = {}
+        self.reused_hunks = 0
+
+class HunkReuse:
+    """Reuses the findings of earlier reviews for hunks that match reviewed ones.
+
+    Hunks are compared by their normalized lines, with the context: identical hunks always match,
+    hunks with the same changed lines in other surroundings when the cosine similarity of their
+    embeddings (by `embedding_model` on Ollama) is at least `threshold`. Only the findings of units
+    that cover a single file are stored, so that a match does not bring in findings about other
+    files. Copies of a hunk within the same changes are reviewed once. Hunks with
+    less than `min_tokens` changed tokens are too common to tell anything about their findings
+    and are always reviewed.
+    """
+
+    def __init__(self, store, embedding_model=DEFAULT_EMBEDDING_MODEL, threshold=0.95, min_tokens=MIN_REUSE_TOKENS):
+        self.store = store
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.min_tokens = min_tokens
+        self.hunks = 0
+        self.reused = {"exact": 0, "similar": 0, "copy": 0}
+        self.embedded = 0
+        self._lock = threading.Lock()
+
+    def _count(self, match, count=1):
+        with self._lock:
+            self.reused[match] += count
+        HUNKS_REUSED.inc(count, match=match)
+
+    def embed(self, texts):
+        try:
+            vectors = backends.pool.embed(self.embedding_model, texts)
+        except backends.BackendError as e:
+            print(f"Could not embed the hunks with {self.embedding_model}: {e}")
+            return None
+        with self._lock:
+            self.embedded += len(texts)
+        return [unit_vector(vector) for vector in vectors]
+
+    def normalize(self, hunk):
+        # The normalized hunk, or None for a hunk that is not reused
+        normalized = normalize_hunk(hunk)
+        if normalized is None or changed_tokens(normalized) < self.min_tokens:
+            return None
+        return normalized
+
+    def split(self, files):
+        result = ReuseResult()
+        hunks = []
+        for file_diff in files:
+            for hunk in file_diff.hunks:
+                normalized = self.normalize(hunk)
+                hunks.append((file_diff, hunk, normalized, hunk_hash(normalized) if normalized else None))
+        changed = {key: hunk_hash(changed_lines(normalized)) for _, _, normalized, key in hunks if key is not None}
+        with self._lock:
+            self.hunks += len(hunks)
+
+        # Hunks that are neither stored nor copies of an earlier hunk of these files are embedded, all at once
+        first_path = {}
+        to_embed = {}
+        for file_diff, hunk, normalized, key in hunks:
+            if key is not None and self.store.exact(key) is None and key not in first_path:
+                to_embed[key] = normalized
+            if key is not None:
+                first_path.setdefault(key, file_diff.path)
+        vectors = self.embed(list(to_embed.values())) if to_embed else []
+        result.vectors = dict(zip(to_embed, vectors or []))
+        result.changed = changed
+        nearest = dict(zip(result.vectors, self.store.nearest([(changed[key], vector) for key, vector in result.vectors.items()])))
+
+        reused = {}
+        kept = {}
+        for file_diff, hunk, normalized, key in hunks:
+            entry_id = self.store.exact(key) if key is not None else None
+            if entry_id is not None:
+                self._count("exact")
+                result.reused_hunks += 1
+            elif key in nearest and nearest[key][0] >= self.threshold:
+                entry_id = nearest[key][1]
+                self._count("similar")
+                result.reused_hunks += 1
+            elif key is not None and first_path[key] != file_diff.path:
+                # Reviewed with the first file that has this hunk
+                result.copies.setdefault(first_path[key], []).append(file_diff.path)
+                self._count("copy")
+                result.reused_hunks += 1
+                continue
+            if entry_id is not None:
+                reused.setdefault(entry_id, []).append(file_diff.path)
+            else:
+                kept.setdefault(file_diff.path, []).append(hunk)
+
+        for file_diff in files:
+            if file_diff.path in kept or not file_diff.hunks:
+                result.pending.append(FileDiff(file_diff.path, file_diff.header, kept.get(file_diff.path, []), file_diff.footer))
+        if result.reused_hunks and not kept:
+            # Only files without hunks (e.g. renames) are left, they are not reviewed on their own
+            result.pending = []
+        for entry_id, paths in reused.items():
+            entry = self.store.entries[entry_id]
+            result.units.append({"paths": list(dict.fromkeys(paths)), "reviews": entry["reviews"], "reused_from": entry["path"]})
+        return result
+
+    def remember(self, result, units):
+        # Stores the findings of the new units for their hunks, and returns the units for the copies.
+        # The findings of a unit with several files are not stored, they are about the other files too,
+        # nor those of a file split into several units, they are about some of its hunks only.
+        files = {file_diff.path: file_diff for file_diff in result.pending}
+        unit_count = Counter(path for unit in units for path in unit["paths"])
+        copy_units = []
+        for unit in units:
+            for path in unit["paths"]:
+                if path not in files:
+                    continue
+                if len(unit["paths"]) == 1 and unit_count[path] == 1:
+                    keys = [hunk_hash(normalized) for normalized in map(self.normalize, files[path].hunks) if normalized]
+                    self.store.add({"path": path, "reviews": unit["reviews"]}, [(key, result.changed[key], result.vectors[key]) for key in keys if key in result.vectors])
+                copies = list(dict.fromkeys(result.copies.get(path, [])))
+                if copies:
+                    copy_units.append({"paths": copies, "reviews": unit["reviews"], "reused_from": path})
+        return copy_units
+
+    def print_stats(self):
+        reused = sum(self.reused.values())
+        print(f"Hunk reuse: {reused} of {self.hunks} hunk(s) reused ({self.reused['exact']} identical, {self.reused['similar']} similar, "
+              f"{self.reused['copy']} copies within the changes), {self.embedded} embedded, {len(self.store)} in {self.store.path}")
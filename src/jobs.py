@@ -0,0 +1,164 @@
+import itertools
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+import metrics
+from review_run import ReviewCancelled
+
+class QueueFullError(Exception):
+    pass
+
+class ReviewJob:
+    def __init__(self, job_id, repo_full_name, pr_number, func, args, limited=True):
+        self.job_id = job_id
+        self.repo_full_name = repo_full_name
+        self.pr_number = pr_number
+        self.func = func
+        self.args = args
+        # Whether the job counts against the per-repository limit; short jobs that only
+        # check on a running review do not (see GitHubReviewer.request_review)
+        self.limited = limited
+        self.status = "queued"
+        self.error = None
+        # Number of identical requests that were merged into this job
+        self.merged = 0
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            "id": self.job_id,
+            "repo": self.repo_full_name,
+            "pr_number": self.pr_number,
+            "status": self.status,
+            "error": self.error,
+            "merged": self.merged,
+            "queued_at": self.queued_at,
+            "wait_seconds": round((self.started_at or now) - self.queued_at, 3),
+            "run_seconds": round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+        }
+
+class ReviewJobQueue:
+    """Bounded queue of review jobs, executed by a fixed pool of worker threads.
+
+    At most `per_repo_limit` jobs of the same repository run at once; jobs that
+    are blocked by that limit stay queued without holding a worker. A job that is
+    submitted while an identical one is still queued is merged into that one.
+    """
+
+    def __init__(self, workers=2, max_queued=20, per_repo_limit=1, history=50):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.per_repo_limit = per_repo_limit
+
+        self._ids = itertools.count(1)
+        self._pending = deque()
+        self._running = {}
+        self._finished = deque(maxlen=history)
+        self._running_per_repo = Counter()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"review-worker-{i + 1}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, repo_full_name, pr_number, func, *args, limited=True):
+        self.start()
+        with self._cond:
+            for job in self._pending:
+                if (job.repo_full_name, job.pr_number, job.func, job.args) == (repo_full_name, pr_number, func, args):
+                    self._merge(job)
+                    return job
+            if len(self._pending) >= self.max_queued:
+                raise QueueFullError(f"Review queue is full ({self.max_queued} jobs pending)")
+            job = ReviewJob(next(self._ids), repo_full_name, pr_number, func, args, limited)
+            self._pending.append(job)
+            metrics.JOBS_QUEUED.set(len(self._pending))
+            self._cond.notify()
+        print(f"Queued review job #{job.job_id} for {repo_full_name}#{pr_number} ({len(self._pending)} pending)")
+        return job
+
+    def merge(self, job):
+        # Counts a request that is served by an existing job instead of a new one
+        with self._cond:
+            self._merge(job)
+
+    def _merge(self, job):
+        job.merged += 1
+        metrics.REVIEW_REQUESTS_COALESCED.inc(action="merged")
+        print(f"Merged review request for {job.repo_full_name}#{job.pr_number} into {job.status} job #{job.job_id}")
+
+    def running_job(self, repo_full_name, pr_number):
+        with self._cond:
+            for job in self._running.values():
+                if job.limited and job.repo_full_name == repo_full_name and job.pr_number == pr_number:
+                    return job
+        return None
+
+    def status(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "max_queued": self.max_queued,
+                "per_repo_limit": self.per_repo_limit,
+                "queued": [job.to_dict() for job in self._pending],
+                "running": [job.to_dict() for job in self._running.values()],
+                "finished": [job.to_dict() for job in reversed(self._finished)],
+            }
+
+    def _next_runnable_job(self):
+        for job in self._pending:
+            if not job.limited or self._running_per_repo[job.repo_full_name] < self.per_repo_limit:
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_runnable_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_runnable_job()
+                self._running[job.job_id] = job
+                if job.limited:
+                    self._running_per_repo[job.repo_full_name] += 1
+                job.status = "running"
+                job.started_at = time.time()
+                metrics.JOBS_QUEUED.set(len(self._pending))
+                metrics.JOBS_RUNNING.set(len(self._running))
+                metrics.JOB_WAIT_SECONDS.observe(job.started_at - job.queued_at)
+
+            try:
+                job.func(*job.args)
+                job.status = "finished"
+            except ReviewCancelled as e:
+                job.status = "cancelled"
+                job.error = str(e)
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                print(f"Review job #{job.job_id} failed: {e}")
+                print(f"Full exception: {traceback.format_exc()}")
+            finally:
+                job.finished_at = time.time()
+                with self._cond:
+                    del self._running[job.job_id]
+                    if job.limited:
+                        self._running_per_repo[job.repo_full_name] -= 1
+                    self._finished.append(job)
+                    metrics.JOBS_RUNNING.set(len(self._running))
+                    self._cond.notify_all()
+                metrics.JOB_RUN_SECONDS.observe(job.finished_at - job.started_at)
+                metrics.JOBS.inc(status=job.status)
+                print(f"Review job #{job.job_id} {job.status} after {job.finished_at - job.started_at:.2f} seconds")
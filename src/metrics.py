@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Metric:
+    def __init__(self, name, help_text, metric_type):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+class Counter(Metric):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text, "counter")
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text, "gauge")
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, "histogram")
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (1 if value <= bound else 0) for c, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _render_value(self, key, value):
+        counts, total, count = value
+        lines = [f"{self.name}_bucket{self._format_labels(key, [('le', bound)])} {c}" for bound, c in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+STAGE_SECONDS = Histogram("pearbot_stage_duration_seconds", "Duration of the review pipeline stages")
+GENERATIONS = Counter("pearbot_generations_total", "Number of generations per model and stage")
+PROMPT_TOKENS = Counter("pearbot_prompt_tokens_total", "Prompt tokens evaluated per model")
+GENERATED_TOKENS = Counter("pearbot_generated_tokens_total", "Tokens generated per model")
+PROMPT_EVAL_SECONDS = Counter("pearbot_prompt_eval_seconds_total", "Time spent evaluating prompts per model")
+EVAL_SECONDS = Counter("pearbot_eval_seconds_total", "Time spent generating tokens per model")
+GENERATION_SECONDS = Histogram("pearbot_generation_duration_seconds", "Total duration of generations as reported by Ollama")
+COMPACTION_TOKENS_SAVED = Counter("pearbot_compaction_tokens_saved_total", "Estimated prompt tokens removed from diffs by the compaction")
+LLM_CALLS_SAVED = Counter("pearbot_llm_calls_saved_total", "Generations skipped by the adaptive ensemble by reason")
+CACHE_REQUESTS = Counter("pearbot_cache_requests_total", "Review cache lookups by result")
+JOB_WAIT_SECONDS = Histogram("pearbot_job_wait_seconds", "Time review jobs spent in the queue")
+JOB_RUN_SECONDS = Histogram("pearbot_job_run_seconds", "Time review jobs took to run")
+JOBS = Counter("pearbot_jobs_total", "Review jobs by final status")
+JOBS_QUEUED = Gauge("pearbot_jobs_queued", "Review jobs waiting in the queue")
+JOBS_RUNNING = Gauge("pearbot_jobs_running", "Review jobs currently running")
+REVIEW_REQUESTS_COALESCED = Counter("pearbot_review_requests_coalesced_total", "Review requests merged into another one or cancelling a superseded one, by action")
+PROMPT_TOKEN_ESTIMATE_RATIO = Histogram("pearbot_prompt_token_estimate_ratio", "Prompt tokens measured by Ollama per estimated prompt token, by model",
+                                        buckets=(0.25, 0.5, 0.75, 0.9, 1, 1.1, 1.25, 1.5, 2, 3))
+HUNKS_REUSED = Counter("pearbot_hunks_reused_total", "Hunks not sent for review as findings for a matching hunk were reused, by match")
+GENERATIONS_CANCELLED = Counter("pearbot_generations_cancelled_total", "Generations aborted because their review was cancelled")
+
+ALL_METRICS = [STAGE_SECONDS, GENERATIONS, PROMPT_TOKENS, GENERATED_TOKENS, PROMPT_EVAL_SECONDS, EVAL_SECONDS,
+               GENERATION_SECONDS, COMPACTION_TOKENS_SAVED, LLM_CALLS_SAVED, CACHE_REQUESTS, JOB_WAIT_SECONDS, JOB_RUN_SECONDS, JOBS, JOBS_QUEUED, JOBS_RUNNING,
+               REVIEW_REQUESTS_COALESCED, GENERATIONS_CANCELLED, PROMPT_TOKEN_ESTIMATE_RATIO, HUNKS_REUSED]
+
+def render_metrics():
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def observe_generation(model, stage, final):
+    # `final` is the last message of an Ollama generation, carrying its metrics (durations in nanoseconds)
+    GENERATIONS.inc(model=model, stage=stage)
+    PROMPT_TOKENS.inc(final.get("prompt_eval_count", 0), model=model)
+    GENERATED_TOKENS.inc(final.get("eval_count", 0), model=model)
+    PROMPT_EVAL_SECONDS.inc(final.get("prompt_eval_duration", 0) / 1e9, model=model)
+    EVAL_SECONDS.inc(final.get("eval_duration", 0) / 1e9, model=model)
+    GENERATION_SECONDS.observe(final.get("total_duration", 0) / 1e9, model=model, stage=stage)
+
+class Tracer:
+    # Records spans in the Chrome trace event format (viewable in chrome://tracing or Perfetto)
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def add(self, name, start, duration, labels):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": round((start - self._start) * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": labels,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, indent=1)
+
+tracer = None
+
+def enable_tracing():
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+@contextmanager
+def span(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        if tracer is not None:
+            tracer.add(stage, start, duration, labels)
@@ -1,48 +1,64 @@
-import requests
 import json
+import sys
+from contextlib import nullcontext
 
-import ollama
+import backends
+import planning
+from metrics import observe_generation
+from model_registry import registry
 
-def post_request_generate(model, prompt):
-    url = "http://localhost:11434/api/generate"
-    headers = {"Content-Type": "application/json"}
-    data = {"model": model, "prompt": prompt, "stream": True}
+def get_context_length(model):
+    return registry.info(model).context_length or "N/A"
 
-    model_details = ollama.show(model)
-    model_format = model_details.get("details", {}).get("format", "N/A")
-    model_family = model_details.get("details", {}).get("family", "N/A")
-    model_parameter_size = model_details.get("details", {}).get("parameter_size", "N/A")
-    model_quantization_level = model_details.get("details", {}).get("quantization_level", "N/A")
-    context_length = model_details.get("model_info", {}).get("llama.context_length", "N/A")
+def post_request_generate(model, prompt, out=None, run=None, stage="generate", plan=None):
+    out = out or sys.stdout
+    data = {"model": model, "prompt": prompt, "stream": True}
+    if plan is not None:
+        data = plan.apply(data)
 
-    # print(json.dumps(model_details, indent=3))
+    model_info = registry.info(model)
+    model_format = model_info.format
+    model_family = model_info.family
+    model_parameter_size = model_info.parameter_size
+    model_quantization_level = model_info.quantization_level
+    context_length = model_info.context_length or "N/A"
 
     response_content = ""
-    with requests.post(url, headers=headers, json=data, stream=True) as r:
-        for line in r.iter_lines():
+    final = {}
+    with backends.pool.stream_generate(data) as stream, (run.tracking(stream) if run is not None else nullcontext()):
+        for line in stream:
             if line:
                 json_response = json.loads(line)
                 if not json_response.get("done", False):
                     content = json_response.get("response", "")
-                    print(content, end='', flush=True)
+                    print(content, end='', flush=True, file=out)
                     response_content += content
                 else:
                     # This is the final response with metrics
-                    print("\n\n---------------------")
-                    print(f"Model: {model}")
-                    print(f"   Family: {model_family}, Format: {model_format}")
-                    print(f"   Parameter Size: {model_parameter_size}, Quantization: {model_quantization_level}")
-                    print(f"   Context Length: {context_length}")
+                    final = json_response
+                    print("\n\n---------------------", file=out)
+                    print(f"Model: {model} (on {stream.backend.url})", file=out)
+                    print(f"   Family: {model_family}, Format: {model_format}", file=out)
+                    print(f"   Parameter Size: {model_parameter_size}, Quantization: {model_quantization_level}", file=out)
+                    print(f"   Context Length: {context_length}", file=out)
                     eval_count = json_response.get("eval_count", 0)
                     prompt_eval_count = json_response.get('prompt_eval_count', 0)
                     eval_duration = json_response.get("eval_duration", 1)  # in nanoseconds
                     tokens_per_second = (eval_count / eval_duration) * 1e9
-                    print(f"Prompt tokens: {prompt_eval_count}")
-                    print(f"Tokens generated: {eval_count}")
-                    print(f"Total tokens: {prompt_eval_count + eval_count}")
-                    print(f"Speed: {tokens_per_second:.2f} tokens/second")
-                    print(f"Generation time: {eval_duration / 1e9:.2f} seconds")
-                    print(f"Total duration: {json_response.get('total_duration', 0) / 1e9:.2f} seconds")
-                    print("---------------------")
-    print()
-    return response_content
+                    if plan is not None:
+                        print(f"Prompt tokens: {prompt_eval_count} (estimated: {plan.estimated_tokens}, context: {plan.num_ctx}, output limit: {plan.num_predict})", file=out)
+                    else:
+                        print(f"Prompt tokens: {prompt_eval_count}", file=out)
+                    print(f"Tokens generated: {eval_count}", file=out)
+                    print(f"Total tokens: {prompt_eval_count + eval_count}", file=out)
+                    print(f"Speed: {tokens_per_second:.2f} tokens/second", file=out)
+                    print(f"Generation time: {eval_duration / 1e9:.2f} seconds", file=out)
+                    print(f"Total duration: {json_response.get('total_duration', 0) / 1e9:.2f} seconds", file=out)
+                    print("---------------------", file=out)
+                    observe_generation(model, stage, json_response)
+                    if plan is not None:
+                        planning.planner.record(plan, json_response)
+                    if run is not None:
+                        run.record_generation(model, prompt, json_response, plan.estimated_tokens if plan is not None else None)
+    print(file=out)
+    return response_content, final
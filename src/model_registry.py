@@ -0,0 +1,105 @@
+import threading
+import time
+
+import backends
+
+class ModelInfo:
+    def __init__(self, name, digest=None, details=None, model_info=None):
+        details = details or {}
+        self.name = name
+        self.digest = digest
+        self.format = details.get("format", "N/A")
+        self.family = details.get("family", "N/A")
+        self.parameter_size = details.get("parameter_size", "N/A")
+        self.quantization_level = details.get("quantization_level", "N/A")
+        self.context_length = None
+        for key, value in (model_info or {}).items():
+            if key.endswith(".context_length"):
+                self.context_length = value
+
+class ModelRegistry:
+    """Caches the model listing and model metadata of Ollama for `ttl` seconds."""
+
+    def __init__(self, ttl=300, client=None):
+        self.ttl = ttl
+        self._client = client
+        self._models = None
+        self._models_loaded_at = 0
+        self._infos = {}
+        self._warm = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # An ollama.Client for the first Ollama server, created on first use since the
+        # ollama package takes a while to import
+        if self._client is None:
+            import ollama
+
+            self._client = ollama.Client(host=backends.pool.primary_url)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def list_models(self, refresh=False):
+        with self._lock:
+            if refresh or self._models is None or time.time() - self._models_loaded_at > self.ttl:
+                self._models = {model["name"]: model for model in self.client.list().get("models", [])}
+                self._models_loaded_at = time.time()
+            return self._models
+
+    def names(self):
+        return list(self.list_models())
+
+    def resolve(self, name):
+        models = self.list_models()
+        for candidate in (name, f"{name}:latest"):
+            if candidate in models:
+                return candidate
+        return None
+
+    def is_available(self, name):
+        # A model that is missing from the cached listing may have been pulled since
+        if self.resolve(name) is not None:
+            return True
+        self.list_models(refresh=True)
+        return self.resolve(name) is not None
+
+    def info(self, name):
+        with self._lock:
+            cached = self._infos.get(name)
+        if cached is not None and time.time() - cached[1] <= self.ttl:
+            return cached[0]
+
+        resolved = self.resolve(name)
+        listing = self.list_models().get(resolved, {})
+        details = self.client.show(name)
+        info = ModelInfo(name, listing.get("digest"), details.get("details"), details.get("model_info"))
+        with self._lock:
+            self._infos[name] = (info, time.time())
+        return info
+
+    def warm_up(self, models, keep_alive=None):
+        # Loads the models in the background (an empty prompt only loads the model),
+        # so the first generation does not have to wait for it.
+        for model in dict.fromkeys(models):
+            with self._lock:
+                if time.time() - self._warm.get(model, 0) < 60:
+                    continue
+                self._warm[model] = time.time()
+            threading.Thread(target=self._load, args=(model, keep_alive), daemon=True).start()
+
+    def _load(self, model, keep_alive):
+        try:
+            backends.pool.load(model, keep_alive)
+        except Exception as e:
+            print(f"Error warming up model {model}: {e}")
+
+    def invalidate(self):
+        with self._lock:
+            self._models = None
+            self._infos = {}
+
+registry = ModelRegistry()
@@ -1,17 +1,25 @@
-import ollama
+from model_registry import registry
 
 def get_available_models():
     try:
-        model_list = ollama.list()
-        models = model_list.get("models", [])
-        return [model["name"] for model in models]
+        return registry.names()
     except Exception as e:
         print(f"Error fetching available models: {e}")
         return []
 
+def get_model_digest(model_name):
+    try:
+        return registry.info(model_name).digest
+    except Exception as e:
+        print(f"Error fetching model digest: {e}")
+        return None
+
 def is_model_available(model_name):
-    available_models = get_available_models()
-    return model_name in available_models or f"{model_name}:latest" in available_models
+    try:
+        return registry.is_available(model_name)
+    except Exception as e:
+        print(f"Error fetching available models: {e}")
+        return False
 
 def validate_models(models):
     all_models = set(models)
@@ -23,3 +31,12 @@ def validate_models(models):
         print(", ".join(get_available_models()))
         return False
     return True
+
+def warm_up_models(models, stage="initial_review"):
+    # The models stay loaded for the keep_alive of the stage they are used in (see planning.GenerationPlanner)
+    import planning
+
+    try:
+        registry.warm_up(models, planning.planner.keep_alive.get(stage))
+    except Exception as e:
+        print(f"Error warming up models: {e}")
@@ -1,5 +1,7 @@
 import argparse
+import os
 import sys
+from contextlib import nullcontext
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -11,10 +13,14 @@ if str(Path(__file__).parent) not in sys.path:
     sys.path.insert(0, str(Path(__file__).parent))
 
 # Now use simple imports that work both ways
-from storage import get_or_create_session
+import backends
+import metrics
+import planning
 from agents import Agent
-from review_github import GitHubReviewer
-from review_local import analyze_diff
+from cache import DEFAULT_CACHE_PATH, ReviewCache
+from adaptive import AdaptiveEnsemble
+from compaction import DiffCompactor
+from review_local import analyze_diff, review_commits
 from ollama_utils import get_available_models
 
 def main():
@@ -25,37 +31,144 @@ def main():
     parser.add_argument("--list-models", action="store_true", help="List available models")
     parser.add_argument("--prompt-style", type=str, default="default", help="Prompt style (from prompts.yaml)")
     parser.add_argument("--initial-review-models", type=str, default="llama3.1,llama3.1,llama3.1", help="Comma-separated list of model names for the initial review (default: llama3.1,llama3.1,llama3.1)")
+    parser.add_argument("--parallel-reviews", type=int, default=1, help="Maximum number of initial reviews to run concurrently, in batch mode of all generations (default: 1)")
+    parser.add_argument("--chunk-tokens", type=int, default=None, help="Token budget per review part for large diffs (default: derived from the models' context length)")
+    parser.add_argument("--adaptive", action="store_true", help="Stop requesting initial reviews once they agree, and skip the final review for small changes")
+    parser.add_argument("--agreement-threshold", type=float, default=0.6, help="Adaptive: similarity (0-1) of the initial reviews above which no further reviews are requested (default: 0.6)")
+    parser.add_argument("--small-diff-tokens", type=int, default=200, help="Adaptive: changes below this many tokens get a single review without a final review (default: 200)")
+    parser.add_argument("--ignore-files", type=str, default=os.getenv("PEARBOT_IGNORE_FILES"), help="Comma-separated glob patterns of files to leave out of the reviews (default: $PEARBOT_IGNORE_FILES)")
+    parser.add_argument("--context-lines", type=int, default=3, help="Lines of unchanged context kept around the changes (default: 3)")
+    parser.add_argument("--max-diff-tokens", type=int, default=None, help="Token budget of the reviewed changes; files beyond it are omitted (default: no limit)")
+    parser.add_argument("--keep-generated", action="store_true", help="Review generated and vendored files (lockfiles, minified bundles, vendor/, ...) too")
+    parser.add_argument("--no-compaction", action="store_true", help="Review the diff as is, without omitting files or trimming context")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the review cache")
+    parser.add_argument("--purge-cache", action="store_true", help="Remove all entries from the review cache")
+    parser.add_argument("--cache-path", type=str, default=DEFAULT_CACHE_PATH, help=f"Path of the review cache (default: {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--cache-max-mb", type=int, default=200, help="Maximum size of the review cache in MB (default: 200)")
+    parser.add_argument("--cache-max-age-days", type=int, default=30, help="Maximum age of review cache entries in days (default: 30)")
+    parser.add_argument("--ollama-hosts", type=str, default=os.getenv("OLLAMA_HOSTS"), help="Comma-separated list of Ollama servers to distribute the generations over (default: $OLLAMA_HOSTS, or $OLLAMA_HOST)")
+    parser.add_argument("--request-timeout", type=float, default=300, help="Seconds without response after which a generation fails (default: 300)")
+    parser.add_argument("--request-retries", type=int, default=2, help="Number of retries of failed generations on other Ollama servers (default: 2)")
+    parser.add_argument("--hedge-after", type=float, default=None, help="Also send a generation to a second Ollama server when the first one did not start responding after this many seconds")
+    parser.add_argument("--review-workers", type=int, default=2, help="Server: number of reviews processed concurrently (default: 2)")
+    parser.add_argument("--review-queue-size", type=int, default=20, help="Server: maximum number of pending reviews before webhooks are rejected (default: 20)")
+    parser.add_argument("--per-repo-reviews", type=int, default=1, help="Server: maximum number of concurrent reviews per repository (default: 1)")
+    parser.add_argument("--full-reviews", action="store_true", help="Server: always review all files of a Pull Request, not only the ones changed since the last review")
+    parser.add_argument("--single-request-diff", action="store_true", help="Server: fetch the whole Pull Request diff with a single request instead of the per-file listing")
+    parser.add_argument("--sessions-path", type=str, default=None, help="Server: SQLite database of the Pull Request sessions (default: ~/.cache/pearbot/sessions.sqlite3)")
+    parser.add_argument("--max-sessions", type=int, default=256, help="Server: number of Pull Request sessions kept in memory, the others are loaded from the database when needed (default: 256)")
+    parser.add_argument("--history-tokens", type=int, default=0, help="Server: send up to this many tokens of earlier feedback on a Pull Request with its next review, older feedback summarized by the model (default: 0, none)")
+    parser.add_argument("--batch", type=str, nargs='+', default=None, metavar="SPEC", help="Review many units in one run: directories of patch files, patch files, Pull Requests (owner/repo#123) or commit ranges (one unit per commit)")
+    parser.add_argument("--max-loaded-models", type=int, default=1, help="Batch: number of models used at the same time (default: 1)")
+    parser.add_argument("--batch-units", type=int, default=8, help="Batch: number of units reviewed at the same time (default: 8)")
+    parser.add_argument("--per-commit", action="store_true", help="Local: review each commit of a patch series (git format-patch) on its own")
+    parser.add_argument("--parallel-commits", type=int, default=2, help="Local: number of commits reviewed concurrently with --per-commit (default: 2)")
+    parser.add_argument("--trace-file", type=str, default=None, help="Local: write a JSON trace of the review stages to this file (Chrome trace event format)")
+    parser.add_argument("--context-repo", type=str, default=None, metavar="PATH", help="Add the definitions around and used by the changes, from this git checkout, as context to the reviews (local diffs and server)")
+    parser.add_argument("--context-tokens", type=int, default=1500, help="Maximum number of tokens of context added with --context-repo (default: 1500)")
+    parser.add_argument("--review-output-tokens", type=int, default=1024, help="Maximum number of tokens of each initial review (default: 1024)")
+    parser.add_argument("--final-output-tokens", type=int, default=2048, help="Maximum number of tokens of the final review (default: 2048)")
+    parser.add_argument("--keep-alive", type=str, default="10m", help="How long Ollama keeps the models loaded after a generation (default: 10m)")
+    parser.add_argument("--reuse-findings", action="store_true", help="Reuse the findings of earlier reviews for hunks that match reviewed ones (needs an embedding model on Ollama)")
+    parser.add_argument("--embedding-model", type=str, default="nomic-embed-text", help="Ollama model that embeds the hunks for --reuse-findings (default: nomic-embed-text)")
+    parser.add_argument("--reuse-threshold", type=float, default=0.95, help="Minimum cosine similarity of a hunk to a reviewed one with the same changed lines to reuse its findings (default: 0.95)")
+    parser.add_argument("--reuse-path", type=str, default=None, help="Directory of the index of reviewed hunks (default: ~/.cache/pearbot/hunks)")
     parser.add_argument("--skip-reasoning", action="store_true", help="Skip reasoning section (if present)")
 
     args = parser.parse_args()
 
-    print(f"Available models: {', '.join(get_available_models()) or 'NONE'}")
+    hosts = args.ollama_hosts.split(',') if args.ollama_hosts else [backends.pool.primary_url]
+    backends.configure_backends(hosts, args.request_timeout, args.request_retries, args.hedge_after)
+
     if args.list_models:
+        print(f"Available models: {', '.join(get_available_models()) or 'NONE'}")
         return
 
     initial_review_models = args.initial_review_models.split(',')
     final_review_model = args.model
 
-    code_review_agent = Agent(role="code_reviewer", use_post_request=True, prompt_style=args.prompt_style)
-    feedback_improver_agent = Agent(role="feedback_improver", use_post_request=True, prompt_style=args.prompt_style)
+    cache = None
+    if not args.no_cache or args.purge_cache:
+        cache = ReviewCache(args.cache_path, args.cache_max_mb * 1024 * 1024, args.cache_max_age_days)
+        if args.purge_cache:
+            cache.purge()
+            print(f"Purged review cache {args.cache_path}")
+        if args.no_cache:
+            cache = None
+
+    compactor = None
+    if not args.no_compaction:
+        ignore_globs = [pattern.strip() for pattern in args.ignore_files.split(',') if pattern.strip()] if args.ignore_files else []
+        compactor = DiffCompactor(ignore_globs, args.context_lines, args.max_diff_tokens, not args.keep_generated)
+
+    adaptive = AdaptiveEnsemble(args.agreement_threshold, small_diff_tokens=args.small_diff_tokens) if args.adaptive else None
+
+    context_builder = None
+    if args.context_repo:
+        from code_index import CodeIndex, ContextBuilder
+
+        context_builder = ContextBuilder(CodeIndex(args.context_repo), args.context_tokens)
+
+    reuse = None
+    if args.reuse_findings:
+        from hunk_reuse import DEFAULT_REUSE_PATH, HunkReuse, HunkStore
+
+        reuse = HunkReuse(HunkStore(args.reuse_path or DEFAULT_REUSE_PATH, args.embedding_model), args.embedding_model, args.reuse_threshold)
+
+    planning.configure_planner({"initial_review": args.review_output_tokens, "improver": args.final_output_tokens},
+                               {"initial_review": args.keep_alive, "improver": args.keep_alive, "history_summary": args.keep_alive})
+
+    code_review_agent = Agent(role="code_reviewer", use_post_request=True, prompt_style=args.prompt_style, cache=cache)
+    feedback_improver_agent = Agent(role="feedback_improver", use_post_request=True, prompt_style=args.prompt_style, cache=cache)
 
     if args.server:
         print("Running as a server...")
-        github_reviewer = GitHubReviewer(code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, args.skip_reasoning)
+        # The server stack (Flask, GitHub client) is only imported when running as a server
+        from jobs import ReviewJobQueue
+        from review_github import GitHubReviewer
+        from storage import DEFAULT_SESSIONS_PATH, configure_sessions
+
+        configure_sessions(args.sessions_path or DEFAULT_SESSIONS_PATH, args.max_sessions)
+
+        job_queue = ReviewJobQueue(args.review_workers, args.review_queue_size, args.per_repo_reviews)
+        github_reviewer = GitHubReviewer(code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, args.skip_reasoning, args.parallel_reviews, job_queue, args.chunk_tokens, not args.full_reviews, args.single_request_diff, compactor=compactor, adaptive=adaptive, context_builder=context_builder, history_tokens=args.history_tokens, reuse=reuse)
         github_reviewer.run_server()
+    elif args.batch:
+        from batch import collect_units, run_batch
+
+        units = collect_units(args.batch)
+        print(f"Reviewing {len(units)} unit(s)...")
+        run_batch(units, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, args.skip_reasoning, args.parallel_reviews, args.max_loaded_models, args.batch_units, args.chunk_tokens, compactor, adaptive, reuse)
+        if cache is not None:
+            cache.print_stats()
     elif args.diff or not sys.stdin.isatty():
+        if args.trace_file:
+            metrics.enable_tracing()
+
         if args.diff == '-' or not sys.stdin.isatty():
             print("Reading diff from stdin...")
-            diff_content = sys.stdin.read()
+            # Unlike an opened file, stdin is left open
+            source = nullcontext(sys.stdin)
         elif args.diff:
             print(f"Reading diff from file: {args.diff}")
-            with open(args.diff, 'r') as file:
-                diff_content = file.read()
+            source = open(args.diff, 'r')
         else:
             parser.print_help()
             return
 
-        analyze_diff(diff_content, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, args.skip_reasoning)
+        with source as source:
+            if args.per_commit:
+                # The patch series is parsed line by line while the commits are reviewed
+                review_commits(source, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, args.skip_reasoning, args.parallel_reviews, args.chunk_tokens, compactor, args.parallel_commits, adaptive, reuse)
+            else:
+                with metrics.span("fetch", source=args.diff or '-'):
+                    diff_content = "".join(source)
+                analyze_diff(diff_content, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, args.skip_reasoning, args.parallel_reviews, args.chunk_tokens, compactor, adaptive, context_builder, reuse)
+        if cache is not None:
+            cache.print_stats()
+        if args.trace_file:
+            metrics.tracer.write(args.trace_file)
+            print(f"Trace written to {args.trace_file}")
     else:
         parser.print_help()
 
@@ -0,0 +1,147 @@
+import math
+import re
+import threading
+import time
+from collections import deque
+
+from metrics import PROMPT_TOKEN_ESTIMATE_RATIO
+from model_registry import registry
+from utils import estimate_tokens
+
+DEFAULT_CONTEXT_LENGTH = 2048
+MIN_NUM_CTX = 2048
+# Generations with less room than this for their output do not fit
+MIN_OUTPUT_TOKENS = 256
+# Output budget and keep_alive of the generations of each stage
+STAGE_OUTPUT_TOKENS = {"initial_review": 1024, "improver": 2048, "history_summary": 512}
+DEFAULT_OUTPUT_TOKENS = 1024
+STAGE_KEEP_ALIVE = {"initial_review": "10m", "improver": "10m", "history_summary": "10m"}
+# keep_alive of Ollama when a generation does not set one
+DEFAULT_KEEP_ALIVE_SECONDS = 300
+DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+# Measured prompt tokens per estimated token, kept per model to correct the estimates
+CALIBRATION_SAMPLES = 20
+
+def keep_alive_seconds(keep_alive):
+    # Seconds of a keep_alive value of Ollama: a number of seconds or a duration like "1h30m",
+    # negative to keep the model loaded forever
+    if keep_alive is None:
+        return DEFAULT_KEEP_ALIVE_SECONDS
+    try:
+        seconds = float(keep_alive)
+    except ValueError:
+        parts = re.findall(r"(-?[\d.]+)(ms|h|m|s)", str(keep_alive))
+        if not parts:
+            return DEFAULT_KEEP_ALIVE_SECONDS
+        seconds = sum(float(value) * DURATION_UNITS[unit] for value, unit in parts)
+    return math.inf if seconds < 0 else seconds
+
+class GenerationPlan:
+    def __init__(self, model, stage, estimated_tokens, ratio, context_length, num_ctx, num_predict, keep_alive):
+        self.model = model
+        self.stage = stage
+        self.estimated_tokens = estimated_tokens
+        # Correction of the estimate that was applied
+        self.ratio = ratio
+        self.context_length = context_length
+        self.num_ctx = num_ctx
+        self.num_predict = num_predict
+        self.keep_alive = keep_alive
+
+    @property
+    def fits(self):
+        return self.estimated_tokens + MIN_OUTPUT_TOKENS <= self.context_length
+
+    def apply(self, payload):
+        # Adds the plan to the payload of an Ollama generation
+        payload = dict(payload, options=dict(payload.get("options", {}), num_ctx=self.num_ctx, num_predict=self.num_predict))
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+class GenerationPlanner:
+    """Sizes each generation from its prompt.
+
+    `num_ctx` is the estimated prompt plus the output budget of the stage, rounded up to a
+    power of two and limited to the context length of the model. Ollama loads a model again
+    when `num_ctx` changes, so a model keeps the largest `num_ctx` it was given as long as it
+    stays loaded (its `keep_alive`) rather than shrinking for smaller prompts. When the prompt leaves less than
+    the output budget, the output budget is reduced to the room that is left.
+    """
+
+    def __init__(self, output_tokens=None, keep_alive=None):
+        self.output_tokens = dict(STAGE_OUTPUT_TOKENS, **(output_tokens or {}))
+        self.keep_alive = dict(STAGE_KEEP_ALIVE, **(keep_alive or {}))
+        self._num_ctx = {}
+        self._ratios = {}
+        self._lock = threading.Lock()
+
+    def context_length(self, model):
+        length = registry.info(model).context_length
+        return length if isinstance(length, int) else DEFAULT_CONTEXT_LENGTH
+
+    def ratio(self, model):
+        # The highest recent ratio: a prompt whose prefix Ollama still had in its KV cache is
+        # only partially evaluated, which makes its ratio too low
+        with self._lock:
+            samples = self._ratios.get(model)
+            return max(samples) if samples else 1.0
+
+    def estimate(self, model, prompt):
+        return math.ceil(estimate_tokens(prompt) * self.ratio(model))
+
+    def plan(self, model, prompt, stage):
+        ratio = self.ratio(model)
+        estimated = math.ceil(estimate_tokens(prompt) * ratio)
+        context_length = self.context_length(model)
+        output_tokens = self.output_tokens.get(stage, DEFAULT_OUTPUT_TOKENS)
+        needed = self._needed_num_ctx(estimated, output_tokens, context_length)
+        keep_alive = self.keep_alive.get(stage)
+        now = time.time()
+        with self._lock:
+            previous, unloaded_at = self._num_ctx.get(model, (0, 0))
+            num_ctx = min(max(needed, previous if now < unloaded_at else 0), context_length)
+            self._num_ctx[model] = (num_ctx, now + keep_alive_seconds(keep_alive))
+        # A prompt that does not fit is cut short by Ollama; the output still gets the minimal budget
+        num_predict = max(min(output_tokens, num_ctx - estimated), MIN_OUTPUT_TOKENS)
+        return GenerationPlan(model, stage, estimated, ratio, context_length, num_ctx, num_predict, keep_alive)
+
+    @staticmethod
+    def _needed_num_ctx(estimated, output_tokens, context_length):
+        return min(2 ** math.ceil(math.log2(max(estimated + output_tokens, MIN_NUM_CTX))), context_length)
+
+    def options(self, model, prompt, stage):
+        # The options that shape the output of a generation (for the cache key of the review), from the
+        # prompt alone: without the larger num_ctx a model may keep from earlier generations, and without
+        # reserving it
+        estimated = self.estimate(model, prompt)
+        output_tokens = self.output_tokens.get(stage, DEFAULT_OUTPUT_TOKENS)
+        num_ctx = self._needed_num_ctx(estimated, output_tokens, self.context_length(model))
+        return {"num_ctx": num_ctx, "num_predict": max(min(output_tokens, num_ctx - estimated), MIN_OUTPUT_TOKENS)}
+
+    def fits(self, model, prompt):
+        return self.estimate(model, prompt) + MIN_OUTPUT_TOKENS <= self.context_length(model)
+
+    def record(self, plan, metrics):
+        # The model stays loaded with the num_ctx of the plan for its keep_alive after the generation
+        now = time.time()
+        with self._lock:
+            previous, unloaded_at = self._num_ctx.get(plan.model, (0, 0))
+            num_ctx = max(plan.num_ctx, previous if now < unloaded_at else 0)
+            self._num_ctx[plan.model] = (num_ctx, now + keep_alive_seconds(plan.keep_alive))
+        # Compares the estimate with the prompt tokens Ollama measured
+        measured = metrics.get("prompt_eval_count")
+        if not measured or not plan.estimated_tokens:
+            return
+        ratio = measured / plan.estimated_tokens
+        PROMPT_TOKEN_ESTIMATE_RATIO.observe(ratio, model=plan.model)
+        with self._lock:
+            # The samples are relative to the uncorrected estimate
+            self._ratios.setdefault(plan.model, deque(maxlen=CALIBRATION_SAMPLES)).append(ratio * plan.ratio)
+
+planner = GenerationPlanner()
+
+def configure_planner(output_tokens=None, keep_alive=None):
+    global planner
+    planner = GenerationPlanner(output_tokens, keep_alive)
+    return planner
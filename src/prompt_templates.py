@@ -0,0 +1,48 @@
+import json
+import os
+from pathlib import Path
+
+PROMPTS_PATH = Path(__file__).parent / "prompts.yaml"
+COMPILED_PROMPTS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pearbot", "prompts.json")
+
+_loaded = {}
+
+def _source_key(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def _read_compiled(compiled_path, key):
+    try:
+        with open(compiled_path, "r") as file:
+            compiled = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return compiled.get("prompts") if compiled.get("source") == key else None
+
+def _write_compiled(compiled_path, key, prompts):
+    try:
+        os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+        temporary_path = f"{compiled_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"source": key, "prompts": prompts}, file)
+        os.replace(temporary_path, compiled_path)
+    except OSError as e:
+        print(f"Could not write the compiled prompts to {compiled_path}: {e}")
+
+def load_prompts(path=PROMPTS_PATH, compiled_path=COMPILED_PROMPTS_PATH):
+    # The prompts are parsed once per process. The parsed templates are also stored as JSON,
+    # keyed by the size and modification time of the YAML file, so later runs neither parse
+    # the YAML nor import PyYAML.
+    key = _source_key(path)
+    prompts = _loaded.get(key)
+    if prompts is None:
+        prompts = _read_compiled(compiled_path, key) if compiled_path else None
+        if prompts is None:
+            import yaml
+
+            with open(path, "r") as file:
+                prompts = yaml.safe_load(file)["prompts"]
+            if compiled_path:
+                _write_compiled(compiled_path, key, prompts)
+        _loaded[key] = prompts
+    return prompts
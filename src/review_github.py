@@ -1,20 +1,27 @@
 import os
-import jwt
-import time
-import requests
 import hmac
 import hashlib
 import sys
+import threading
 import traceback
 
-from github import Github, GithubException
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, jsonify
 
-from ollama_utils import validate_models
+import backends
+from diffs import FileDiff, parse_diff, split_hunks
+from ensemble import run_ensemble
+from github_client import GitHubAPIError, GitHubClient
+from jobs import QueueFullError, ReviewJobQueue
+from metrics import REVIEW_REQUESTS_COALESCED, render_metrics, span
+from ollama_utils import validate_models, warm_up_models
+from review_run import ReviewCancelled, ReviewRun
+from storage import checkout_session, file_fingerprint, get_or_create_session, model_summarizer
 from utils import remove_reasoning
 
+FILE_SEPARATOR = "\n---\n"
+
 class GitHubReviewer:
-    def __init__(self, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool):
+    def __init__(self, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool, parallel_reviews=1, job_queue=None, chunk_tokens=None, incremental=True, single_request_diff=False, github_client=None, compactor=None, adaptive=None, context_builder=None, history_tokens=0, reuse=None):
         try:
             self.GITHUB_APP_ID = os.getenv("GITHUB_APP_ID")
             self.GITHUB_PRIVATE_KEY = os.getenv("GITHUB_PRIVATE_KEY")
@@ -34,6 +41,21 @@ class GitHubReviewer:
         self.initial_review_models = initial_review_models
         self.final_review_model = final_review_model
         self.skip_reasoning = skip_reasoning
+        self.parallel_reviews = parallel_reviews
+        self.chunk_tokens = chunk_tokens
+        self.incremental = incremental
+        self.single_request_diff = single_request_diff
+        self.compactor = compactor
+        self.adaptive = adaptive
+        self.context_builder = context_builder
+        # Tokens of earlier feedback on a Pull Request sent back with its next review (0: none)
+        self.history_tokens = history_tokens
+        self.reuse = reuse
+        self.github = github_client or GitHubClient(self.GITHUB_APP_ID, self.GITHUB_PRIVATE_KEY)
+        self.job_queue = job_queue or ReviewJobQueue()
+        # Reviews in progress by (repository, Pull Request number): the head they review and their ReviewRun
+        self.active_reviews = {}
+        self._active_lock = threading.Lock()
 
         self.app = Flask(__name__)
         self.setup_routes()
@@ -53,14 +75,33 @@ class GitHubReviewer:
             print(f"Received event: {event}")
 
             if event == "issue_comment":
-                self.handle_issue_comment(payload)
+                try:
+                    job = self.handle_issue_comment(payload)
+                except QueueFullError as e:
+                    print(f"Rejecting review request: {e}")
+                    return 'Review queue is full, try again later', 503, {'Retry-After': '60'}
+                if job is not None:
+                    return jsonify(job.to_dict()), 202
             else:
                 print(f"Event {event} is not supported")
 
             return 'Webhook received', 200
 
+        @self.app.route('/jobs', methods=['GET'])
+        def jobs():
+            return jsonify(self.job_queue.status())
+
+        @self.app.route('/backends', methods=['GET'])
+        def ollama_backends():
+            return jsonify(backends.pool.status())
+
+        @self.app.route('/metrics', methods=['GET'])
+        def metrics():
+            return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
     def run_server(self, host="localhost", port=3000):
-        self.app.run(host=host, port=port)
+        self.job_queue.start()
+        self.app.run(host=host, port=port, threaded=True)
 
     def verify_webhook_signature(self, request):
         signature = request.headers.get('X-Hub-Signature-256')
@@ -76,27 +117,6 @@ class GitHubReviewer:
 
         return hmac.compare_digest(mac.hexdigest(), signature)
 
-    def create_jwt(self):
-        now = int(time.time())
-        payload = {
-            "iat": now,
-            "exp": now + (10 * 60),  # JWT expires in 10 minutes
-            "iss": self.GITHUB_APP_ID
-        }
-        return jwt.encode(payload, self.GITHUB_PRIVATE_KEY, algorithm="RS256")
-
-    def get_installation_access_token(self, installation_id):
-        jwt_token = self.create_jwt()
-        headers = {
-            "Authorization": f"Bearer {jwt_token}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        response = requests.post(
-            f"https://api.github.com/app/installations/{installation_id}/access_tokens",
-            headers=headers
-        )
-        return response.json()["token"]
-
     def handle_issue_comment(self, payload):
         action = payload["action"]
         comment = payload["comment"]
@@ -107,67 +127,151 @@ class GitHubReviewer:
 
         if "pull_request" in issue and action == "created" and "@pearbot review" in comment["body"].lower():
             print(f"\nReview requested with `@pearbot review` for Pull Request #{issue['number']}")
-            self.perform_review(issue["number"], repo["full_name"], payload["installation"]["id"])
+            return self.request_review(repo["full_name"], issue["number"], payload["installation"]["id"])
         else:
             print(f"Review condition not found")
+            return None
+
+    def request_review(self, repo_full_name, pr_number, installation_id):
+        # Requests are coalesced per Pull Request. While a review of it runs, a short job checks the head
+        # (the webhook has to be answered right away, see coalesce_review); identical requests that are
+        # still queued are merged by the job queue.
+        with self._active_lock:
+            active = (repo_full_name, pr_number) in self.active_reviews
+        if active:
+            return self.job_queue.submit(repo_full_name, pr_number, self.coalesce_review, pr_number, repo_full_name, installation_id, limited=False)
+        return self.job_queue.submit(repo_full_name, pr_number, self.perform_review, pr_number, repo_full_name, installation_id)
+
+    def coalesce_review(self, pr_number, repo_full_name, installation_id):
+        # A request for the head that is being reviewed is merged into that review; a request for a new
+        # head cancels it, as does any request while the review has not fetched the Pull Request yet
+        # and its head is not known. When the head cannot be fetched, the running review serves the request.
+        with self._active_lock:
+            active = self.active_reviews.get((repo_full_name, pr_number))
+        job = self.job_queue.running_job(repo_full_name, pr_number)
+        if active is None or job is None:
+            self.job_queue.submit(repo_full_name, pr_number, self.perform_review, pr_number, repo_full_name, installation_id)
+            return
+        try:
+            head_sha = self.github.get_pull(repo_full_name, pr_number, installation_id)["head"]["sha"]
+        except GitHubAPIError as e:
+            print(f"GitHub API error while checking the head of {repo_full_name}#{pr_number}: {e.status} - {e.data}")
+            head_sha = active["head_sha"]
+        if head_sha == active["head_sha"]:
+            self.job_queue.merge(job)
+            return
+        aborted = active["run"].cancel()
+        REVIEW_REQUESTS_COALESCED.inc(action="cancelled")
+        print(f"Cancelled the review of {repo_full_name}#{pr_number} at {(active['head_sha'] or 'an unknown head')[:7]}, head is now at {head_sha[:7]} ({aborted} generation(s) aborted)")
+        self.job_queue.submit(repo_full_name, pr_number, self.perform_review, pr_number, repo_full_name, installation_id)
 
     def perform_review(self, pr_number, repo_full_name, installation_id):
+        key = (repo_full_name, pr_number)
+        run = ReviewRun()
+        # The head is set once the Pull Request is fetched
+        with self._active_lock:
+            self.active_reviews[key] = {"head_sha": None, "run": run}
+        try:
+            # Keeps the session of the Pull Request in memory for _perform_review while it runs
+            with checkout_session(pr_number, repo_full_name):
+                self._perform_review(pr_number, repo_full_name, installation_id, run)
+        except ReviewCancelled:
+            print(f"Review of {repo_full_name}#{pr_number} was cancelled, a newer head is reviewed instead")
+            raise
+        finally:
+            with self._active_lock:
+                if self.active_reviews.get(key, {}).get("run") is run:
+                    del self.active_reviews[key]
+
+    def set_active_head(self, repo_full_name, pr_number, run, head_sha):
+        with self._active_lock:
+            active = self.active_reviews.get((repo_full_name, pr_number))
+            if active is not None and active["run"] is run:
+                active["head_sha"] = head_sha
+        run.check_cancelled()
+
+    def _perform_review(self, pr_number, repo_full_name, installation_id, run):
         if not validate_models(self.initial_review_models + ([self.final_review_model] if self.final_review_model != "" else [])):
-            sys.exit(1)
+            raise RuntimeError("Required models are not available")
+        warm_up_models(self.initial_review_models)
+
+        with span("fetch", repo=repo_full_name, pr=pr_number):
+            pull_request = self.github.get_pull(repo_full_name, pr_number, installation_id)
+            head_sha = pull_request["head"]["sha"]
+            self.set_active_head(repo_full_name, pr_number, run, head_sha)
+            if self.single_request_diff:
+                _, files = parse_diff(self.github.get_pull_diff(repo_full_name, pr_number, installation_id))
+                separator = ""
+            else:
+                files = self.file_diffs(self.github.get_pull_files(repo_full_name, pr_number, installation_id))
+                separator = FILE_SEPARATOR
+        if self.compactor is not None:
+            files, report = self.compactor.compact(files, separator)
+            report.print_report()
+        changes = separator.join(file_diff.render() for file_diff in files)
+        fingerprints = {file_diff.path: file_fingerprint(file_diff) for file_diff in files}
+
+        session = get_or_create_session(pr_number, repo_full_name)
+        previous_units = []
+        if self.incremental and session.last_reviewed_sha is not None:
+            previous_units = session.valid_review_units(fingerprints)
+            print(f"Last review of #{pr_number} was at {session.last_reviewed_sha[:7]}, head is now at {head_sha[:7]}")
 
-        access_token = self.get_installation_access_token(installation_id)
-        g = Github(access_token)
-        repo_obj = g.get_repo(repo_full_name)
-        pull_request = repo_obj.get_pull(pr_number)
+        context = self.context_builder.build(files, head_sha, fetch=f"pull/{pr_number}/head") if self.context_builder is not None else ""
+        if self.history_tokens:
+            history = session.history(self.history_tokens, model_summarizer(self.final_review_model or self.initial_review_models[0], run))
+            if history:
+                context += "\n\nEarlier feedback on this Pull Request:\n" + "\n\n".join(message["content"] for message in history)
 
-        changes = self.file_changes_as_string(pull_request.get_files())
         pr_data = {
-            "title": pull_request.title,
-            "description": pull_request.body,
+            "title": pull_request["title"],
+            "description": pull_request["body"],
             "changes": changes,
-            "context": ""
+            "context": context.strip()
         }
 
-        initial_reviews = []
-        for model in self.initial_review_models:
-            print(f"\n\n >>> Requesting initial review with {model}...")
-            _, initial_review = self.code_review_agent.analyze(pr_data, model)
-            initial_reviews.append(initial_review)
+        with span("review", repo=repo_full_name, pr=pr_number):
+            units, improved_feedback = run_ensemble(pr_data, self.code_review_agent, self.feedback_improver_agent, self.initial_review_models, self.final_review_model, self.parallel_reviews, print, files, separator, self.chunk_tokens, previous_units, run, self.adaptive, self.reuse)
+        run.print_summary()
+        if self.reuse is not None:
+            self.reuse.print_stats()
+        # A review of a superseded head is not recorded or posted
+        run.check_cancelled()
+        session.record_review(head_sha, units, fingerprints)
+        session.add_message("assistant", improved_feedback)
 
-        improvement_data = {
-            "pr_data": pr_data,
-            "initial_reviews": initial_reviews
-        }
-        if self.final_review_model != "":
-            print(f"\n\n >>> Requesting improved review (with {self.final_review_model})...\n\n")
-            _, improved_feedback = self.feedback_improver_agent.analyze(improvement_data, self.final_review_model)
-        else:
-            print(f"\n\n >>> No final review model specified. Returning first review.\n\n")
-            improved_feedback = initial_reviews[0]
+        if self.code_review_agent.cache is not None:
+            self.code_review_agent.cache.print_stats()
 
         if self.skip_reasoning:
             improved_feedback = remove_reasoning(improved_feedback)
 
         try:
             print(f"\n\nPosting improved feedback:\n{improved_feedback}\n\n")
-            pull_request.create_issue_comment(f"{improved_feedback}")
-        except GithubException as e:
+            with span("post", repo=repo_full_name, pr=pr_number):
+                self.github.create_issue_comment(repo_full_name, pr_number, f"{improved_feedback}", installation_id)
+        except GitHubAPIError as e:
             print(f"GitHub API error: {e.status} - {e.data}")
         except Exception as e:
             print(f"Error posting review: {e}")
             print(f"Full exception: {traceback.format_exc()}")
 
     @staticmethod
-    def file_changes_as_string(files):
-        file_changes = []
+    def file_diffs(files):
+        file_diffs = []
         for file in files:
-            file_changes.append(f"""
-        Filename: {file.filename}
-        Status: {file.status}
-        Additions: {file.additions}
-        Deletions: {file.deletions}
-        Changes: {file.changes}
+            preamble, hunks = split_hunks(file.get("patch"))
+            header = f"""
+        Filename: {file['filename']}
+        Status: {file['status']}
+        Additions: {file['additions']}
+        Deletions: {file['deletions']}
+        Changes: {file['changes']}
         Patch:
-    {file.patch}
-    """)
-        return "\n---\n".join(file_changes)
+    {preamble}"""
+            file_diffs.append(FileDiff(file['filename'], header, hunks, "\n    "))
+        return file_diffs
+
+    @staticmethod
+    def file_changes_as_string(files):
+        return FILE_SEPARATOR.join(file_diff.render() for file_diff in GitHubReviewer.file_diffs(files))
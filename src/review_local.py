@@ -1,27 +1,35 @@
+import io
 import json
 import re
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from colorama import Fore, Style
 
-from ollama_utils import validate_models
+from diffs import FileDiff, flatten_commits, parse_patch_series
+from ensemble import run_ensemble
+from metrics import span
+from ollama_utils import validate_models, warm_up_models
+from review_run import ReviewRun
 from utils import remove_reasoning
 
-def extract_commit_info(diff_content):
+def extract_commit_info(diff_content, commits):
     commit_range = None
-    commit_messages = []
+    commit_messages = [commit.subject for commit in commits if commit.sha]
 
-    commit_hashes = re.findall(r'index ([0-9a-f]{7,40})\.\.([0-9a-f]{7,40})', diff_content)
-    if commit_hashes:
-        first_commit, last_commit = commit_hashes[0][0], commit_hashes[-1][1]
-        commit_range = f"{first_commit}..{last_commit}"
+    if commit_messages:
+        commit_range = f"{commits[0].sha[:7]}..{commits[-1].sha[:7]}"
+    else:
+        commit_hashes = re.findall(r'index ([0-9a-f]{7,40})\.\.([0-9a-f]{7,40})', diff_content)
+        if commit_hashes:
+            commit_range = f"{commit_hashes[0][0]}..{commit_hashes[-1][1]}"
+    if commit_range:
         print(f"Extracted commit range: {commit_range}")
     else:
         print("No commit range found in the diff content.")
 
-    message_blocks = re.findall(r'From [0-9a-f]+ .*\nFrom: .*\nDate: .*\nSubject: \[PATCH\] (.*)', diff_content)
-    commit_messages.extend(message_blocks)
-
     if commit_messages:
         print(f"Extracted {len(commit_messages)} commit message(s) from the diff content.")
     else:
@@ -29,11 +37,17 @@ def extract_commit_info(diff_content):
 
     return commit_messages
 
-def analyze_diff(diff_content, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool):
+def announce(message, out=None):
+    print(Fore.GREEN + message, file=out)
+    print(Style.RESET_ALL, file=out)
+
+def analyze_diff(diff_content, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool, parallel_reviews=1, chunk_tokens=None, compactor=None, adaptive=None, context_builder=None, reuse=None):
     if not validate_models(initial_review_models + ([final_review_model] if final_review_model != "" else [])):
         sys.exit(1)
+    warm_up_models(initial_review_models)
 
-    extracted_messages = extract_commit_info(diff_content)
+    commits = list(parse_patch_series(diff_content.splitlines(keepends=True)))
+    extracted_messages = extract_commit_info(diff_content, commits)
 
     if not extracted_messages:
         comments_str = "No commit information found."
@@ -47,29 +61,82 @@ def analyze_diff(diff_content, code_review_agent, feedback_improver_agent, initi
         "context": ""
     }
 
+    preamble, files = flatten_commits(commits)
+    if compactor is not None:
+        files, report = compactor.compact(files)
+        report.print_report()
+    if preamble.strip():
+        files.insert(0, FileDiff("(commit messages)", preamble))
+    if compactor is not None:
+        pr_data["changes"] = "".join(file_diff.render() for file_diff in files)
+    if context_builder is not None:
+        pr_data["context"] = context_builder.build(files)
+
     print(json.dumps(pr_data, indent=4))
 
-    initial_reviews = []
-    for model in initial_review_models:
-        print(Fore.GREEN + f"\n\n >>> Requesting initial review with {model}...")
-        print(Style.RESET_ALL)
-        _, initial_review = code_review_agent.analyze(pr_data, model)
-        initial_reviews.append(initial_review)
+    run = ReviewRun()
+    with span("review", source="diff"):
+        _, improved_feedback = run_ensemble(pr_data, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, parallel_reviews, announce, files, "", chunk_tokens, run=run, adaptive=adaptive, reuse=reuse)
+    run.print_summary()
+    if reuse is not None:
+        reuse.print_stats()
+
+    if skip_reasoning:
+        improved_feedback = remove_reasoning(improved_feedback)
+
+    print(f"\n\nImproved feedback:\n{improved_feedback}\n\n")
 
-    improvement_data = {
-        "pr_data": pr_data,
-        "initial_reviews": initial_reviews
+def commit_review_data(commit, files):
+    return {
+        "title": commit.subject or commit.label,
+        "description": f"    commit {commit.sha}\n    author: {commit.headers.get('From', 'unknown')}\n\n{commit.message}" if commit.sha else "No commit information found.",
+        "changes": "".join(file_diff.render() for file_diff in files),
+        "context": ""
     }
 
-    if final_review_model != "":
-        print(Fore.GREEN + f"\n\n >>> Requesting improved review (with {final_review_model})...\n\n")
-        _, improved_feedback = feedback_improver_agent.analyze(improvement_data, final_review_model)
-    else:
-        print(Fore.GREEN + f"\n\n >>> No final review model specified. Returning first review.\n\n")
-        improved_feedback = initial_reviews[0]
-    print(Style.RESET_ALL)
+def review_commit(commit, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool, parallel_reviews=1, chunk_tokens=None, compactor=None, adaptive=None, out=None, reuse=None):
+    files = commit.files
+    if compactor is not None:
+        files, report = compactor.compact(files)
+    pr_data = commit_review_data(commit, files)
+
+    run = ReviewRun(out)
+    with span("review", source="commit", commit=commit.label):
+        _, improved_feedback = run_ensemble(pr_data, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, parallel_reviews, partial(announce, out=out), files, "", chunk_tokens, run=run, adaptive=adaptive, reuse=reuse)
+    run.print_summary()
 
     if skip_reasoning:
         improved_feedback = remove_reasoning(improved_feedback)
+    return improved_feedback
 
-    print(f"\n\nImproved feedback:\n{improved_feedback}\n\n")
+def review_commits(lines, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning: bool, parallel_reviews=1, chunk_tokens=None, compactor=None, parallel_commits=2, adaptive=None, reuse=None):
+    # Reviews every commit of a patch series on its own, `parallel_commits` at a time. The series is
+    # parsed while the reviews run, and at most `parallel_commits` further commits are read ahead, so
+    # memory does not grow with the length of the series. The output of each commit is buffered and
+    # printed in the order of the series.
+    if not validate_models(initial_review_models + ([final_review_model] if final_review_model != "" else [])):
+        sys.exit(1)
+    warm_up_models(initial_review_models)
+
+    def print_result(commit, future, buffer):
+        improved_feedback = future.result()
+        announce(f"\n\n >>> Review of commit {commit.label}:")
+        print(buffer.getvalue(), end='')
+        print(f"\n\nImproved feedback for {commit.label}:\n{improved_feedback}\n\n")
+
+    reviewed = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=parallel_commits) as executor:
+        for commit in parse_patch_series(lines):
+            buffer = io.StringIO()
+            future = executor.submit(review_commit, commit, code_review_agent, feedback_improver_agent, initial_review_models, final_review_model, skip_reasoning, parallel_reviews, chunk_tokens, compactor, adaptive, buffer, reuse)
+            pending.append((commit, future, buffer))
+            reviewed += 1
+            while len(pending) > parallel_commits:
+                print_result(*pending.popleft())
+        while pending:
+            print_result(*pending.popleft())
+
+    print(f"Reviewed {reviewed} commit(s)")
+    if reuse is not None:
+        reuse.print_stats()
@@ -0,0 +1,94 @@
+import threading
+from contextlib import contextmanager
+
+from metrics import GENERATIONS_CANCELLED
+
+class ReviewCancelled(Exception):
+    pass
+
+class ReviewRun:
+    # Collects the generations of one review (all stages) to report on them at the end
+    def __init__(self, out=None, scheduler=None):
+        # Where the output of the review goes (default: stdout), e.g. a buffer for concurrent reviews
+        self.out = out
+        # Orders the generations of several reviews by model (see batch.ModelScheduler)
+        self.scheduler = scheduler
+        self.generations = []
+        self.cached = 0
+        self.calls_saved = 0
+        self.cancelled = threading.Event()
+        # Open streams of the generations in progress, closed when the review is cancelled
+        self._streams = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        # Stops the review: generations in progress are aborted by closing their streams to Ollama,
+        # further generations are not started. Returns the number of aborted generations.
+        with self._lock:
+            self.cancelled.set()
+            streams = list(self._streams)
+        for stream in streams:
+            stream.close()
+        GENERATIONS_CANCELLED.inc(len(streams))
+        return len(streams)
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise ReviewCancelled("Review was cancelled")
+
+    @contextmanager
+    def tracking(self, stream):
+        # Registers a generation stream so that `cancel` can close it. Reading a stream that was
+        # closed underneath may fail in any way or just end early, so both become ReviewCancelled.
+        self.check_cancelled()
+        with self._lock:
+            self._streams.add(stream)
+        try:
+            yield stream
+        except Exception:
+            self.check_cancelled()
+            raise
+        finally:
+            with self._lock:
+                self._streams.discard(stream)
+        self.check_cancelled()
+
+    def record_generation(self, model, prompt, metrics, estimated_tokens=None):
+        with self._lock:
+            self.generations.append({
+                "model": model,
+                "prompt_chars": len(prompt),
+                # Prompt tokens estimated by the planning.GenerationPlanner, next to the measured ones
+                "estimated_prompt_tokens": estimated_tokens,
+                "prompt_eval_count": metrics.get("prompt_eval_count", 0),
+                "eval_count": metrics.get("eval_count", 0),
+                "total_duration": metrics.get("total_duration", 0),
+            })
+
+    def record_cached(self, model):
+        with self._lock:
+            self.cached += 1
+
+    def record_calls_saved(self, count):
+        with self._lock:
+            self.calls_saved += count
+
+    def prompt_tokens_saved(self):
+        # Ollama reports only the prompt tokens it had to evaluate; a prefix that was still in
+        # its KV cache is not counted. The full size of a prompt is extrapolated with the highest
+        # tokens-per-character ratio seen for the model, i.e. from a fully evaluated prompt.
+        with self._lock:
+            generations = list(self.generations)
+        ratios = {}
+        for g in generations:
+            if g["prompt_chars"]:
+                ratios[g["model"]] = max(ratios.get(g["model"], 0), g["prompt_eval_count"] / g["prompt_chars"])
+        return sum(max(round(g["prompt_chars"] * ratios.get(g["model"], 0)) - g["prompt_eval_count"], 0) for g in generations)
+
+    def print_summary(self):
+        evaluated = sum(g["prompt_eval_count"] for g in self.generations)
+        estimated = sum(g["estimated_prompt_tokens"] or 0 for g in self.generations)
+        generated = sum(g["eval_count"] for g in self.generations)
+        print(f"Review: {len(self.generations)} generation(s), {self.cached} cached response(s), {self.calls_saved} LLM call(s) saved, "
+              f"{evaluated} prompt tokens evaluated (~{estimated} estimated), ~{self.prompt_tokens_saved()} prompt tokens reused from the KV cache, "
+              f"{generated} tokens generated", file=self.out)
@@ -1,18 +1,275 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from utils import estimate_tokens, remove_reasoning
+
+DEFAULT_SESSIONS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pearbot", "sessions.sqlite3")
+# Messages kept in a session; older ones are folded into its summary
+MAX_HISTORY_MESSAGES = 20
+# Latest messages that are sent back to the model as they are, the older ones only as a summary
+HISTORY_KEEP = 2
+MAX_SUMMARY_CHARS = 2000
+FOLDED_MESSAGE_CHARS = 300
+
+def fold_messages(summary, messages):
+    # Summary without the model: the start of every message, keeping the latest MAX_SUMMARY_CHARS characters
+    lines = [f"- {message['role']}: {' '.join(message['content'].split())[:FOLDED_MESSAGE_CHARS]}" for message in messages]
+    return "\n".join(([summary] if summary else []) + lines)[-MAX_SUMMARY_CHARS:]
+
+def model_summarizer(model, run=None):
+    # Summarizes the earlier conversation with a model, as part of the ReviewRun `run` (which can cancel
+    # it), falling back to fold_messages when the generation fails
+    def summarize(summary, messages):
+        import backends
+        import planning
+        from metrics import observe_generation
+        from prompt_templates import load_prompts
+
+        conversation = "\n\n".join(f"{message['role']}:\n{message['content']}" for message in messages)
+        prompt = load_prompts()["history_summary"].format(summary=summary or "(none)", conversation=conversation)
+        if run is not None:
+            run.check_cancelled()
+        plan = planning.planner.plan(model, prompt, "history_summary")
+        try:
+            response, metrics = backends.pool.generate(plan.apply({"model": model, "prompt": prompt}), tracker=run.tracking if run is not None else None)
+        except backends.BackendError as e:
+            print(f"Could not summarize the conversation with {model}: {e}")
+            return fold_messages(summary, messages)
+        observe_generation(model, "history_summary", metrics)
+        planning.planner.record(plan, metrics)
+        if run is not None:
+            run.record_generation(model, prompt, metrics, plan.estimated_tokens)
+        return remove_reasoning(response).strip()[:MAX_SUMMARY_CHARS]
+    return summarize
+
+def history_tokens(summary, messages):
+    return (estimate_tokens(summary) if summary else 0) + sum(estimate_tokens(message["content"]) for message in messages)
+
 class PRSession:
-    def __init__(self, pr_number, repo_full_name):
+    def __init__(self, pr_number, repo_full_name, store=None):
         self.pr_number = pr_number
         self.repo_full_name = repo_full_name
+        self.store = store
         self.conversation_history = []
+        # Summary of the messages that were dropped from the history
+        self.summary = ""
+        self.last_reviewed_sha = None
+        # Review units of the last review: files (with a fingerprint of their changes) and the initial reviews covering them
+        self.review_units = []
+        self.updated_at = time.time()
+        self.lock = threading.RLock()
+
+    def to_dict(self):
+        return {
+            "history": self.conversation_history,
+            "summary": self.summary,
+            "last_reviewed_sha": self.last_reviewed_sha,
+            "review_units": self.review_units,
+        }
+
+    @classmethod
+    def from_dict(cls, pr_number, repo_full_name, data, store=None):
+        session = cls(pr_number, repo_full_name, store)
+        session.conversation_history = data["history"]
+        session.summary = data["summary"]
+        session.last_reviewed_sha = data["last_reviewed_sha"]
+        session.review_units = data["review_units"]
+        return session
+
+    def _changed(self):
+        self.updated_at = time.time()
+        if self.store is not None:
+            self.store.save(self)
 
     def add_message(self, role, content):
-        self.conversation_history.append({"role": role, "content": content})
+        with self.lock:
+            self.conversation_history.append({"role": role, "content": content})
+            if len(self.conversation_history) > MAX_HISTORY_MESSAGES:
+                dropped = self.conversation_history[:-MAX_HISTORY_MESSAGES]
+                self.conversation_history = self.conversation_history[-MAX_HISTORY_MESSAGES:]
+                self.summary = fold_messages(self.summary, dropped)
+            self._changed()
 
     def get_conversation_history(self):
         return self.conversation_history
 
-pr_sessions = {}
+    def history(self, max_tokens, summarize=None):
+        # Messages to send back to the model, dropping the oldest to fit in `max_tokens`. When the
+        # history does not fit, the messages before the latest HISTORY_KEEP are folded into the summary
+        # (by the model with `summarize`), without holding the lock during the generation.
+        with self.lock:
+            summary = self.summary
+            messages = list(self.conversation_history)
+        older = messages[:-HISTORY_KEEP]
+        if older and history_tokens(summary, messages) > max_tokens:
+            summary = (summarize or fold_messages)(summary, older)
+            messages = messages[-HISTORY_KEEP:]
+            with self.lock:
+                # Unless the history was changed in the meantime
+                if self.conversation_history[:len(older) + len(messages)] == older + messages:
+                    self.summary = summary
+                    self.conversation_history = self.conversation_history[len(older):]
+                    self._changed()
+        messages = ([{"role": "summary", "content": summary}] if summary else []) + messages
+        while messages and history_tokens("", messages) > max_tokens:
+            messages.pop(0)
+        return messages
+
+    def valid_review_units(self, fingerprints):
+        # Units restricted to their files that are still part of the PR with unchanged changes.
+        # Findings on the other files of a unit are outdated, those files are reviewed again.
+        units = []
+        for unit in self.review_units:
+            valid = [path for path, fingerprint in unit["files"].items() if fingerprints.get(path) == fingerprint]
+            if not valid:
+                continue
+            outdated = sorted((set(unit["files"]) - set(valid)) | set(unit.get("outdated_paths", [])))
+            units.append(dict(unit, paths=valid, outdated_paths=outdated))
+        return units
+
+    def record_review(self, head_sha, units, fingerprints):
+        with self.lock:
+            self.last_reviewed_sha = head_sha
+            # Files that were reviewed again are no longer outdated in the earlier units
+            reviewed = {path for unit in units for path in unit["paths"]}
+            self.review_units = []
+            for unit in units:
+                unit = dict(unit, files={path: fingerprints[path] for path in unit["paths"]})
+                if unit.get("outdated_paths"):
+                    unit["outdated_paths"] = [path for path in unit["outdated_paths"] if path not in reviewed]
+                self.review_units.append(unit)
+            self._changed()
+
+class SessionStore:
+    """Sessions of Pull Requests by repository and number.
+
+    Every change of a session is written to a SQLite database at `path`, so sessions can be
+    dropped from memory at any time: the least recently used ones go when there are more
+    than `max_sessions` or they take more than `max_bytes`, and any session that was not used
+    for `idle_seconds`. Sessions checked out by a review stay in memory until it is done,
+    so that concurrent reviews of a Pull Request share one session. Dropped sessions are
+    loaded again when they are used; sessions that were not changed for `max_age_days` are
+    deleted.
+    """
+
+    def __init__(self, path=DEFAULT_SESSIONS_PATH, max_sessions=256, max_bytes=64 * 1024 * 1024, idle_seconds=3600, max_age_days=30):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.loaded = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        # Size of the stored data of every session in memory
+        self._sizes = {}
+        self._used_at = {}
+        # Number of reviews that checked out each session
+        self._pins = Counter()
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # The database is opened on first use
+        if self._db is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    repo TEXT NOT NULL,
+                    pr_number INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (repo, pr_number)
+                )""")
+            self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.max_age_seconds,))
+            self._db.commit()
+        return self._db
+
+    def get(self, repo_full_name, pr_number, pin=False):
+        key = (repo_full_name, pr_number)
+        now = time.time()
+        with self._lock:
+            if pin:
+                self._pins[key] += 1
+            session = self._sessions.get(key)
+            if session is None:
+                row = self._connect().execute("SELECT data FROM sessions WHERE repo = ? AND pr_number = ?", key).fetchone()
+                if row is not None:
+                    session = PRSession.from_dict(pr_number, repo_full_name, json.loads(row[0]), self)
+                    self._sizes[key] = len(row[0])
+                    self.loaded += 1
+                else:
+                    session = PRSession(pr_number, repo_full_name, self)
+                    self._sizes[key] = 0
+                self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            self._used_at[key] = now
+            self._evict(now)
+            return session
+
+    @contextmanager
+    def checkout(self, repo_full_name, pr_number):
+        # The session, kept in memory while it is checked out
+        session = self.get(repo_full_name, pr_number, pin=True)
+        try:
+            yield session
+        finally:
+            with self._lock:
+                key = (repo_full_name, pr_number)
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+                self._evict(time.time())
+
+    def save(self, session):
+        key = (session.repo_full_name, session.pr_number)
+        data = json.dumps(session.to_dict())
+        with self._lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", key + (data, session.updated_at))
+            db.commit()
+            if self._sessions.get(key) is session:
+                self._sizes[key] = len(data)
+                self._evict(time.time())
+
+    def _evict(self, now):
+        total = sum(self._sizes.values())
+        for key in list(self._sessions):
+            if len(self._sessions) <= 1:
+                break
+            if len(self._sessions) <= self.max_sessions and total <= self.max_bytes and now - self._used_at[key] <= self.idle_seconds:
+                break
+            if self._pins[key]:
+                continue
+            del self._sessions[key]
+            del self._used_at[key]
+            total -= self._sizes.pop(key)
+            self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            return {"in_memory": len(self._sessions), "bytes": sum(self._sizes.values()), "loaded": self.loaded, "evicted": self.evicted}
+
+sessions = SessionStore()
+
+def configure_sessions(path=DEFAULT_SESSIONS_PATH, max_sessions=256, max_bytes=64 * 1024 * 1024, idle_seconds=3600):
+    global sessions
+    sessions = SessionStore(path, max_sessions, max_bytes, idle_seconds)
+    return sessions
+
+def file_fingerprint(file_diff):
+    return hashlib.sha256(file_diff.render().encode()).hexdigest()
 
 def get_or_create_session(pr_number, repo_full_name):
-    if pr_number not in pr_sessions:
-        pr_sessions[pr_number] = PRSession(pr_number, repo_full_name)
-    return pr_sessions[pr_number]
+    return sessions.get(repo_full_name, pr_number)
+
+def checkout_session(pr_number, repo_full_name):
+    return sessions.checkout(repo_full_name, pr_number)
@@ -5,4 +5,8 @@ def remove_reasoning(text):
     pattern = r'^\s*<think>.*?</think>\s*'
     # Use re.sub with re.DOTALL to match across multiple lines
     result = re.sub(pattern, '', text, flags=re.DOTALL)
-    return result
\ No newline at end of file
+    return result
+
+def estimate_tokens(text):
+    # Rough estimate for code and English prose (~4 characters per token)
+    return len(text) // 4 + 1
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# Modules in src/ import each other by their bare names (see src/pearbot.py)
+SRC_DIR = str(Path(__file__).parent.parent / "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
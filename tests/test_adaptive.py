@@ -0,0 +1,52 @@
+import pytest
+
+from adaptive import AdaptiveEnsemble, similarity
+from diffs import parse_diff
+from ensemble import run_ensemble
+from review_run import ReviewRun
+
+DIFF = "diff --git a/app.py b/app.py\n--- a/app.py\n+++ b/app.py\n@@ -1,1 +1,1 @@\n-x = compute(values)\n+x = compute(values, cache=True)\n"
+
+class FakeAgent:
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def fits(self, data, model):
+        return True
+
+    def analyze(self, data, model, out=None, run=None, slot=0):
+        self.calls.append(model)
+        return "", self.responses[model]
+
+def review(responses, adaptive):
+    reviewer = FakeAgent(responses)
+    improver = FakeAgent({"final": "improved"})
+    run = ReviewRun()
+    _, files = parse_diff(DIFF)
+    pr_data = {"title": "Test", "description": "", "changes": DIFF, "context": ""}
+    _, feedback = run_ensemble(pr_data, reviewer, improver, ["a", "b", "c", "d"], "final", 1, lambda message: None, files, "", 10000, run=run, adaptive=adaptive)
+    return reviewer.calls, improver.calls, feedback, run
+
+def test_stops_when_reviews_agree():
+    """Test that no further initial reviews are requested once the first reviews agree."""
+    agreeing = "The compute call ignores the cache argument when values is empty."
+    responses = {"a": agreeing, "b": agreeing + " Please fix.", "c": "unrelated", "d": "unrelated"}
+    calls, improver_calls, feedback, run = review(responses, AdaptiveEnsemble(small_diff_tokens=0))
+    assert calls == ["a", "b"]
+    assert improver_calls == ["final"]
+    assert run.calls_saved == 2
+
+    disagreeing = {"a": "Rename the variable x.", "b": "Caching breaks thread safety in compute.", "c": "Caching breaks thread safety.", "d": "never"}
+    calls, _, _, run = review(disagreeing, AdaptiveEnsemble(small_diff_tokens=0))
+    assert calls == ["a", "b", "c"]
+    assert run.calls_saved == 1
+
+def test_small_diff_gets_single_review():
+    """Test that a small change gets one review, returned without the improver."""
+    calls, improver_calls, feedback, run = review({"a": "Looks fine."}, AdaptiveEnsemble(small_diff_tokens=1000))
+    assert calls == ["a"]
+    assert improver_calls == []
+    assert feedback == "Looks fine."
+    assert run.calls_saved == 4
+    assert similarity("cache compute values", "compute values cache") == pytest.approx(1.0)
@@ -0,0 +1,83 @@
+import backends
+import cache
+import planning
+from agents import Agent
+from cache import ReviewCache
+from ensemble import run_initial_reviews
+
+PR_DATA = {"title": "Fix cache", "description": "Details", "changes": "diff --git a/a.py b/a.py\n+x = 1\n", "context": "Related code"}
+
+def test_prefix_stable_prompts_share_prefix():
+    """Test that both stages of the prefix_stable style start with the same rendered text, which includes the changes."""
+    reviewer = Agent("code_reviewer", prompt_style="prefix_stable")
+    improver = Agent("feedback_improver", prompt_style="prefix_stable")
+    review_prompt = reviewer._prepare_prompt(PR_DATA)
+    feedback_prompt = improver._prepare_prompt({"pr_data": PR_DATA, "initial_reviews": ["First review", "Second review"]})
+
+    prefix = reviewer._render("review", **dict(PR_DATA, context="Additional Context:\nRelated code", examples=reviewer.prompts["examples"]))
+    prefix = prefix[:prefix.index("Task:")]
+    assert review_prompt.startswith(prefix) and feedback_prompt.startswith(prefix)
+    assert PR_DATA["changes"] in prefix and "Related code" in prefix
+    assert "First review" in feedback_prompt[len(prefix):]
+
+class FakeRegistry:
+    class Info:
+        context_length = 8192
+
+    def info(self, model):
+        return self.Info()
+
+class FakePool:
+    def __init__(self, done_reason):
+        self.done_reason = done_reason
+        self.payloads = []
+
+    def generate(self, payload, tracker=None):
+        self.payloads.append(payload)
+        return f"review {len(self.payloads)}", {"done": True, "done_reason": self.done_reason}
+
+def test_truncated_responses_are_not_cached(tmp_path, monkeypatch):
+    """Test that a response cut short by the output limit is generated again instead of replayed from the cache."""
+    monkeypatch.setattr(planning, "registry", FakeRegistry())
+    monkeypatch.setattr(planning, "planner", planning.GenerationPlanner())
+    monkeypatch.setattr(cache, "get_model_digest", lambda model: None)
+    agent = Agent("code_reviewer", cache=ReviewCache(str(tmp_path / "reviews.sqlite3")))
+
+    pool = FakePool("length")
+    monkeypatch.setattr(backends, "pool", pool)
+    agent.analyze(PR_DATA, "m")
+    agent.analyze(PR_DATA, "m")
+    assert len(pool.payloads) == 2
+    assert pool.payloads[0]["options"]["num_predict"] == 1024
+
+    pool.done_reason = "stop"
+    agent.analyze(PR_DATA, "m")
+    agent.analyze(PR_DATA, "m")
+    assert len(pool.payloads) == 3
+
+def test_repeated_models_are_cached_separately(tmp_path, monkeypatch):
+    """Test that every use of a model in the ensemble gets its own review, also from the cache."""
+    monkeypatch.setattr(planning, "registry", FakeRegistry())
+    monkeypatch.setattr(planning, "planner", planning.GenerationPlanner())
+    monkeypatch.setattr(cache, "get_model_digest", lambda model: None)
+    monkeypatch.setattr(backends, "pool", FakePool("stop"))
+    agent = Agent("code_reviewer", cache=ReviewCache(str(tmp_path / "reviews.sqlite3")))
+
+    assert run_initial_reviews(agent, PR_DATA, ["m", "m", "m"], announce=lambda message: None) == ["review 1", "review 2", "review 3"]
+    assert run_initial_reviews(agent, PR_DATA, ["m", "m", "m"], announce=lambda message: None) == ["review 1", "review 2", "review 3"]
+    assert len(backends.pool.payloads) == 3
+
+def test_cache_key_ignores_sticky_context(tmp_path, monkeypatch):
+    """Test that a larger num_ctx kept from an earlier generation does not change the cache key, and cache hits plan nothing."""
+    monkeypatch.setattr(planning, "registry", FakeRegistry())
+    monkeypatch.setattr(planning, "planner", planning.GenerationPlanner())
+    monkeypatch.setattr(cache, "get_model_digest", lambda model: None)
+    monkeypatch.setattr(backends, "pool", FakePool("stop"))
+    agent = Agent("code_reviewer", cache=ReviewCache(str(tmp_path / "reviews.sqlite3")))
+
+    agent.analyze(PR_DATA, "m")
+    planning.planner.plan("m", "x" * 4 * 7000, "improver")
+    sticky = dict(planning.planner._num_ctx)
+    assert agent.analyze(PR_DATA, "m")[1] == "review 1"
+    assert len(backends.pool.payloads) == 1
+    assert planning.planner._num_ctx == sticky
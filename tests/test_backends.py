@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from backends import BackendError, BackendPool
+from review_run import ReviewCancelled, ReviewRun
+
+def start_ollama(delay=0.0, status=200, token_delay=0.0):
+    # Stand-in for an Ollama server that streams a two-token generation
+    class FakeOllama(BaseHTTPRequestHandler):
+        # Chunked like Ollama's responses, so that every line arrives on its own
+        protocol_version = "HTTP/1.1"
+        generations = 0
+        response_status = status
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            type(self).generations += 1
+            time.sleep(delay)
+            status = self.response_status
+            self.send_response(status)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                if status == 200:
+                    port = self.server.server_address[1]
+                    for line in ({"response": f"{port} "}, {"response": "ok"}, {"done": True, "eval_count": 2}):
+                        data = json.dumps(line).encode() + b"\n"
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        self.wfile.flush()
+                        time.sleep(token_delay)
+                self.wfile.write(b"0\r\n\r\n")
+            except ConnectionError:
+                # The client closed the stream early
+                self.close_connection = True
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, FakeOllama, f"http://127.0.0.1:{server.server_address[1]}"
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(**kwargs):
+        server, handler, url = start_ollama(**kwargs)
+        started.append(server)
+        return handler, url
+
+    yield start
+    for server in started:
+        server.shutdown()
+
+def test_generations_spread_over_backends(servers):
+    """Test that concurrent generations go to the least loaded backends."""
+    urls = [servers(delay=0.2)[1] for _ in range(3)]
+    pool = BackendPool(urls)
+    streams = [pool.stream_generate({"model": "m", "prompt": "p"}) for _ in range(3)]
+
+    assert sorted(stream.backend.url for stream in streams) == sorted(urls)
+    for stream in streams:
+        stream.close()
+    assert all(backend.in_flight == 0 for backend in pool.backends)
+
+def test_failed_backend_is_retried_elsewhere(servers):
+    """Test that a failing backend is marked unhealthy and the generation retried on another one."""
+    _, failing = servers(status=500)
+    _, working = servers()
+    pool = BackendPool([failing, working])
+
+    response, metrics = pool.generate({"model": "m", "prompt": "p"})
+    assert response.endswith("ok") and metrics["eval_count"] == 2
+    assert pool.backends[0].failures == 1 and not pool.backends[0].healthy
+    # The unhealthy backend is avoided from now on
+    assert pool.stream_generate({"model": "m", "prompt": "p"}).backend.url == working
+
+def test_single_backend_recovers(servers):
+    """Test that the only backend is healthy again once a request to it succeeds."""
+    handler, url = servers(status=500)
+    pool = BackendPool([url], retries=0)
+    with pytest.raises(BackendError):
+        pool.generate({"model": "m", "prompt": "p"})
+    assert not pool.backends[0].healthy
+
+    handler.response_status = 200
+    response, _ = pool.generate({"model": "m", "prompt": "p"})
+    assert response.endswith("ok") and pool.backends[0].healthy
+
+def test_slow_backend_is_hedged(servers):
+    """Test that a second backend is asked when the first one is slow to respond."""
+    slow_handler, slow = servers(delay=2)
+    _, fast = servers()
+    pool = BackendPool([slow, fast], hedge_after=0.2)
+
+    start = time.time()
+    with pool.stream_generate({"model": "m", "prompt": "p"}) as stream:
+        assert stream.backend.url == fast
+    assert time.time() - start < 1.5
+    assert pool.hedged == 1
+
+def test_cancelled_review_aborts_generation(servers):
+    """Test that cancelling a review closes the stream of its generation in progress."""
+    _, url = servers(token_delay=2)
+    pool = BackendPool([url])
+    run = ReviewRun()
+    errors = []
+
+    def generate():
+        try:
+            pool.generate({"model": "m", "prompt": "p"}, tracker=run.tracking)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=generate)
+    start = time.time()
+    thread.start()
+    time.sleep(0.3)
+    assert run.cancel() == 1
+    thread.join(timeout=5)
+    assert time.time() - start < 1.5
+    assert len(errors) == 1 and isinstance(errors[0], ReviewCancelled)
+    assert pool.backends[0].in_flight == 0
@@ -54,3 +54,11 @@ def test_server_startup():
 
     # Exit code 124 means timeout (expected), 0 means success, anything else is failure
     assert result.returncode in [0, 124], f"Server startup failed with exit code {result.returncode}: {result.stderr}"
+
+def test_local_startup_is_lazy():
+    """Test that importing pearbot does not import the server stack, the ollama package or PyYAML."""
+    code = "import sys; import pearbot; print(sorted({'flask', 'jwt', 'ollama', 'yaml', 'review_github', 'github_client'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd='src')
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import batch
+from batch import BatchUnit, run_batch
+from diffs import parse_diff
+
+DIFF = "diff --git a/app.py b/app.py\n--- a/app.py\n+++ b/app.py\n@@ -1,1 +1,1 @@\n-x = 1\n+x = 2\n"
+
+class FakeAgent:
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.Lock()
+
+    def fits(self, data, model):
+        return True
+
+    def analyze(self, data, model, out=None, run=None, slot=0):
+        with run.scheduler.slot(model):
+            with self.lock:
+                self.log.append(model)
+            time.sleep(0.01)
+        run.record_generation(model, "", {"eval_count": 10})
+        return "", f"review by {model}"
+
+def test_batch_groups_generations_by_model(monkeypatch, capsys):
+    """Test that the generations of all units run in model-contiguous waves."""
+    monkeypatch.setattr(batch, "validate_models", lambda models: True)
+    log = []
+    units = []
+    for i in range(4):
+        _, files = parse_diff(DIFF)
+        units.append(BatchUnit(f"unit {i}", {"title": f"Unit {i}", "description": "", "changes": DIFF, "context": ""}, files))
+
+    runs = run_batch(units, FakeAgent(log), FakeAgent(log), ["a", "b"], "final", False, parallel=2, max_units=4, chunk_tokens=10000)
+
+    # One wave per model instead of switching models within every unit
+    assert len(runs) == 4
+    assert sorted(log) == ["a"] * 4 + ["b"] * 4 + ["final"] * 4
+    assert log[-4:] == ["final"] * 4
+    changes = sum(1 for previous, model in zip(log, log[1:]) if model != previous)
+    assert changes == 2
+    output = capsys.readouterr().out
+    assert "Model loads: 3 (~12 when reviewed one after another, ~9 avoided)" in output
+    assert output.index("Improved feedback for unit 0") < output.index("Improved feedback for unit 3")
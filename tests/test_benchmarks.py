@@ -0,0 +1,26 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+def test_benchmark_smoke(tmp_path):
+    """Test that the benchmark runs both review modes against the mock servers and writes its results."""
+    output = tmp_path / "results.json"
+    result = subprocess.run(
+        [sys.executable, str(ROOT / "benchmarks" / "run_benchmarks.py"), "--sizes", "1", "--token-rate", "5000", "--latency", "0", "--output", str(output)],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+        timeout=120
+    )
+
+    assert result.returncode == 0, result.stderr
+    results = json.loads(output.read_text())["results"]
+    assert [r["mode"] for r in results] == ["local", "github"]
+    for r in results:
+        # Three initial reviews and the final review
+        assert r["llm_calls"] == 4
+        assert r["time_to_first_token_seconds"] is not None
+        assert r["cpu_seconds"] > 0
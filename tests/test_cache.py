@@ -0,0 +1,43 @@
+import time
+
+import cache
+from cache import ReviewCache
+
+def test_cache_hit_miss_and_digest(tmp_path, monkeypatch):
+    """Test that cached responses are returned until the model digest changes."""
+    digests = {"llama3.1": "sha256:aaa"}
+    monkeypatch.setattr(cache, "get_model_digest", lambda model: digests[model])
+    review_cache = ReviewCache(str(tmp_path / "reviews.sqlite3"))
+
+    key = review_cache.key("llama3.1", "default", "prompt")
+    assert review_cache.get(key) is None
+    review_cache.put(key, "llama3.1", "review")
+    assert review_cache.get(review_cache.key("llama3.1", "default", "prompt")) == "review"
+    assert review_cache.get(review_cache.key("llama3.1", "simple", "prompt")) is None
+
+    digests["llama3.1"] = "sha256:bbb"
+    assert review_cache.get(review_cache.key("llama3.1", "default", "prompt")) is None
+    assert (review_cache.hits, review_cache.misses) == (1, 3)
+
+def test_cache_eviction(tmp_path, monkeypatch):
+    """Test that the least recently used entries are evicted when the cache exceeds its size."""
+    monkeypatch.setattr(cache, "get_model_digest", lambda model: None)
+    review_cache = ReviewCache(str(tmp_path / "reviews.sqlite3"), max_bytes=250)
+
+    for i in range(3):
+        review_cache.put(f"key{i}", "m", "x" * 100)
+        time.sleep(0.01)
+    assert review_cache.get("key0") is None
+    assert review_cache.get("key2") == "x" * 100
+    assert review_cache.stats()["entries"] == 2
+
+    review_cache.purge()
+    assert review_cache.stats()["entries"] == 0
+
+def test_generation_options_are_part_of_the_key(tmp_path, monkeypatch):
+    """Test that a response generated with other options, e.g. a smaller output limit, is not reused."""
+    monkeypatch.setattr(cache, "get_model_digest", lambda model: None)
+    review_cache = ReviewCache(str(tmp_path / "reviews.sqlite3"))
+    review_cache.put(review_cache.key("m", "default", "prompt", {"num_ctx": 4096, "num_predict": 256}), "m", "review")
+    assert review_cache.get(review_cache.key("m", "default", "prompt", {"num_predict": 256, "num_ctx": 4096})) == "review"
+    assert review_cache.get(review_cache.key("m", "default", "prompt", {"num_ctx": 4096, "num_predict": 1024})) is None
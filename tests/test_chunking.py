@@ -0,0 +1,57 @@
+from chunking import build_chunks
+from diffs import FileDiff, parse_diff
+from utils import estimate_tokens
+
+def make_diff(files=5, hunks=4, lines=20):
+    diff = "From 1234567 Mon Sep 17 00:00:00 2001\nSubject: [PATCH] Test\n\n"
+    for f in range(files):
+        diff += f"diff --git a/file{f}.py b/file{f}.py\nindex 1111111..2222222 100644\n--- a/file{f}.py\n+++ b/file{f}.py\n"
+        for h in range(hunks):
+            diff += f"@@ -{h * 100},{lines} +{h * 100},{lines} @@ def func{h}():\n"
+            diff += "".join(f"+    value_{f}_{h}_{i} = compute({i})\n" for i in range(lines))
+    return diff
+
+def test_parse_diff_round_trip():
+    """Test that parsing a diff into files and hunks keeps every line."""
+    diff = make_diff()
+    preamble, files = parse_diff(diff)
+
+    assert preamble.startswith("From 1234567")
+    assert [f.path for f in files] == [f"file{i}.py" for i in range(5)]
+    assert all(len(f.hunks) == 4 for f in files)
+    assert preamble + "".join(f.render() for f in files) == diff
+
+def test_chunks_respect_budget_and_keep_all_lines():
+    """Test that chunks stay within the token budget and no changed line is dropped."""
+    _, files = parse_diff(make_diff())
+    chunks = build_chunks(files, 400)
+
+    assert len(chunks) > 1
+    assert all(estimate_tokens(chunk.text) <= 400 + 50 for chunk in chunks)
+    added = [line for chunk in chunks for line in chunk.text.splitlines() if line.startswith("+    ")]
+    assert len(added) == 5 * 4 * 20
+    # Files split over several chunks repeat their header
+    for chunk in chunks:
+        for path in chunk.paths:
+            assert f"diff --git a/{path} b/{path}" in chunk.text
+
+def test_oversized_hunk_is_split_on_lines():
+    """Test that a single hunk larger than the budget is split instead of truncated."""
+    _, files = parse_diff(make_diff(files=1, hunks=1, lines=200))
+    chunks = build_chunks(files, 300)
+
+    assert len(chunks) > 1
+    added = [line for chunk in chunks for line in chunk.text.splitlines() if line.startswith("+    ")]
+    assert len(added) == 200
+    assert "(continued)" in chunks[1].text
+
+def test_oversized_header_without_hunks():
+    """Test that text without hunks, like long commit messages, is split on lines when it is over the budget."""
+    messages = "".join(f"Commit message line {i} explaining the change\n" for i in range(100))
+    _, files = parse_diff(make_diff(files=1, hunks=1, lines=5))
+    chunks = build_chunks([FileDiff("(commit messages)", messages)] + files, 200)
+
+    assert len(chunks) > 1
+    assert "".join(chunk.text for chunk in chunks).count("Commit message line") == 100
+    # A single line over the budget is kept as a whole
+    assert build_chunks([FileDiff("(commit messages)", "x" * 4000)], 200)[0].text == "x" * 4000
@@ -0,0 +1,83 @@
+import subprocess
+
+from code_index import CodeIndex, ContextBuilder
+from diffs import parse_diff
+
+HELPERS = '''def normalize(text):
+    return text.strip().lower()
+
+def unrelated():
+    return 42
+'''
+
+MAIN = '''from helpers import normalize
+
+class Greeter:
+    def greet(self, name):
+        return "Hello " + name
+'''
+
+DIFF = '''diff --git a/main.py b/main.py
+--- a/main.py
++++ b/main.py
+@@ -4,2 +4,2 @@ class Greeter:
+     def greet(self, name):
+-        return "Hello " + name
++        return "Hello " + normalize(name)
+'''
+
+def git(repo, *args):
+    subprocess.run(["git", "-C", str(repo), "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args), check=True, capture_output=True)
+
+def test_context_of_a_change(tmp_path):
+    """Test that the context holds the enclosing definition and the definitions used by the change."""
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "helpers.py").write_text(HELPERS)
+    (repo / "main.py").write_text(MAIN)
+    git(repo, "init", "-q")
+    git(repo, "add", ".")
+    git(repo, "commit", "-qm", "Initial commit")
+    head = subprocess.run(["git", "-C", str(repo), "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+
+    index = CodeIndex(str(repo), str(tmp_path / "index.json"))
+    _, files = parse_diff(DIFF)
+    context = ContextBuilder(index).build(files)
+    assert "main.py:4-5 (function greet, encloses the change)" in context
+    assert "def normalize(text):" in context
+    assert "unrelated" not in context
+    assert index.parsed == 2
+
+    # Only changed files are parsed again, and the index is kept on disk
+    (repo / "helpers.py").write_text(HELPERS + "\ndef added():\n    pass\n")
+    index = CodeIndex(str(repo), str(tmp_path / "index.json"))
+    index.refresh()
+    assert index.parsed == 1
+    assert [symbol.name for symbol in index.symbols("helpers.py")] == ["normalize", "unrelated", "added"]
+
+    # A commit is indexed from its blobs, without the changes of the working tree
+    index.refresh(head)
+    assert index.parsed == 0
+    assert [symbol.name for symbol in index.symbols("helpers.py")] == ["normalize", "unrelated"]
+    assert index.lines("helpers.py")[0] == "def normalize(text):"
+
+def test_missing_commit_is_fetched_or_skipped(tmp_path):
+    """Test that the context of a commit missing from the repository is fetched, and never taken from its working tree."""
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "helpers.py").write_text(HELPERS)
+    (repo / "main.py").write_text(MAIN)
+    git(repo, "init", "-q")
+    git(repo, "add", ".")
+    git(repo, "commit", "-qm", "Initial commit")
+    git(tmp_path, "clone", "-q", str(repo), "clone")
+    (repo / "main.py").write_text(MAIN + "\n")
+    git(repo, "commit", "-qam", "Change")
+    git(repo, "update-ref", "refs/pull/1/head", "HEAD")
+    head = subprocess.run(["git", "-C", str(repo), "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+
+    builder = ContextBuilder(CodeIndex(str(tmp_path / "clone"), str(tmp_path / "index.json")))
+    _, files = parse_diff(DIFF)
+    assert builder.build(files, head) == ""
+    assert builder.build(files, head, fetch="pull/2/head") == ""
+    assert "def normalize(text):" in builder.build(files, head, fetch="pull/1/head")
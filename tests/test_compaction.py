@@ -0,0 +1,96 @@
+from compaction import OMITTED_PATH, DiffCompactor, is_generated, is_whitespace_only, trim_context
+from diffs import parse_diff
+
+DIFF = """diff --git a/package-lock.json b/package-lock.json
+index 1111111..2222222 100644
+--- a/package-lock.json
++++ b/package-lock.json
+@@ -1,3 +1,3 @@
+ {
+-  "version": "1.0.0"
++  "version": "1.0.1"
+ }
+diff --git a/src/old.py b/src/new.py
+similarity index 100%
+rename from src/old.py
+rename to src/new.py
+diff --git a/src/style.py b/src/style.py
+index 3333333..4444444 100644
+--- a/src/style.py
++++ b/src/style.py
+@@ -1,2 +1,2 @@
+-def f(a, b):\t
++def f(a, b):
+     return a
+diff --git a/src/app.py b/src/app.py
+index 5555555..6666666 100644
+--- a/src/app.py
++++ b/src/app.py
+@@ -10,9 +10,9 @@ def main():
+ line10
+ line11
+ line12
+ line13
+-line14
++line14 changed
+ line15
+ line16
+ line17
+ line18
+diff --git a/src/build/rules.py b/src/build/rules.py
+index 7777777..8888888 100644
+--- a/src/build/rules.py
++++ b/src/build/rules.py
+@@ -1,2 +1,2 @@
+ if x:
+-        return 1
++    return 1
+"""
+
+def test_compaction_omits_and_summarizes():
+    """Test that generated, renamed and whitespace-only files are omitted and listed in a summary."""
+    _, files = parse_diff(DIFF)
+    compacted, report = DiffCompactor(context_lines=1).compact(files)
+
+    # Indentation changes and source under a nested build/ directory are kept
+    assert [file_diff.path for file_diff in compacted] == ["src/app.py", "src/build/rules.py", OMITTED_PATH]
+    assert dict(report.omitted) == {
+        "package-lock.json": "generated or vendored",
+        "src/new.py": "renamed without changes",
+        "src/style.py": "whitespace-only changes",
+    }
+    assert "src/new.py (renamed without changes)" in compacted[-1].render()
+    assert compacted[0].hunks == ["@@ -13,3 +13,3 @@ def main():\n line13\n-line14\n+line14 changed\n line15\n"]
+    assert report.tokens_saved > 0
+
+def test_trim_context_splits_hunks():
+    """Test that distant changes in one hunk become separate hunks with correct line numbers."""
+    hunk = "@@ -1,8 +1,8 @@\n-a\n+A\n b\n c\n d\n e\n f\n-g\n+G\n h\n"
+    assert trim_context(hunk, 1) == [
+        "@@ -1,2 +1,2 @@\n-a\n+A\n b\n",
+        "@@ -6,3 +6,3 @@\n f\n-g\n+G\n h\n",
+    ]
+
+def test_ignore_globs_and_token_budget():
+    """Test that ignored files and files beyond the token budget are omitted."""
+    _, files = parse_diff(DIFF)
+    compacted, report = DiffCompactor(ignore_globs=["src/app.py"], max_tokens=1).compact(files[:1] + files[3:], "\n---\n")
+    assert [file_diff.path for file_diff in compacted] == [OMITTED_PATH]
+    assert dict(report.omitted)["src/app.py"] == "ignored"
+
+    compacted, report = DiffCompactor(max_tokens=1, detect_generated=False).compact(files[:1])
+    assert dict(report.omitted) == {"package-lock.json": "over the token budget"}
+
+def test_whitespace_and_generated_detection():
+    """Test that only trailing whitespace counts as whitespace-only, and that top-level build output and files with a generator header are generated."""
+    assert is_whitespace_only("@@ -1,1 +1,1 @@\n-x = 1  \r\n+x = 1\n")
+    assert not is_whitespace_only("@@ -1,2 +1,2 @@\n if x:\n-        return 1\n+    return 1\n")
+    _, files = parse_diff("diff --git a/build/app.js b/build/app.js\n--- a/build/app.js\n+++ b/build/app.js\n@@ -1 +1 @@\n-a\n+b\n")
+    assert is_generated(files[0])
+
+    new_file = "diff --git a/{path} b/{path}\n--- /dev/null\n+++ b/{path}\n@@ -0,0 +1,2 @@\n+{first}\n+x = 1\n"
+    generated = [("gen.go", "// Code generated by stringer. DO NOT EDIT."), ("schema.py", "# @generated by schema-tool")]
+    written = [("notes.py", '"""Do not edit the auto-generated tables by hand."""'), ("util.py", "# Regenerate with make, do not edit the autogenerated part")]
+    for (path, first), expected in [(case, True) for case in generated] + [(case, False) for case in written]:
+        _, files = parse_diff(new_file.format(path=path, first=first))
+        assert is_generated(files[0]) == expected, path
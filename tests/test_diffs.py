@@ -0,0 +1,52 @@
+from diffs import parse_diff, parse_patch_series
+
+def make_patch(sha, subject_lines, path):
+    return "".join([
+        f"From {sha} Mon Sep 17 00:00:00 2001\n",
+        "From: Jane Doe <jane@example.com>\n",
+        "Date: Tue, 1 Oct 2024 10:00:00 +0200\n",
+        "".join(subject_lines),
+        "\n",
+        "Longer description\nof the change.\n",
+        "---\n",
+        f" {path} | 2 +-\n",
+        " 1 file changed, 1 insertion(+), 1 deletion(-)\n",
+        "\n",
+        f"diff --git a/{path} b/{path}\n",
+        "index 1111111..2222222 100644\n",
+        f"--- a/{path}\n",
+        f"+++ b/{path}\n",
+        "@@ -1,2 +1,2 @@\n",
+        " keep\n",
+        "-- old\n",
+        "+- new\n",
+        "-- \n",
+        "2.39.0\n",
+        "\n",
+    ])
+
+SERIES = (make_patch("a" * 40, ["Subject: [PATCH 1/2] Fix the parser for very long\n", " subjects\n"], "src/a.py")
+          + make_patch("b" * 40, ["Subject: [PATCH 2/2] Add tests\n"], "tests/test_a.py"))
+
+def test_patch_series_is_parsed_into_commits():
+    """Test that a format-patch series yields commits with folded subjects, messages and complete hunks."""
+    commits = list(parse_patch_series(iter(SERIES.splitlines(keepends=True))))
+
+    assert [commit.sha for commit in commits] == ["a" * 40, "b" * 40]
+    assert commits[0].subject == "Fix the parser for very long subjects"
+    assert commits[0].message == "Longer description\nof the change."
+    assert commits[0].headers["From"] == "Jane Doe <jane@example.com>"
+    assert [file_diff.path for file_diff in commits[1].files] == ["tests/test_a.py"]
+
+    file_diff = commits[0].files[0]
+    # The removed line "-- old" belongs to the hunk, the "-- " signature after it does not
+    assert file_diff.hunks == ["@@ -1,2 +1,2 @@\n keep\n-- old\n+- new\n"]
+    assert file_diff.footer == "-- \n2.39.0\n\n"
+    assert "".join(commit.render() for commit in commits) == SERIES
+
+def test_parse_diff_keeps_series_round_trip():
+    """Test that the flattened series still reproduces the input."""
+    preamble, files = parse_diff(SERIES)
+    assert preamble.startswith("From " + "a" * 40)
+    assert preamble + "".join(file_diff.render() for file_diff in files) == SERIES
+    assert len(files) == 2
@@ -0,0 +1,91 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from github_client import DEFAULT_RETRY_AFTER_SECONDS, GitHubAPIError, GitHubClient, retry_after_seconds
+
+PULL = {"title": "Fix bug", "body": "Details", "head": {"sha": "abc1234"}}
+DIFF = "diff --git a/a.py b/a.py\n--- a/a.py\n+++ b/a.py\n@@ -1 +1 @@\n-a\n+b\n"
+
+class FakeGitHub(BaseHTTPRequestHandler):
+    requests = []
+    # Installation tokens that were revoked
+    revoked = set()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.requests.append(("POST", self.path, dict(self.headers)))
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/access_tokens"):
+            tokens = sum(1 for request in self.requests if request[1].endswith("/access_tokens"))
+            self.reply(201, json.dumps({"token": f"ghs_{tokens}", "expires_at": "2999-01-01T00:00:00Z"}).encode())
+        else:
+            self.reply(201, json.dumps({"id": 1}).encode())
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path, dict(self.headers)))
+        if self.headers.get("Authorization", "").split()[-1] in self.revoked:
+            self.reply(401, b'{"message": "Bad credentials"}')
+        elif self.headers.get("Accept") == "application/vnd.github.v3.diff":
+            self.reply(200, DIFF.encode())
+        elif self.headers.get("If-None-Match") == '"v1"':
+            self.reply(304)
+        else:
+            self.reply(200, json.dumps(PULL).encode(), {"ETag": '"v1"', "X-RateLimit-Remaining": "4999", "X-RateLimit-Reset": "0"})
+
+@pytest.fixture
+def github_client():
+    FakeGitHub.requests = []
+    FakeGitHub.revoked = set()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGitHub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    yield GitHubClient("1", pem, base_url=f"http://127.0.0.1:{server.server_address[1]}")
+    server.shutdown()
+
+def test_token_is_cached_and_etag_revalidated(github_client):
+    """Test that the installation token is requested once and unchanged resources are revalidated."""
+    for _ in range(3):
+        assert github_client.get_pull("org/repo", 1, 42)["title"] == "Fix bug"
+
+    token_requests = [r for r in FakeGitHub.requests if r[1].endswith("/access_tokens")]
+    assert len(token_requests) == 1
+    assert github_client.not_modified == 2
+    assert FakeGitHub.requests[-1][2]["Authorization"] == "token ghs_1"
+
+def test_revoked_token_is_requested_again(github_client):
+    """Test that a token the API rejects is dropped and a new one is requested, once."""
+    assert github_client.get_pull("org/repo", 1, 42)["title"] == "Fix bug"
+    FakeGitHub.revoked.add("ghs_1")
+    assert github_client.get_pull("org/repo", 1, 42)["title"] == "Fix bug"
+    assert FakeGitHub.requests[-1][2]["Authorization"] == "token ghs_2"
+
+    FakeGitHub.revoked.update({"ghs_2", "ghs_3"})
+    with pytest.raises(GitHubAPIError):
+        github_client.get_pull("org/repo", 1, 42)
+
+def test_pull_diff_in_single_request(github_client):
+    """Test that the whole diff is fetched with the diff media type."""
+    assert github_client.get_pull_diff("org/repo", 1, 42) == DIFF
+    assert [r[0] for r in FakeGitHub.requests] == ["POST", "GET"]
+
+def test_retry_after_forms():
+    """Test that Retry-After is read as seconds or as an HTTP date."""
+    assert retry_after_seconds("30") == 30
+    assert retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert retry_after_seconds("soon") == DEFAULT_RETRY_AFTER_SECONDS
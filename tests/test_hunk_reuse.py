@@ -0,0 +1,78 @@
+import zlib
+
+from diffs import parse_diff
+from ensemble import run_ensemble
+from hunk_reuse import HunkReuse, HunkStore, unit_vector
+
+HUNK = "@@ -{line},2 +{line},2 @@ def handler(request):\n-    data = request.json\n+    data = request.get_json(silent={flag})\n     return {call}(data)\n"
+
+def diff(*files):
+    return "".join(f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n" + "".join(HUNK.format(line=line, flag=flag, call=call) for line, flag, call in hunks) for path, hunks in files)
+
+class FakeAgent:
+    def __init__(self):
+        self.changes = []
+
+    def fits(self, data, model):
+        return True
+
+    def analyze(self, data, model, out=None, run=None, slot=0):
+        self.changes.append(data.get("changes"))
+        return "", f"review of {model}"
+
+def embed(texts):
+    # Character trigrams hashed into buckets, similar texts get similar vectors
+    vectors = []
+    for text in texts:
+        vector = [0.0] * 64
+        for i in range(len(text) - 2):
+            vector[zlib.crc32(text[i:i + 3].encode()) % 64] += 1.0
+        vectors.append(unit_vector(vector))
+    return vectors
+
+def review(reuse, changes):
+    reviewer = FakeAgent()
+    _, files = parse_diff(changes)
+    pr_data = {"title": "Test", "description": "", "changes": changes, "context": ""}
+    units, _ = run_ensemble(pr_data, reviewer, FakeAgent(), ["a"], "", 1, lambda message: None, files, "", 10000, reuse=reuse)
+    return reviewer.changes, units
+
+def test_matching_hunks_reuse_earlier_findings(tmp_path, monkeypatch):
+    """Test that copies of a hunk are reviewed once and matching hunks of later changes are not reviewed again."""
+    reuse = HunkReuse(HunkStore(str(tmp_path)), threshold=0.9)
+    monkeypatch.setattr(reuse, "embed", embed)
+
+    # A bulk edit: the same change in two files is reviewed once
+    reviewed, units = review(reuse, diff(("a.py", [(10, "True", "process")]), ("b.py", [(20, "True", "process")])))
+    assert len(reviewed) == 1 and "b/b.py" not in reviewed[0]
+    assert units[-1] == {"paths": ["b.py"], "reviews": ["review of a"], "reused_from": "a.py"}
+
+    # A backport of the same change at other lines, and in slightly different surroundings, are not
+    # reviewed again; a change of other lines in the same surroundings is
+    reuse = HunkReuse(HunkStore(str(tmp_path)), threshold=0.9)
+    monkeypatch.setattr(reuse, "embed", embed)
+    reviewed, units = review(reuse, diff(("a.py", [(5, "True", "process")]), ("c.py", [(7, "True", "processed")]), ("d.py", [(7, "False", "process")])))
+    assert len(reviewed) == 1 and "b/d.py" in reviewed[0] and "b/c.py" not in reviewed[0]
+    assert units[0] == {"paths": ["a.py", "c.py"], "reviews": ["review of a"], "reused_from": "a.py"}
+    assert reuse.reused == {"exact": 1, "similar": 1, "copy": 0}
+
+def test_findings_of_several_files_are_not_stored(tmp_path, monkeypatch):
+    """Test that the findings of a review of several files are not reused for a change to one of them."""
+    reuse = HunkReuse(HunkStore(str(tmp_path)), threshold=0.9)
+    monkeypatch.setattr(reuse, "embed", embed)
+    review(reuse, diff(("a.py", [(10, "True", "process")]), ("b.py", [(20, "False", "process")])))
+    assert len(reuse.store) == 0
+
+    reviewed, units = review(reuse, diff(("c.py", [(10, "True", "process")])))
+    assert len(reviewed) == 1 and not any("reused_from" in unit for unit in units)
+
+def test_small_hunks_are_always_reviewed(tmp_path, monkeypatch):
+    """Test that hunks with few changed tokens, like an added import, are neither reused nor deduplicated."""
+    import_hunk = "diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n@@ -1,1 +1,2 @@\n import sys\n+import os\n"
+    for paths in (["a.py", "b.py"], ["c.py"]):
+        reuse = HunkReuse(HunkStore(str(tmp_path)), threshold=0.9)
+        monkeypatch.setattr(reuse, "embed", embed)
+        reviewed, units = review(reuse, "".join(import_hunk.format(path=path) for path in paths))
+        assert len(reviewed) == 1 and all(f"b/{path}" in reviewed[0] for path in paths)
+        assert not any("reused_from" in unit for unit in units)
+    assert len(reuse.store) == 0
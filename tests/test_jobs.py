@@ -0,0 +1,78 @@
+import threading
+import time
+
+import pytest
+
+from jobs import QueueFullError, ReviewJobQueue
+from review_run import ReviewCancelled
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            pytest.fail("Timed out waiting for condition")
+        time.sleep(0.01)
+
+def test_jobs_run_in_background():
+    """Test that submitted jobs are executed by the workers and reported as finished."""
+    job_queue = ReviewJobQueue(workers=2)
+    results = []
+    job = job_queue.submit("org/repo", 1, results.append, "done")
+
+    wait_for(lambda: job.status == "finished")
+    assert results == ["done"]
+    assert job_queue.status()["finished"][0]["id"] == job.job_id
+
+def test_backpressure_and_per_repo_limit():
+    """Test that the queue rejects jobs when full and runs one job per repository at a time."""
+    release = threading.Event()
+    job_queue = ReviewJobQueue(workers=2, max_queued=1, per_repo_limit=1)
+
+    first = job_queue.submit("org/repo", 1, release.wait)
+    wait_for(lambda: first.status == "running")
+
+    # The second job of the same repository has to wait even though a worker is idle
+    second = job_queue.submit("org/repo", 2, lambda: None)
+    time.sleep(0.1)
+    assert second.status == "queued"
+
+    with pytest.raises(QueueFullError):
+        job_queue.submit("org/other", 3, lambda: None)
+
+    release.set()
+    wait_for(lambda: second.status == "finished")
+
+def test_failed_job_does_not_stop_worker():
+    """Test that an exception in a job is recorded and the worker keeps processing."""
+    job_queue = ReviewJobQueue(workers=1)
+
+    def fail():
+        raise RuntimeError("boom")
+
+    failed = job_queue.submit("org/repo", 1, fail)
+    ok = job_queue.submit("org/repo", 2, lambda: None)
+
+    wait_for(lambda: ok.status == "finished")
+    assert failed.status == "failed"
+    assert failed.error == "boom"
+
+def test_identical_requests_are_merged():
+    """Test that a request identical to a queued job is merged into it, and cancelled jobs are reported."""
+    release = threading.Event()
+    job_queue = ReviewJobQueue(workers=1)
+
+    def cancelled():
+        release.wait()
+        raise ReviewCancelled("Review was cancelled")
+
+    first = job_queue.submit("org/repo", 1, cancelled)
+    wait_for(lambda: first.status == "running")
+    results = []
+    second = job_queue.submit("org/repo", 2, results.append, "done")
+    assert job_queue.submit("org/repo", 2, results.append, "done") is second
+    assert second.merged == 1
+
+    release.set()
+    wait_for(lambda: second.status == "finished")
+    assert results == ["done"]
+    assert first.status == "cancelled"
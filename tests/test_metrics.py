@@ -0,0 +1,36 @@
+import json
+
+import metrics
+
+def test_prometheus_exposition():
+    """Test that counters and histograms are rendered in the Prometheus text format."""
+    counter = metrics.Counter("test_tokens_total", "Tokens")
+    counter.inc(5, model="llama3.1")
+    counter.inc(2, model="llama3.1")
+    histogram = metrics.Histogram("test_seconds", "Durations", buckets=(1, 10))
+    histogram.observe(0.5, stage="fetch")
+    histogram.observe(5, stage="fetch")
+
+    lines = counter.render() + histogram.render()
+    assert "# TYPE test_tokens_total counter" in lines
+    assert 'test_tokens_total{model="llama3.1"} 7' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="1"} 1' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="10"} 2' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="+Inf"} 2' in lines
+    assert 'test_seconds_count{stage="fetch"} 2' in lines
+
+def test_spans_are_traced(tmp_path):
+    """Test that spans are observed in the stage histogram and written to the trace file."""
+    tracer = metrics.enable_tracing()
+    try:
+        with metrics.span("render", role="code_reviewer"):
+            pass
+        path = tmp_path / "trace.json"
+        tracer.write(path)
+    finally:
+        metrics.tracer = None
+
+    events = json.loads(path.read_text())["traceEvents"]
+    assert events[0]["name"] == "render"
+    assert events[0]["args"] == {"role": "code_reviewer"}
+    assert 'pearbot_stage_duration_seconds_count{stage="render"}' in metrics.render_metrics()
@@ -0,0 +1,52 @@
+import threading
+
+import backends
+import planning
+from model_registry import ModelRegistry
+from ollama_utils import validate_models, warm_up_models
+
+def test_registry_caches_listing_and_metadata(monkeypatch):
+    """Test that validating and inspecting several models costs one listing and one show per model, and a missing model one more listing."""
+    calls = {"list": 0, "show": 0}
+    models = [{"name": "llama3.1:latest", "digest": "abc"}, {"name": "qwen2.5:7b", "digest": "def"}]
+
+    class FakeClient:
+        def list(self):
+            calls["list"] += 1
+            return {"models": list(models)}
+
+        def show(self, name):
+            calls["show"] += 1
+            return {"details": {"family": "llama", "quantization_level": "Q4_0"}, "model_info": {"llama.context_length": 131072}}
+
+    registry = ModelRegistry(client=FakeClient())
+    monkeypatch.setattr("ollama_utils.registry", registry)
+
+    assert validate_models(["llama3.1", "qwen2.5:7b", "llama3.1"])
+    assert not registry.is_available("mistral")
+    for _ in range(3):
+        info = registry.info("llama3.1")
+    assert (info.digest, info.family, info.context_length, info.quantization_level) == ("abc", "llama", 131072, "Q4_0")
+    assert calls == {"list": 2, "show": 1}
+
+    # A model pulled after the listing was cached is found
+    models.append({"name": "mistral:latest", "digest": "ghi"})
+    assert registry.is_available("mistral")
+    assert calls["list"] == 3
+
+def test_warm_up_uses_configured_keep_alive(monkeypatch):
+    """Test that models are warmed up with the keep_alive the planner uses for their stage."""
+    loaded = []
+    done = threading.Event()
+
+    class FakePool:
+        def load(self, model, keep_alive=None):
+            loaded.append((model, keep_alive))
+            done.set()
+
+    monkeypatch.setattr(backends, "pool", FakePool())
+    monkeypatch.setattr(planning, "planner", planning.GenerationPlanner(keep_alive={"initial_review": "1h"}))
+    monkeypatch.setattr("ollama_utils.registry", ModelRegistry(client=None))
+    warm_up_models(["m"])
+    assert done.wait(5)
+    assert loaded == [("m", "1h")]
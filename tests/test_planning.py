@@ -0,0 +1,59 @@
+import math
+from types import SimpleNamespace
+
+import planning
+from planning import MIN_OUTPUT_TOKENS, GenerationPlanner, keep_alive_seconds
+
+class FakeRegistry:
+    class Info:
+        context_length = 8192
+
+    def info(self, model):
+        return self.Info()
+
+def test_plan_sizes_context_and_output(monkeypatch):
+    """Test that num_ctx follows the prompt within the context length and the output budget shrinks to fit."""
+    monkeypatch.setattr(planning, "registry", FakeRegistry())
+    planner = GenerationPlanner()
+
+    plan = planner.plan("m", "x" * 400, "initial_review")
+    assert (plan.num_ctx, plan.num_predict, plan.fits) == (2048, 1024, True)
+    assert plan.apply({"model": "m"}) == {"model": "m", "options": {"num_ctx": 2048, "num_predict": 1024}, "keep_alive": "10m"}
+
+    plan = planner.plan("m", "x" * 4 * 7000, "improver")
+    assert (plan.num_ctx, plan.num_predict, plan.fits) == (8192, 8192 - plan.estimated_tokens, True)
+    # The model is not loaded again with a smaller context for a smaller prompt
+    assert planner.plan("m", "x" * 400, "initial_review").num_ctx == 8192
+
+    plan = planner.plan("m", "x" * 4 * 9000, "initial_review")
+    assert not plan.fits and plan.num_predict == MIN_OUTPUT_TOKENS
+    assert not planner.fits("m", "x" * 4 * 9000)
+
+def test_estimate_is_calibrated_with_measured_tokens(monkeypatch):
+    """Test that the measured prompt tokens correct later estimates."""
+    monkeypatch.setattr(planning, "registry", FakeRegistry())
+    planner = GenerationPlanner()
+
+    plan = planner.plan("m", "x" * 400, "initial_review")
+    planner.record(plan, {"prompt_eval_count": plan.estimated_tokens * 2})
+    assert planner.estimate("m", "x" * 400) == plan.estimated_tokens * 2
+    # A later measurement with the corrected estimate keeps the correction
+    plan = planner.plan("m", "x" * 400, "initial_review")
+    planner.record(plan, {"prompt_eval_count": plan.estimated_tokens})
+    assert planner.ratio("m") == 2.0
+
+def test_num_ctx_sticks_for_the_keep_alive(monkeypatch):
+    """Test that a model keeps its num_ctx for as long as its keep_alive keeps it loaded."""
+    monkeypatch.setattr(planning, "registry", FakeRegistry())
+    assert (keep_alive_seconds("1h30m"), keep_alive_seconds(60), keep_alive_seconds("-1"), keep_alive_seconds(None)) == (5400, 60, math.inf, 300)
+
+    clock = [0]
+    monkeypatch.setattr(planning, "time", SimpleNamespace(time=lambda: clock[0]))
+    planner = GenerationPlanner(keep_alive={"initial_review": "1h"})
+    planner.plan("m", "x" * 4 * 7000, "initial_review")
+    clock[0] = 1800
+    assert planner.plan("m", "x" * 400, "initial_review").num_ctx == 8192
+
+    planner = GenerationPlanner(keep_alive={"initial_review": "0"})
+    planner.plan("m", "x" * 4 * 7000, "initial_review")
+    assert planner.plan("m", "x" * 400, "initial_review").num_ctx == 2048
@@ -0,0 +1,20 @@
+import json
+
+import prompt_templates
+
+def test_prompts_are_compiled_once(tmp_path, monkeypatch):
+    """Test that the prompts are found relative to the package and reused from the compiled JSON."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(prompt_templates, "_loaded", {})
+    compiled_path = tmp_path / "prompts.json"
+
+    prompts = prompt_templates.load_prompts(compiled_path=str(compiled_path))
+    assert "default" in prompts["instructions"]
+    assert json.loads(compiled_path.read_text())["prompts"] == prompts
+
+    # A new process would read the compiled prompts instead of the YAML file
+    monkeypatch.setattr(prompt_templates, "_loaded", {})
+    compiled = json.loads(compiled_path.read_text())
+    compiled["prompts"]["examples"] = "from the compiled prompts"
+    compiled_path.write_text(json.dumps(compiled))
+    assert prompt_templates.load_prompts(compiled_path=str(compiled_path))["examples"] == "from the compiled prompts"
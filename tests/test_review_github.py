@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+from github_client import GitHubAPIError
+from jobs import ReviewJobQueue
+import storage
+from review_github import GitHubReviewer
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            pytest.fail("Timed out waiting for condition")
+        time.sleep(0.01)
+
+class FakeGitHubClient:
+    def __init__(self, head_sha):
+        self.head_sha = head_sha
+
+    def get_pull(self, repo_full_name, pr_number, installation_id):
+        if self.head_sha is None:
+            raise GitHubAPIError(502, "Bad Gateway")
+        return {"head": {"sha": self.head_sha}}
+
+@pytest.fixture
+def reviewer(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, "sessions", storage.SessionStore(str(tmp_path / "sessions.sqlite3")))
+    for name in ("GITHUB_APP_ID", "GITHUB_PRIVATE_KEY", "GITHUB_APP_WEBHOOK_SECRET"):
+        monkeypatch.setenv(name, "test")
+    reviewer = GitHubReviewer(None, None, ["m"], "", False, job_queue=ReviewJobQueue(workers=2, per_repo_limit=1), github_client=FakeGitHubClient("a" * 40))
+    reviewer.reviewed = []
+    reviewer.release = threading.Event()
+
+    def perform_review(pr_number, repo_full_name, installation_id, run):
+        # Stands in for fetching and reviewing the Pull Request
+        head_sha = reviewer.github.head_sha
+        reviewer.set_active_head(repo_full_name, pr_number, run, head_sha)
+        while not reviewer.release.wait(0.01):
+            run.check_cancelled()
+        reviewer.reviewed.append(head_sha)
+
+    reviewer._perform_review = perform_review
+    return reviewer
+
+def running_review(reviewer):
+    return reviewer.job_queue.running_job("org/repo", 1)
+
+def test_requests_are_coalesced_per_pull_request(reviewer):
+    """Test that a request for the head under review is merged and a request for a new head cancels the review."""
+    first = reviewer.request_review("org/repo", 1, 10)
+    wait_for(lambda: reviewer.active_reviews.get(("org/repo", 1), {}).get("head_sha") == "a" * 40)
+    # The head is checked by a job, not while the webhook is answered
+    check = reviewer.request_review("org/repo", 1, 10)
+    assert check is not first and not check.limited
+    wait_for(lambda: check.status == "finished")
+    assert first.merged == 1
+
+    reviewer.github.head_sha = "b" * 40
+    reviewer.request_review("org/repo", 1, 10)
+    wait_for(lambda: first.status == "cancelled")
+    wait_for(lambda: reviewer.active_reviews.get(("org/repo", 1), {}).get("head_sha") == "b" * 40)
+    second = running_review(reviewer)
+
+    # When the head cannot be fetched, the running review serves the request
+    reviewer.github.head_sha = None
+    check = reviewer.request_review("org/repo", 1, 10)
+    wait_for(lambda: check.status == "finished")
+    assert second.merged == 1
+    assert reviewer.job_queue.status()["queued"] == [] and running_review(reviewer) is second
+
+    reviewer.release.set()
+    wait_for(lambda: second.status == "finished")
+    assert reviewer.reviewed == ["b" * 40]
+
+def test_request_cancels_review_with_unknown_head(reviewer):
+    """Test that a request cancels a review that has not fetched the Pull Request yet."""
+    started = threading.Event()
+    fetch = threading.Event()
+    review = reviewer._perform_review
+
+    def perform_review(pr_number, repo_full_name, installation_id, run):
+        started.set()
+        fetch.wait()
+        review(pr_number, repo_full_name, installation_id, run)
+
+    reviewer._perform_review = perform_review
+    first = reviewer.request_review("org/repo", 1, 10)
+    started.wait(5)
+    check = reviewer.request_review("org/repo", 1, 10)
+    wait_for(lambda: check.status == "finished")
+    fetch.set()
+    wait_for(lambda: first.status == "cancelled")
+    reviewer.release.set()
+    wait_for(lambda: reviewer.reviewed == ["a" * 40])
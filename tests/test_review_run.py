@@ -0,0 +1,14 @@
+from review_run import ReviewRun
+
+def test_prompt_tokens_saved():
+    """Test that the prompt tokens reused from the KV cache are extrapolated from a fully evaluated prompt."""
+    run = ReviewRun()
+    assert run.prompt_tokens_saved() == 0
+
+    run.record_generation("a", "x" * 1000, {"prompt_eval_count": 250})
+    # 1200 characters at 0.25 tokens per character, of which only 100 were evaluated
+    run.record_generation("a", "x" * 1200, {"prompt_eval_count": 100})
+    # Every model has its own ratio
+    run.record_generation("b", "x" * 1000, {"prompt_eval_count": 500})
+    run.record_generation("b", "x" * 1000, {"prompt_eval_count": 500})
+    assert run.prompt_tokens_saved() == 200
@@ -0,0 +1,91 @@
+from diffs import parse_diff
+from ensemble import run_ensemble
+from storage import MAX_HISTORY_MESSAGES, SessionStore, file_fingerprint
+
+def test_sessions_are_evicted_and_loaded_again(tmp_path):
+    """Test that sessions are scoped by repository, evicted beyond the limit and loaded back from disk."""
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"), max_sessions=2)
+    first = store.get("org/one", 1)
+    first.record_review("abc", [], {})
+    assert store.get("org/two", 1) is not first
+
+    store.get("org/three", 1)
+    assert store.stats()["in_memory"] == 2 and store.evicted == 1
+
+    loaded = store.get("org/one", 1)
+    assert loaded is not first
+    assert loaded.last_reviewed_sha == "abc"
+    assert store.loaded == 1
+
+def test_history_stays_bounded(tmp_path):
+    """Test that the history keeps a bounded number of messages and summarizes the older ones."""
+    session = SessionStore(str(tmp_path / "sessions.sqlite3")).get("org/repo", 1)
+    for i in range(MAX_HISTORY_MESSAGES + 5):
+        session.add_message("assistant", f"Feedback number {i}")
+    assert len(session.conversation_history) == MAX_HISTORY_MESSAGES
+    assert "Feedback number 0" in session.summary
+
+    summaries = []
+
+    def summarize(summary, messages):
+        summaries.append(len(messages))
+        return "Summary of the earlier feedback"
+
+    # Nothing is summarized while the history fits
+    assert len(session.history(1000, summarize)) == MAX_HISTORY_MESSAGES + 1 and summaries == []
+
+    history = session.history(60, summarize)
+    assert summaries == [MAX_HISTORY_MESSAGES - 2]
+    assert [message["content"] for message in history] == ["Summary of the earlier feedback", f"Feedback number {MAX_HISTORY_MESSAGES + 3}", f"Feedback number {MAX_HISTORY_MESSAGES + 4}"]
+    # Only the latest messages are sent when the summary does not fit as well
+    assert len(session.history(12, summarize)) == 2
+
+def test_checked_out_sessions_are_not_evicted(tmp_path):
+    """Test that a session stays in memory while it is checked out, so that concurrent reviews share it."""
+    store = SessionStore(str(tmp_path / "sessions.sqlite3"), max_sessions=1)
+    with store.checkout("org/one", 1) as session:
+        store.get("org/two", 1)
+        store.get("org/three", 1)
+        assert store.get("org/one", 1) is session
+    store.get("org/two", 1)
+    assert store.stats()["in_memory"] == 1
+
+class FakeAgent:
+    def __init__(self):
+        self.changes = []
+
+    def fits(self, data, model):
+        return True
+
+    def analyze(self, data, model, out=None, run=None, slot=0):
+        self.changes.append(data.get("changes", ""))
+        return "", f"review {len(self.changes)}"
+
+def review_round(session, diff):
+    _, files = parse_diff(diff)
+    fingerprints = {file_diff.path: file_fingerprint(file_diff) for file_diff in files}
+    previous_units = session.valid_review_units(fingerprints) if session.last_reviewed_sha else []
+    reviewer = FakeAgent()
+    pr_data = {"title": "Test", "description": "", "changes": diff, "context": ""}
+    units, feedback = run_ensemble(pr_data, reviewer, FakeAgent(), ["a"], "", 1, lambda message: None, files, "", 10000, previous_units)
+    session.record_review("sha", units, fingerprints)
+    return reviewer.changes, feedback
+
+def file_diff(path, value):
+    return f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n@@ -1,1 +1,1 @@\n-x = 0\n+x = {value}\n"
+
+def test_incremental_review_reuses_unchanged_files(tmp_path):
+    """Test that only changed files are reviewed again, and outdated files are cleared once reviewed again."""
+    session = SessionStore(str(tmp_path / "sessions.sqlite3")).get("org/repo", 1)
+    reviewed, _ = review_round(session, file_diff("a.py", 1) + file_diff("b.py", 1))
+    assert len(reviewed) == 1
+
+    reviewed, feedback = review_round(session, file_diff("a.py", 1) + file_diff("b.py", 2))
+    assert len(reviewed) == 1 and "b/b.py" in reviewed[0] and "b/a.py" not in reviewed[0]
+    assert "disregard its comments on b.py" in feedback
+    assert not any(unit.get("outdated_paths") for unit in session.review_units)
+
+    reviewed, feedback = review_round(session, file_diff("a.py", 1) + file_diff("b.py", 2))
+    assert reviewed == []
+    assert "disregard" not in feedback
+    assert [unit["paths"] for unit in session.review_units] == [["a.py"], ["b.py"]]